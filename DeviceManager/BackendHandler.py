@@ -75,6 +75,15 @@ class KafkaHandler:
         LOGGER.info(f" Publishing remove event to Kafka")
         self.kafkaNotifier.send_notification(DeviceEvent.REMOVE, device, meta)
 
+    def remove_many(self, devices, meta):
+        """
+            Publishes a batch of events to kafka broker, notifying the removal
+            of each given device
+        """
+
+        LOGGER.info(f" Publishing {len(devices)} remove events to Kafka")
+        self.kafkaNotifier.send_notifications(DeviceEvent.REMOVE, devices, meta)
+
     def update(self, device, meta):
         """
             Publishes event to kafka broker, notifying device update
@@ -83,6 +92,15 @@ class KafkaHandler:
         LOGGER.info(f" Publishing create update to Kafka")
         self.kafkaNotifier.send_notification(DeviceEvent.UPDATE, device, meta)
 
+    def update_many(self, devices, meta):
+        """
+            Publishes a batch of events to kafka broker, notifying the update
+            of each given device
+        """
+
+        LOGGER.info(f" Publishing {len(devices)} update events to Kafka")
+        self.kafkaNotifier.send_notifications(DeviceEvent.UPDATE, devices, meta)
+
     def configure(self, device, meta):
         """
             Publishes event to kafka broker, notifying device configuration
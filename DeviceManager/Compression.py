@@ -0,0 +1,95 @@
+"""
+    Compresses responses according to the encodings accepted by the client.
+
+    Regular responses are compressed once they are larger than the configured
+    threshold. Streamed responses are compressed chunk by chunk, as they are
+    produced, so they are never buffered in memory.
+"""
+import zlib
+from flask import request
+
+from DeviceManager.app import app
+from DeviceManager.conf import CONFIG
+from DeviceManager.Logger import Log
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LOGGER = Log().color_log()
+
+
+def supported_encodings():
+    """ Lists the supported encodings, in order of preference """
+    encodings = ['gzip', 'deflate']
+    if zstandard is not None:
+        encodings.insert(0, 'zstd')
+    return encodings
+
+
+def negotiate_encoding(accept_encodings):
+    """
+    Selects the response encoding.
+
+    :param accept_encodings: The parsed Accept-Encoding header of the request
+    :return The selected encoding, or None if the response should be sent as is
+    """
+    return accept_encodings.best_match(supported_encodings())
+
+
+def make_compressor(encoding, level):
+    """
+    Builds an incremental compressor for the given encoding.
+
+    :return An object providing compress(data) and flush() methods
+    """
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    level = min(level, zlib.Z_BEST_COMPRESSION)
+    if encoding == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zlib.compressobj(level)
+
+
+def compress_stream(chunks, compressor, charset='utf-8'):
+    """ Compresses the chunks of a streamed response as they are produced """
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode(charset)
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+@app.after_request
+def compress_response(response):
+    if (CONFIG.compression_min_size < 0 or
+            response.status_code < 200 or response.status_code in (204, 304) or
+            response.direct_passthrough or 'Content-Encoding' in response.headers):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+
+    compressor = make_compressor(encoding, CONFIG.compression_level)
+    if response.is_streamed:
+        response.response = compress_stream(response.response, compressor, response.charset)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < CONFIG.compression_min_size:
+            return response
+        response.set_data(compressor.compress(data) + compressor.flush())
+        LOGGER.debug(f" Response compressed from {len(data)} to "
+                     f"{response.content_length} bytes ({encoding})")
+
+    response.headers['Content-Encoding'] = encoding
+    return response
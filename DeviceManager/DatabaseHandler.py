@@ -1,5 +1,6 @@
 import os
-from flask import g, request, jsonify, make_response
+from flask import g, request, make_response
+from DeviceManager.JsonEncoder import jsonify
 from flask_sqlalchemy import SQLAlchemy
 
 from .app import app
@@ -13,8 +14,17 @@ app.config['SQLALCHEMY_BINDS'] = {}
 
 LOGGER = Log().color_log()
 
+class BatchSQLAlchemy(SQLAlchemy):
+    def apply_driver_hacks(self, app, info, options):
+        super().apply_driver_hacks(app, info, options)
+        # executemany statements (such as the INSERTs the ORM issues for rows
+        # whose primary keys are known beforehand) are sent in pages, instead
+        # of one round trip per row
+        if info.drivername.endswith('psycopg2'):
+            options.setdefault('use_batch_mode', True)
+
 # adapted from https://gist.github.com/miikka/28a7bd77574a00fcec8d
-class MultiTenantSQLAlchemy(SQLAlchemy):
+class MultiTenantSQLAlchemy(BatchSQLAlchemy):
     def check_binds(self, bind_key):
         binds = app.config.get('SQLALCHEMY_BINDS')
         if binds.get(bind_key, None) is None:
@@ -36,7 +46,7 @@ class MultiTenantSQLAlchemy(SQLAlchemy):
 
 SINGLE_TENANT = os.environ.get('SINGLE_TENANT', False)
 if SINGLE_TENANT:
-    db = SQLAlchemy(app)
+    db = BatchSQLAlchemy(app)
 else:
     db = MultiTenantSQLAlchemy(app)
 
@@ -2,6 +2,8 @@ from datetime import datetime
 import re
 import sqlalchemy
 from sqlalchemy import event
+from sqlalchemy.sql import text
+from sqlalchemy.orm.attributes import set_committed_value
 
 from .app import app
 from .utils import HTTPRequestError
@@ -21,6 +23,11 @@ class DeviceOverride(db.Model):
 
     static_value = db.Column(db.String(128))
 
+    # A device overrides each attribute at most once
+    __table_args__ = (
+        sqlalchemy.UniqueConstraint('did', 'aid', name='overrides_did_aid_key'),
+    )
+
 class DeviceAttr(db.Model):
     __tablename__ = 'attrs'
 
@@ -56,12 +63,14 @@ class DeviceAttr(db.Model):
     )
 
     def __repr__(self):
+        # only shows children that are already loaded: repr must not query the database
         children_str=""
-        for child in self.children:
-            children_str += "«{}:{}»".format(child.label, child.static_value)
+        if 'children' not in sqlalchemy.inspect(self).unloaded:
+            for child in self.children:
+                children_str += "«{}:{}»".format(child.label, child.static_value)
 
         return "<Attr(label='{}', type='{}', value_type='{}', children='{}', parent={})>".format(
-            self.label, self.type, self.value_type, children_str, self.parent)
+            self.label, self.type, self.value_type, children_str, self.parent_id)
 
 
 class DeviceTemplate(db.Model):
@@ -82,15 +91,6 @@ class DeviceTemplate(db.Model):
                               back_populates="templates",
                               passive_deletes='all')
 
-    config_attrs = db.relationship('DeviceAttr',
-                                   primaryjoin=db.and_(DeviceAttr.template_id == id,
-                                                       DeviceAttr.type != 'static',
-                                                       DeviceAttr.type != 'dynamic',
-                                                       DeviceAttr.type != 'actuator'))
-    data_attrs = db.relationship('DeviceAttr',
-                                 primaryjoin=db.and_(DeviceAttr.template_id == id,
-                                                     DeviceAttr.type.in_(('static', 'dynamic', 'actuator'))))
-
     def __repr__(self):
         return "<Template(label={}, attrs={})>".format(self.label, self.attrs)
 
@@ -147,32 +147,192 @@ class DeviceAttrsPsk(db.Model):
             self.device_id, self.attr_id, self.psk)
 
 
-def assert_device_exists(device_id, session=None):
+class WriteGeneration(db.Model):
+    __tablename__ = 'write_generation'
+
+    # Single row table, bumped by every write performed on the tenant
+    id = db.Column(db.Integer, primary_key=True)
+    generation = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+class Job(db.Model):
+    __tablename__ = 'jobs'
+
+    id = db.Column(db.String(36), primary_key=True)
+    kind = db.Column(db.String(64), nullable=False)
+    # pending, running, done or failed
+    status = db.Column(db.String(16), nullable=False, default='pending')
+    # JSON: everything needed to perform the operation, along with the claims
+    # (not the token) of the request that submitted it
+    params = db.Column(db.Text, nullable=False)
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    # JSON: what the operation returned, or the error it raised
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    created = db.Column(db.DateTime, default=datetime.now)
+    started = db.Column(db.DateTime)
+    finished = db.Column(db.DateTime)
+    # running jobs are leased to the worker that claimed them, until locked_until
+    locked_until = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+
+    # pending jobs are claimed in creation order
+    __table_args__ = (
+        sqlalchemy.Index('jobs_status_created_idx', 'status', 'created'),
+    )
+
+    def __repr__(self):
+        return "<Job(id='%s', kind='%s', status='%s')>" % (self.id, self.kind, self.status)
+
+
+def assert_device_exists(device_id, session=None, options=None):
     """
     Assert that a device exists, returning the object retrieved from the
     database.
+
+    :param options: Optional query options, restricting what is loaded
     """
     try:
         if session:
             with session.no_autoflush:
-                return session.query(Device).filter_by(id=device_id).one()
+                query = session.query(Device)
+                if options:
+                    query = query.options(*options)
+                return query.filter_by(id=device_id).one()
         else:
-            return Device.query.filter_by(id=device_id).one()
+            query = Device.query
+            if options:
+                query = query.options(*options)
+            return query.filter_by(id=device_id).one()
     except sqlalchemy.orm.exc.NoResultFound:
         raise HTTPRequestError(404, "No such device: %s" % device_id)
 
 
-def assert_template_exists(template_id, session=None):
+def assert_template_exists(template_id, session=None, options=None):
     try:
         if session:
             with session.no_autoflush:
-                return session.query(DeviceTemplate).filter_by(id=template_id).one()
+                query = session.query(DeviceTemplate)
+                if options:
+                    query = query.options(*options)
+                return query.filter_by(id=template_id).one()
         else:
-            return DeviceTemplate.query.filter_by(id=template_id).one()
+            query = DeviceTemplate.query
+            if options:
+                query = query.options(*options)
+            return query.filter_by(id=template_id).one()
     except sqlalchemy.orm.exc.NoResultFound:
         raise HTTPRequestError(404, "No such template: %s" % template_id)
 
 
+def attr_tree(template_ids, *columns, where=None):
+    """
+    Builds a recursive CTE selecting every attribute of the given templates,
+    along with their whole metadata hierarchy.
+
+    :param template_ids: The templates whose attributes are to be selected
+    :param columns: Names of the attribute columns to be selected (all of
+    them if none is informed) - id is always selected
+    :param where: Optional condition the top level attributes must meet -
+    metadata of attributes left out are left out as well
+    """
+    attrs = DeviceAttr.__table__
+    child_attrs = attrs.alias('child_attrs')
+    if columns:
+        names = ['id'] + [name for name in columns if name != 'id']
+        selected = [attrs.c[name] for name in names]
+        child_selected = [child_attrs.c[name] for name in names]
+    else:
+        selected, child_selected = [attrs], [child_attrs]
+
+    condition = attrs.c.template_id.in_(template_ids)
+    if where is not None:
+        condition = sqlalchemy.and_(condition, where)
+    tree = sqlalchemy.select(selected).where(condition).cte('attr_tree', recursive=True)
+    return tree.union_all(sqlalchemy.select(child_selected).where(child_attrs.c.parent_id == tree.c.id))
+
+
+def load_attr_trees(templates, session=None):
+    """
+    Loads the attributes of the given templates, along with their whole
+    metadata hierarchy, using a single recursive query - whatever the number
+    of attributes or the depth of their metadata. The loaded trees are set as
+    the templates attrs and the attributes children, so that walking them
+    does not query the database any further.
+
+    :param templates: The templates whose attributes are to be loaded
+    :param session: The database session, the default one if not informed
+    """
+    templates = [template for template in templates if template is not None]
+    if not templates:
+        return
+    session = session or db.session
+
+    tree = attr_tree(set(template.id for template in templates))
+    with session.no_autoflush:
+        orm_attrs = session.query(DeviceAttr).select_entity_from(tree).order_by(tree.c.id).all()
+
+    by_template = {}
+    by_parent = {}
+    for orm_attr in orm_attrs:
+        if orm_attr.parent_id is None:
+            by_template.setdefault(orm_attr.template_id, []).append(orm_attr)
+        else:
+            by_parent.setdefault(orm_attr.parent_id, []).append(orm_attr)
+
+    for orm_attr in orm_attrs:
+        set_committed_value(orm_attr, 'children', by_parent.get(orm_attr.id, []))
+    for template in templates:
+        set_committed_value(template, 'attrs', by_template.get(template.id, []))
+
+
+def sequence_key(mapper):
+    """
+    Finds the sequence generating the primary key of a model.
+
+    :return The sequence and the name of the primary key attribute, or None
+    if the model primary key is not drawn from a sequence
+    """
+    if len(mapper.primary_key) != 1:
+        return None
+    column = mapper.primary_key[0]
+    if not isinstance(column.default, sqlalchemy.Sequence):
+        return None
+    return column.default, mapper.get_property_by_column(column).key
+
+
+def reserve_sequence_ids(session, sequence, count):
+    """ Draws count values from the given sequence, in a single query """
+    values = session.execute(
+        text("SELECT nextval(:sequence) FROM generate_series(1, :count)"),
+        {'sequence': sequence.name, 'count': count}).fetchall()
+    return [row[0] for row in values]
+
+
+def prefetch_sequence_ids(session, flush_context, instances):
+    """
+    Assigns primary keys to every new object of a sequence backed model
+    (templates, attributes, overrides), reserving the ids of each sequence
+    at once - instead of one nextval round trip per inserted row. Rows whose
+    primary keys are known beforehand are then inserted by executemany
+    statements (see DatabaseHandler).
+    """
+    pending = {}
+    for instance in session.new:
+        key = sequence_key(sqlalchemy.inspect(instance).mapper)
+        if key is None or getattr(instance, key[1]) is not None:
+            continue
+        pending.setdefault(key[0].name, (key[0], key[1], []))[2].append(instance)
+
+    for sequence, attribute, new_instances in pending.values():
+        ids = reserve_sequence_ids(session, sequence, len(new_instances))
+        for instance, new_id in zip(new_instances, ids):
+            setattr(instance, attribute, new_id)
+
+
+event.listen(db.session, 'before_flush', prefetch_sequence_ids)
+
+
 def assert_device_relation_exists(device_id, template_id):
     try:
         return DeviceTemplateMap.query.filter_by(device_id=device_id, template_id=template_id).one()
@@ -5,15 +5,19 @@
 import re
 import logging
 import json
+import itertools
 import time
 from datetime import datetime
 import secrets
-from flask import request, jsonify, Blueprint, make_response
+from flask import request, Blueprint, make_response, Response, stream_with_context
+from DeviceManager.JsonEncoder import jsonify
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import or_, and_, func, text
+from sqlalchemy import or_, and_, func, text, select, literal, union_all, cast, String, Integer
+from sqlalchemy.orm import load_only, joinedload, noload
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 from DeviceManager.utils import *
-from DeviceManager.utils import create_id, get_pagination, format_response
+from DeviceManager.utils import get_pagination, format_response
 from DeviceManager.utils import HTTPRequestError
 from DeviceManager.conf import CONFIG
 from DeviceManager.BackendHandler import KafkaHandler, KafkaInstanceHandler
@@ -22,11 +26,17 @@ from DeviceManager.DatabaseHandler import db
 from DeviceManager.DatabaseModels import assert_device_exists, assert_template_exists
 from DeviceManager.DatabaseModels import handle_consistency_exception, assert_device_relation_exists
 from DeviceManager.DatabaseModels import DeviceTemplate, DeviceAttr, Device, DeviceTemplateMap, DeviceAttrsPsk
-from DeviceManager.DatabaseModels import DeviceOverride
+from DeviceManager.DatabaseModels import DeviceOverride, load_attr_trees
 from DeviceManager.SerializationModels import device_list_schema, device_schema, ValidationError
-from DeviceManager.SerializationModels import attr_list_schema
+from DeviceManager.SerializationModels import attr_list_schema, AttrSchema, DeviceSchema
+from DeviceManager.SerializationModels import DEVICE_FIELDS, parse_fields, selective_schema
 from DeviceManager.SerializationModels import parse_payload, load_attrs, validate_repeated_attrs
+from DeviceManager.SerializationModels import parse_merge_patch, parse_json_object
 from DeviceManager.TenancyManager import init_tenant_context
+from DeviceManager.IdAllocator import allocate_device_ids, id_space_usage
+from DeviceManager.QueryCache import LISTING_CACHE, bump_generation, current_generation
+from DeviceManager.RequestCoalescer import coalesced
+from DeviceManager.JobHandler import JobHandler, register_job, is_async
 from DeviceManager.app import app
 from DeviceManager.Logger import Log
 
@@ -35,6 +45,73 @@ device = Blueprint('device', __name__)
 
 LOGGER = Log().color_log()
 
+# Maximum number of rows inserted by a single statement
+BULK_INSERT_CHUNK = 1000
+
+# Number of devices loaded (and notified) at once by bulk operations
+NOTIFY_BATCH = 500
+
+# How many devices are removed by each statement of a bulk delete
+DELETE_BATCH = 1000
+
+# Attribute fields whose serialization depends on the device overrides
+OVERRIDE_FIELDS = frozenset(['static_value', 'is_static_overridden', 'metadata'])
+ATTR_COLUMNS = ('label', 'created', 'updated', 'type', 'value_type', 'static_value')
+
+def attr_load_options(path, attr_fields):
+    """
+    Restricts the attribute columns and relationships loaded through the given
+    loader path to what the selected attribute fields need
+    """
+    if not attr_fields:
+        return [path]
+    columns = [name for name in ATTR_COLUMNS if name in attr_fields]
+    if 'is_static_overridden' in attr_fields and 'static_value' not in columns:
+        # the flag is only computed for attributes with a static value
+        columns.append('static_value')
+    options = [path.load_only('id', 'template_id', 'parent_id', *columns)]
+    if 'metadata' not in attr_fields:
+        options.append(path.noload(DeviceAttr.children))
+    return options
+
+def device_load_options(fields, sensitive_data=False):
+    """
+    Builds the query options needed to load devices for the given sparse
+    fieldset: unrequested columns are deferred and unrequested relationships
+    are not loaded at all.
+
+    :param fields: Parsed field selection, as returned by parse_fields
+    :param sensitive_data: Whether pre shared keys might be serialized
+    :return A list of query options
+    """
+    if fields is None:
+        return []
+
+    columns = [name for name in ('label', 'created', 'updated') if name in fields]
+    options = [load_only('id', *columns)]
+
+    attr_fields = fields.get('attrs')
+    templates = joinedload(Device.templates)
+    if attr_fields is not None:
+        options.append(templates.load_only('id'))
+        options.extend(attr_load_options(templates.joinedload(DeviceTemplate.attrs), attr_fields))
+    elif 'templates' in fields:
+        options.append(templates.load_only('id'))
+        options.append(templates.noload(DeviceTemplate.attrs))
+    else:
+        options.append(noload(Device.templates))
+
+    if attr_fields is None or (attr_fields and not attr_fields & OVERRIDE_FIELDS):
+        options.append(noload(Device.overrides))
+    if not sensitive_data or attr_fields is None or (attr_fields and 'static_value' not in attr_fields):
+        options.append(noload(Device.pre_shared_keys))
+
+    return options
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
 def fill_overridden_flag(attrs):
     # Update all static attributes with "is_static_overridden" attribute
     for templateId in attrs:
@@ -48,43 +125,69 @@ def fill_overridden_flag(attrs):
 
 
 
+def apply_override(attrs, orm_attr, static_value):
+    if orm_attr.template_id is not None:
+        for attr in attrs[orm_attr.template_id]:
+            if attr['id'] == orm_attr.id:
+                attr['static_value'] = static_value
+                attr['is_static_overridden'] = True
+    else:
+        # If override attr does not have template_id it means we have a metadata override
+        # TODO: Here we do not handle multiple hierarchical levels of metadata
+        for attr in attrs[orm_attr.parent.template_id]:
+            if attr['id'] == orm_attr.parent_id:
+                for metadata in attr.get('metadata', []):
+                    if metadata['id'] == orm_attr.id:
+                        metadata['static_value'] = static_value
+                        metadata['is_static_overridden'] = True
+
 def serialize_override_attrs(orm_overrides, attrs):
 
     fill_overridden_flag(attrs)
 
     for override in orm_overrides:
-        if override.attr.template_id is not None:
-            for attr in attrs[override.attr.template_id]:
-                if attr['id'] == override.aid:
-                    attr['static_value'] = override.static_value
-                    attr['is_static_overridden'] = True
-        else:
-            # If override attr does not have template_id it means we have a metadata override
-            # TODO: Here we do not handle multiple hierarchical levels of metadata
-            for attr in attrs[override.attr.parent.template_id]:
-                if attr['id'] == override.attr.parent_id:
-                    for metadata in attr['metadata']:
-                        if metadata['id'] == override.aid:
-                            metadata['static_value'] = override.static_value
-                            metadata['is_static_overridden'] = True
-
-def serialize_full_device(orm_device, tenant, sensitive_data=False):
-    data = device_schema.dump(orm_device)
+        apply_override(attrs, override.attr, override.static_value)
+
+def serialize_full_device(orm_device, tenant, sensitive_data=False, fields=None):
+    attr_fields = None
+    attrs_schema = attr_list_schema
+    if fields is None:
+        data = device_schema.dump(orm_device)
+    else:
+        selected = frozenset(fields) - {'attrs'}
+        data = selective_schema(DeviceSchema, selected).dump(orm_device) if selected else {}
+        if 'attrs' not in fields:
+            return data
+        attr_fields = fields['attrs']
+        if attr_fields:
+            # attribute ids are needed to apply overrides and keys, and static
+            # values to compute is_static_overridden (see fill_overridden_flag)
+            internal = {'id', 'static_value'} if 'is_static_overridden' in attr_fields else {'id'}
+            attrs_schema = selective_schema(AttrSchema, attr_fields | internal, many=True)
+
     data['attrs'] = {}
     for template in orm_device.templates:
-        data['attrs'][template.id] = attr_list_schema.dump(template.attrs)
+        data['attrs'][template.id] = attrs_schema.dump(template.attrs)
 
     # Override device regular and metadata attributes
-    serialize_override_attrs(orm_device.overrides, data['attrs'])
+    if not attr_fields or attr_fields & OVERRIDE_FIELDS:
+        serialize_override_attrs(orm_device.overrides, data['attrs'])
 
-    if sensitive_data:
+    if sensitive_data and (not attr_fields or 'static_value' in attr_fields):
         for psk_data in orm_device.pre_shared_keys:
             for template_id in data['attrs']:
                 for attr in data['attrs'][template_id]:
                     if attr['id'] == psk_data.attr_id:
                         dec = decrypt(psk_data.psk)
                         attr['static_value'] = dec.decode('ascii')
-    
+
+    if attr_fields:
+        for template_id in data['attrs']:
+            data['attrs'][template_id] = [
+                {key: value for key, value in attr.items() if key in attr_fields}
+                for attr in data['attrs'][template_id]
+            ]
+
     return data
 
 def find_template(template_list, id):
@@ -93,7 +196,15 @@ def find_template(template_list, id):
         if template.id == int(id):
             return template
 
-def create_orm_override(attr, orm_device, orm_template):
+def collect_overrides(attr, orm_template):
+    """
+    Validates an attribute override (as received in a device payload) against
+    the template it refers to.
+
+    :return A list of (attribute, static value) pairs to be overridden
+    :raises HTTPRequestError: If the attribute (or metadata) is unknown
+    """
+    overrides = []
     try:
         target = int(attr['id'])
     except ValueError:
@@ -105,13 +216,7 @@ def create_orm_override(attr, orm_device, orm_template):
         if target == orm_attr.id:
             found = True
             if 'static_value' in attr and attr['static_value'] is not None:
-                orm_override = DeviceOverride(
-                    device=orm_device,
-                    attr=orm_attr,
-                    static_value=attr['static_value']
-                )
-                db.session.add(orm_override)
-                LOGGER.debug(f" Added overrided form {orm_override}")
+                overrides.append((orm_attr, attr['static_value']))
 
             # Update possible metadata field
             if 'metadata' in attr:
@@ -131,19 +236,25 @@ def create_orm_override(attr, orm_device, orm_template):
                             if metadata_target == orm_attr_child.id:
                                 found = True
                                 if 'static_value' in metadata and metadata['static_value'] is not None:
-                                    orm_override = DeviceOverride(
-                                        device=orm_device,
-                                        attr=orm_attr_child,
-                                        static_value=metadata['static_value']
-                                    )
-                                    db.session.add(orm_override)
-                                    LOGGER.debug(f" Added overrided form {orm_override}")
+                                    overrides.append((orm_attr_child, metadata['static_value']))
 
 
     if not found:
         LOGGER.error(f" Unknown attribute {attr['id']} in override list")
         raise HTTPRequestError(400, 'Unknown attribute {} in override list'.format(target))
 
+    return overrides
+
+def create_orm_override(attr, orm_device, orm_template):
+    for orm_attr, static_value in collect_overrides(attr, orm_template):
+        orm_override = DeviceOverride(
+            device=orm_device,
+            attr=orm_attr,
+            static_value=static_value
+        )
+        db.session.add(orm_override)
+        LOGGER.debug(f" Added overrided form {orm_override}")
+
 
 def auto_create_template(json_payload, new_device):
     if ('attrs' in json_payload) and (new_device.templates is None):
@@ -169,6 +280,347 @@ def parse_template_list(template_list, new_device):
     for template_id in template_list:
         new_device.templates.append(assert_template_exists(template_id, db.session))
 
+def update_template_list(template_list, orm_device):
+    """
+    Associates the device with exactly the given templates, touching only the
+    associations that changed. Pre shared keys of attributes from templates
+    no longer associated are removed.
+    """
+    try:
+        requested = [int(template_id) for template_id in template_list]
+    except (TypeError, ValueError):
+        raise HTTPRequestError(400, 'Template ids must be integers')
+
+    current = {orm_template.id: orm_template for orm_template in orm_device.templates}
+    for template_id, orm_template in current.items():
+        if template_id not in requested:
+            LOGGER.debug(f" Removing template {template_id} from device {orm_device.id}")
+            orm_device.templates.remove(orm_template)
+
+    for template_id in requested:
+        if template_id not in current:
+            LOGGER.debug(f" Adding template {template_id} to device {orm_device.id}")
+            orm_device.templates.append(assert_template_exists(template_id, db.session))
+            current[template_id] = None
+
+    for psk in list(orm_device.pre_shared_keys):
+        if psk.attrs.template_id not in requested:
+            orm_device.pre_shared_keys.remove(psk)
+            db.session.delete(psk)
+
+def update_orm_overrides(attrs, orm_device):
+    """
+    Makes the device overrides match the ones requested in its attribute
+    list: changed overrides are updated in place, new ones are created and
+    overrides no longer requested are removed.
+    """
+    requested = {}
+    for attr in attrs:
+        orm_template = find_template(orm_device.templates, attr['template_id'])
+        if orm_template is None:
+            LOGGER.error(f" Unknown template {attr['template_id']} in attr list")
+            raise HTTPRequestError(400, 'Unknown template {} in attr list'.format(attr['template_id']))
+        for orm_attr, static_value in collect_overrides(attr, orm_template):
+            requested[orm_attr.id] = (orm_attr, static_value)
+
+    for orm_override in list(orm_device.overrides):
+        if orm_override.aid not in requested:
+            orm_device.overrides.remove(orm_override)
+            db.session.delete(orm_override)
+            continue
+        orm_attr, static_value = requested.pop(orm_override.aid)
+        if orm_override.static_value != static_value:
+            orm_override.static_value = static_value
+
+    for orm_attr, static_value in requested.values():
+        db.session.add(DeviceOverride(device=orm_device, attr=orm_attr, static_value=static_value))
+
+def set_orm_override(orm_device, orm_overrides, orm_attr, static_value):
+    """
+    Sets (or, if static_value is None, removes) the override of a single
+    attribute. orm_overrides maps attribute ids to the device overrides.
+
+    :return True if anything was changed
+    """
+    orm_override = orm_overrides.get(orm_attr.id)
+    if static_value is None:
+        if orm_override is None:
+            return False
+        orm_device.overrides.remove(orm_override)
+        db.session.delete(orm_override)
+        del orm_overrides[orm_attr.id]
+    elif orm_override is None:
+        orm_override = DeviceOverride(device=orm_device, attr=orm_attr, static_value=static_value)
+        db.session.add(orm_override)
+        orm_overrides[orm_attr.id] = orm_override
+    elif orm_override.static_value != static_value:
+        orm_override.static_value = static_value
+    else:
+        return False
+    return True
+
+def find_orm_attr(orm_attrs, attr_id):
+    try:
+        target = int(attr_id)
+    except (TypeError, ValueError):
+        raise HTTPRequestError(400, 'Unknown attribute {} in override list'.format(attr_id))
+    for orm_attr in orm_attrs:
+        if orm_attr.id == target:
+            return orm_attr
+    raise HTTPRequestError(400, 'Unknown attribute {} in override list'.format(attr_id))
+
+def patch_orm_overrides(attrs, orm_device):
+    """
+    Applies the overrides listed in a device merge patch. Only the listed
+    attributes (and metadata) are touched; a null static_value removes the
+    override.
+
+    Note that this deviates from RFC 7396, under which an array replaces the
+    target one wholesale: attrs (and metadata) arrays are merged element by
+    element instead, matching elements by id, so that a single override can
+    be patched without restating every other one.
+
+    :return True if anything was changed
+    :raises HTTPRequestError: If an override (or its template, attribute or
+    metadata) is invalid
+    """
+    if not isinstance(attrs, list) or not all(isinstance(attr, dict) for attr in attrs):
+        raise HTTPRequestError(400, 'attrs must be a list of attribute overrides')
+
+    orm_overrides = {orm_override.aid: orm_override for orm_override in orm_device.overrides}
+    changed = False
+    for attr in attrs:
+        try:
+            orm_template = find_template(orm_device.templates, attr.get('template_id'))
+        except (TypeError, ValueError):
+            orm_template = None
+        if orm_template is None:
+            LOGGER.error(f" Unknown template {attr.get('template_id')} in attr list")
+            raise HTTPRequestError(400, 'Unknown template {} in attr list'.format(attr.get('template_id')))
+
+        orm_attr = find_orm_attr(orm_template.attrs, attr.get('id'))
+        if 'static_value' in attr:
+            changed |= set_orm_override(orm_device, orm_overrides, orm_attr, attr['static_value'])
+
+        metadata_list = attr.get('metadata', [])
+        if not isinstance(metadata_list, list) or \
+                not all(isinstance(metadata, dict) for metadata in metadata_list):
+            raise HTTPRequestError(400, 'metadata must be a list of metadata overrides')
+        for metadata in metadata_list:
+            orm_metadata = find_orm_attr(orm_attr.children, metadata.get('id'))
+            if 'static_value' in metadata:
+                changed |= set_orm_override(orm_device, orm_overrides, orm_metadata,
+                                            metadata['static_value'])
+    return changed
+
+def label_condition(label):
+    """
+    Builds the condition selecting the devices whose label contains the given
+    text - the very match GET /device?label= performs, so that a selector
+    picks the same devices as the listing does.
+    """
+    return Device.label.like("%{}%".format(label))
+
+def device_selector(selector):
+    """
+    Builds the conditions (over Device) selecting the devices described by a
+    selector, combining all its given criteria:
+        - template: id of a template the devices must be associated with
+        - label: text the device labels must contain (see label_condition)
+        - ids: list of device ids
+
+    :return A list of SQLAlchemy conditions
+    :raises HTTPRequestError: If the selector is empty or invalid
+    """
+    if not isinstance(selector, dict):
+        raise HTTPRequestError(400, "A device selector (template, label and/or ids) is required")
+
+    conditions = []
+    if selector.get('template') is not None:
+        try:
+            template_id = int(selector['template'])
+        except (TypeError, ValueError):
+            raise HTTPRequestError(400, "Selector template must be a template id")
+        conditions.append(Device.id.in_(select([DeviceTemplateMap.device_id])
+                                        .where(DeviceTemplateMap.template_id == template_id)))
+    if selector.get('label') is not None:
+        conditions.append(label_condition(selector['label']))
+    if selector.get('ids') is not None:
+        if not isinstance(selector['ids'], list):
+            raise HTTPRequestError(400, "Selector ids must be a list of device ids")
+        conditions.append(Device.id.in_([str(device_id) for device_id in selector['ids']]))
+
+    if not conditions:
+        raise HTTPRequestError(400, "A device selector (template, label and/or ids) is required")
+    return conditions
+
+def iter_devices(device_ids, batch=NOTIFY_BATCH):
+    """
+    Loads the given devices, yielding them in lists of (at most) batch
+    devices. The attributes of their templates are loaded by a single query
+    per batch.
+    """
+    device_ids = list(device_ids)
+    for chunk in chunks(device_ids, batch):
+        orm_devices = (db.session.query(Device)
+                       .options(joinedload(Device.templates).noload(DeviceTemplate.attrs))
+                       .filter(Device.id.in_(chunk)).all())
+        load_attr_trees(set(template for orm_device in orm_devices for template in orm_device.templates),
+                        db.session)
+        yield orm_devices
+
+def iter_template_device_ids(template_id, batch=NOTIFY_BATCH):
+    """
+    Yields the ids (sorted) of the devices associated with a template, in
+    lists of at most batch ids. Each list is read by a single query over the
+    device_template index, resuming after the last id read.
+    """
+    last = None
+    while True:
+        query = (db.session.query(DeviceTemplateMap.device_id)
+                 .filter(DeviceTemplateMap.template_id == template_id))
+        if last is not None:
+            query = query.filter(DeviceTemplateMap.device_id > last)
+        device_ids = [row[0] for row in
+                      query.order_by(DeviceTemplateMap.device_id).limit(batch).all()]
+        if not device_ids:
+            return
+        last = device_ids[-1]
+        yield device_ids
+
+def parse_template_id(template_id):
+    """ Converts a template id received from a request into an integer """
+    try:
+        return int(template_id)
+    except (TypeError, ValueError):
+        raise HTTPRequestError(400, "Template ids must be integers")
+
+def template_attr_ids(template_id):
+    """ Selects the ids of every attribute (and metadata) of a template """
+    top_level = select([DeviceAttr.id]).where(DeviceAttr.template_id == template_id)
+    return select([DeviceAttr.id]).where(or_(DeviceAttr.template_id == template_id,
+                                             DeviceAttr.parent_id.in_(top_level)))
+
+def template_conflicts(template_id, selected, ignored=None):
+    """
+    Builds a query listing, for each device in selected, the attributes
+    (device_id, label, type) of the given template which clash with the
+    attributes the device already has - that is, what would make the
+    validate_device trigger refuse the association. Associations with the
+    template itself, and with ignored (if given), are not taken into account.
+    """
+    current = DeviceAttr.__table__.alias('current_attrs')
+    added = DeviceAttr.__table__.alias('added_attrs')
+    excluded = [template_id] if ignored is None else [template_id, ignored]
+    return (select([DeviceTemplateMap.device_id, added.c.label, added.c.type])
+            .select_from(DeviceTemplateMap.__table__
+                         .join(current, current.c.template_id == DeviceTemplateMap.template_id)
+                         .join(added, and_(added.c.template_id == template_id,
+                                           added.c.label == current.c.label,
+                                           added.c.type == current.c.type)))
+            .where(and_(DeviceTemplateMap.device_id.in_(selected),
+                        DeviceTemplateMap.template_id.notin_(excluded)))
+            .distinct())
+
+def collect_conflicts(rows):
+    """ Groups conflicting attributes (device_id, label, type) by device """
+    conflicts = {}
+    for device_id, label, attr_type in rows:
+        conflicts.setdefault(device_id, []).append({'label': label, 'type': attr_type})
+    return conflicts
+
+def link_template(template_id, selected, ignored=None):
+    """
+    Associates a template with every device in selected that is not yet
+    associated with it - skipping those with conflicting attributes - using a
+    single INSERT ... SELECT.
+
+    :return The ids of the devices associated, and the conflicts found
+    """
+    conflicting = template_conflicts(template_id, selected, ignored)
+    conflicts = collect_conflicts(db.session.execute(conflicting))
+
+    linked = select([DeviceTemplateMap.device_id]).where(DeviceTemplateMap.template_id == template_id)
+    source = (select([Device.id, literal(template_id)])
+              .where(and_(Device.id.in_(selected),
+                          Device.id.notin_(linked),
+                          Device.id.notin_(select([conflicting.alias('conflicting').c.device_id])))))
+    insert = (pg_insert(DeviceTemplateMap.__table__)
+              .from_select(['device_id', 'template_id'], source)
+              .on_conflict_do_nothing()
+              .returning(DeviceTemplateMap.device_id))
+    return [row[0] for row in db.session.execute(insert)], conflicts
+
+def unlink_template(template_id, selected):
+    """
+    Disassociates a template from every device in selected, removing the
+    overrides and pre shared keys the devices had on its attributes.
+
+    :return The ids of the devices disassociated
+    """
+    unlinked = (select([DeviceTemplateMap.device_id])
+                .where(and_(DeviceTemplateMap.template_id == template_id,
+                            DeviceTemplateMap.device_id.in_(selected))))
+    attr_ids = template_attr_ids(template_id)
+    db.session.execute(DeviceOverride.__table__.delete()
+                       .where(and_(DeviceOverride.did.in_(unlinked),
+                                   DeviceOverride.aid.in_(attr_ids))))
+    db.session.execute(DeviceAttrsPsk.__table__.delete()
+                       .where(and_(DeviceAttrsPsk.device_id.in_(unlinked),
+                                   DeviceAttrsPsk.attr_id.in_(attr_ids))))
+    result = db.session.execute(DeviceTemplateMap.__table__.delete()
+                                .where(and_(DeviceTemplateMap.template_id == template_id,
+                                            DeviceTemplateMap.device_id.in_(selected)))
+                                .returning(DeviceTemplateMap.device_id))
+    return [row[0] for row in result]
+
+def touch_devices(device_ids):
+    """ Sets the 'updated' column of the given devices """
+    if device_ids:
+        db.session.execute(Device.__table__.update()
+                           .where(Device.id.in_(device_ids))
+                           .values(updated=datetime.now()))
+
+def resolve_attr_key(candidates, key):
+    """
+    Finds the attribute referred to by key - either its id or its label -
+    among candidates ((id, label) rows).
+
+    :return The attribute id
+    :raises HTTPRequestError: If no (or more than one) attribute matches
+    """
+    if key.isdigit():
+        for attr_id, _ in candidates:
+            if attr_id == int(key):
+                return attr_id
+
+    matches = [attr_id for attr_id, label in candidates if label == key]
+    if not matches:
+        raise HTTPRequestError(400, 'Unknown attribute {} in override list'.format(key))
+    if len(matches) > 1:
+        raise HTTPRequestError(400, 'Attribute label {} is ambiguous, use its id instead'.format(key))
+    return matches[0]
+
+def override_value(value):
+    """
+    Coerces an attribute value, as received by the attribute value endpoints,
+    into the string an override stores: strings are kept as they are, other
+    scalars (numbers and booleans) are JSON encoded and null is kept as None
+    (the override is removed).
+
+    :raises HTTPRequestError: If the value is not a scalar
+    """
+    if isinstance(value, (dict, list)):
+        raise HTTPRequestError(400, "Attribute values must be scalars")
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+def tenant_generation(token):
+    """ Current write generation of the tenant, keying coalesced reads """
+    init_tenant_context(token, db)
+    return current_generation(db.session)
+
 def find_attribute(orm_device, attr_name, attr_type):
     """
     Find a particular attribute in a device retrieved from database.
@@ -200,26 +652,41 @@ class DeviceHandler(object):
         """
         Creates a new device id
         :return The new ID
-        :rtype int
-        :raises HTTPRequestError: If this function can't generate a new valid
-        ID after 10 attempts.
+        :rtype str
+        :raises HTTPRequestError: If the device id space is exhausted.
+        """
+        new_id = allocate_device_ids(db.session, 1)[0]
+        LOGGER.debug(f" Generated a new device id {new_id}")
+        return new_id
+
+    @staticmethod
+    def generate_device_ids(count):
         """
+        Creates a batch of new device ids, drawn from the tenant id sequence
+        in a single round trip.
 
-        # TODO this is awful, makes me sad, but for now also makes demoing
-        # easier We might want to look into an auto-configuration feature for
-        # devices, such that ids are not input manually on devices
+        :param count: How many ids should be created
+        :return The new IDs
+        :rtype list
+        :raises HTTPRequestError: If the device id space is exhausted.
+        """
+        ids = allocate_device_ids(db.session, count)
+        LOGGER.debug(f" Generated {count} new device ids")
+        return ids
 
-        _attempts = 0
-        generated_id = ''
-        while _attempts < 10 and len(generated_id) == 0:
-            _attempts += 1
-            new_id = create_id()
-            if Device.query.filter_by(id=new_id).first() is None:
-                LOGGER.debug(f" Generated a new device id {new_id}")
-                return new_id
+    @staticmethod
+    def get_id_space(token):
+        """
+        Reports how full the device id space of the tenant is.
 
-        LOGGER.error(f" Failed to generate unique device_id")
-        raise HTTPRequestError(500, "Failed to generate unique device_id")
+        :param token: The authorization token (JWT).
+        :return A JSON with the id space capacity and usage.
+        :rtype JSON
+        :raises HTTPRequestError: If no authorization token was provided (no
+        tenant was informed)
+        """
+        init_tenant_context(token, db)
+        return id_space_usage(db.session)
 
     @staticmethod
     def list_ids(token):
@@ -241,6 +708,7 @@ class DeviceHandler(object):
         return data
 
     @staticmethod
+    @coalesced('devices', tenant_generation)
     def get_devices(token, params, sensitive_data=False):
         """
         Fetches known devices, potentially limited by a given value. Ordering
@@ -248,7 +716,7 @@ class DeviceHandler(object):
 
         :param token: The authorization token (JWT).
         :param params: Parameters received from request (page_number, per_page, 
-        sortBy, attr, attr_type, label, template, idsOnly)
+        sortBy, attr, attr_type, label, template, idsOnly, fields)
         :param sensitive_data: Informs if sensitive data like keys should be
         returned
         :return A JSON containing pagination information and the device list
@@ -258,7 +726,18 @@ class DeviceHandler(object):
         """
         tenant = init_tenant_context(token, db)
 
+        # listings carrying sensitive data (pre shared keys) are never kept in
+        # memory: the cache ignores results of unknown generations
+        cache_key = ('devices', LISTING_CACHE.normalize(params))
+        generation = None if sensitive_data else current_generation(db.session)
+        result = LISTING_CACHE.get(tenant, generation, cache_key)
+        if result is not None:
+            LOGGER.debug(f" Device listing retrieved from cache")
+            return result
+
         pagination = {'page': params.get('page_number'), 'per_page': params.get('per_page'), 'error_out': False}
+        fields = parse_fields(params.get('fields'), DEVICE_FIELDS)
+        load_options = device_load_options(fields, sensitive_data)
 
         SORT_CRITERION = {
             'label': Device.label,
@@ -284,7 +763,7 @@ class DeviceHandler(object):
         label_filter = []
         target_label = params.get('label')
         if target_label:
-            label_filter.append(Device.label.like("%{}%".format(target_label)))
+            label_filter.append(label_condition(target_label))
 
         template_filter = []
         target_template = params.get('template')
@@ -295,6 +774,7 @@ class DeviceHandler(object):
             LOGGER.debug(f" Filtering devices by {attr_filter}")
 
             page = db.session.query(Device) \
+                            .options(*load_options) \
                             .join(DeviceTemplateMap, isouter=True)
 
             page = page.join(DeviceTemplate) \
@@ -316,6 +796,7 @@ class DeviceHandler(object):
                 LOGGER.debug(f"Filtering devices with template: {target_template}")     
             
             page = db.session.query(Device) \
+                            .options(*load_options) \
                             .join(DeviceTemplateMap, isouter=True)
 
             if sensitive_data: #aditional joins for sensitive data
@@ -330,15 +811,17 @@ class DeviceHandler(object):
 
         else:
             LOGGER.debug(f" Querying devices sorted by device id")
-            page = db.session.query(Device).order_by(sortBy).paginate(**pagination)
+            page = db.session.query(Device).options(*load_options).order_by(sortBy).paginate(**pagination)
 
         devices = []
         
         if params.get('idsOnly').lower() in ['true', '1', '']:
-            return DeviceHandler.get_only_ids(page)
+            result = DeviceHandler.get_only_ids(page)
+            LISTING_CACHE.put(tenant, generation, cache_key, result)
+            return result
 
         for d in page.items:
-            devices.append(serialize_full_device(d, tenant, sensitive_data))
+            devices.append(serialize_full_device(d, tenant, sensitive_data, fields))
 
 
         result = {
@@ -351,6 +834,7 @@ class DeviceHandler(object):
             'devices': devices
         }
 
+        LISTING_CACHE.put(tenant, generation, cache_key, result)
         return result
 
     @staticmethod
@@ -366,7 +850,8 @@ class DeviceHandler(object):
         return device_id
 
     @staticmethod
-    def get_device(token, device_id, sensitive_data=False):
+    @coalesced('device', tenant_generation)
+    def get_device(token, device_id, sensitive_data=False, fields=None):
         """
         Fetches a single device.
 
@@ -374,6 +859,8 @@ class DeviceHandler(object):
         :param device_id: The requested device.
         :param sensitive_data: Informs if sensitive data like keys should be
         returned
+        :param fields: Sparse fieldset selection (e.g. 'id,label,attrs.label'),
+        None to retrieve the full device
         :return A Device
         :rtype Device, as described in DatabaseModels package
         :raises HTTPRequestError: If no authorization token was provided (no
@@ -383,8 +870,10 @@ class DeviceHandler(object):
         """
 
         tenant = init_tenant_context(token, db)
-        orm_device = assert_device_exists(device_id)
-        return serialize_full_device(orm_device, tenant, sensitive_data)
+        selection = parse_fields(fields, DEVICE_FIELDS)
+        orm_device = assert_device_exists(device_id,
+                                          options=device_load_options(selection, sensitive_data))
+        return serialize_full_device(orm_device, tenant, sensitive_data, selection)
 
     @staticmethod
     def validate_device_id(device_id):
@@ -436,6 +925,9 @@ class DeviceHandler(object):
             raise HTTPRequestError(
                 400, "Verbose can only be used for single device creation")
 
+        if count > 1:
+            return cls.create_devices_bulk(params, count, c_length, tenant)
+
         devices = []
         full_device = None
         orm_devices = []
@@ -447,7 +939,7 @@ class DeviceHandler(object):
                 device_data, json_payload = parse_payload(content_type, data_request, device_schema)
                 validate_repeated_attrs(json_payload)
 
-                if json_payload.get('id', None) is None or count > 1 : 
+                if json_payload.get('id', None) is None:
                     device_data['id'] = DeviceHandler.generate_device_id()
                 else:
                     DeviceHandler.validate_device_id(json_payload['id'])
@@ -460,6 +952,7 @@ class DeviceHandler(object):
                 auto_create_template(json_payload, orm_device)
                 db.session.add(orm_device)
                 orm_devices.append(orm_device)
+            bump_generation(db.session)
             db.session.commit()
         except IntegrityError as error:
             handle_consistency_exception(error)
@@ -493,6 +986,91 @@ class DeviceHandler(object):
             }
         return result
 
+    @classmethod
+    def create_devices_bulk(cls, params, count, c_length, tenant):
+        """
+        Creates count identical devices (but for their ids and indexed labels).
+
+        The payload is parsed and validated, and its templates and overrides
+        resolved, only once. Device ids are allocated in a single round trip
+        and devices, template associations and overrides are inserted using
+        multi-row INSERT statements.
+
+        :return The summary (id and label) of the created devices.
+        """
+        try:
+            device_data, json_payload = parse_payload(params.get('content_type'),
+                                                      params.get('data'), device_schema)
+            validate_repeated_attrs(json_payload)
+        except ValidationError as error:
+            raise HTTPRequestError(400, error.messages)
+
+        orm_templates = [assert_template_exists(template_id, db.session)
+                         for template_id in json_payload.get('templates', [])]
+
+        overrides = []
+        for attr in json_payload.get('attrs', []):
+            orm_template = find_template(orm_templates, attr['template_id'])
+            if orm_template is None:
+                LOGGER.error(f" Unknown template {orm_template} in attr list")
+                raise HTTPRequestError(400, 'Unknown template {} in attr list'.format(orm_template))
+            overrides.extend(collect_overrides(attr, orm_template))
+
+        # Every device shares the same attributes, hence the same event payload
+        attrs = {}
+        for orm_template in orm_templates:
+            attrs[orm_template.id] = attr_list_schema.dump(orm_template.attrs)
+        fill_overridden_flag(attrs)
+        for orm_attr, static_value in overrides:
+            apply_override(attrs, orm_attr, static_value)
+        template_ids = [orm_template.id for orm_template in orm_templates]
+
+        now = datetime.now()
+        device_rows = [
+            {
+                'id': device_id,
+                'label': DeviceHandler.indexed_label(count, c_length, device_data['label'], i),
+                'created': now
+            }
+            for i, device_id in enumerate(DeviceHandler.generate_device_ids(count))
+        ]
+
+        try:
+            for chunk in chunks(device_rows, BULK_INSERT_CHUNK):
+                db.session.execute(Device.__table__.insert().values(chunk))
+                template_rows = [{'device_id': device['id'], 'template_id': template_id}
+                                 for device in chunk for template_id in template_ids]
+                if template_rows:
+                    db.session.execute(DeviceTemplateMap.__table__.insert().values(template_rows))
+                override_rows = [{'id': func.nextval('override_id'), 'did': device['id'],
+                                  'aid': orm_attr.id, 'static_value': static_value}
+                                 for device in chunk for orm_attr, static_value in overrides]
+                if override_rows:
+                    db.session.execute(DeviceOverride.__table__.insert().values(override_rows))
+            bump_generation(db.session)
+            db.session.commit()
+        except IntegrityError as error:
+            handle_consistency_exception(error)
+
+        LOGGER.debug(f" Created {count} devices in database")
+
+        created = now.isoformat()
+        kafka_handler_instance = cls.kafka.getInstance(cls.kafka.kafkaNotifier)
+        for device in device_rows:
+            full_device = {
+                'id': device['id'],
+                'label': device['label'],
+                'created': created,
+                'templates': template_ids,
+                'attrs': attrs
+            }
+            kafka_handler_instance.create(full_device, meta={"service": tenant})
+
+        return {
+            'message': 'devices created',
+            'devices': [{'id': device['id'], 'label': device['label']} for device in device_rows]
+        }
+
     @classmethod
     def delete_device(cls, device_id, token):
         """
@@ -516,36 +1094,66 @@ class DeviceHandler(object):
         kafka_handler_instance.remove(data, meta={"service": tenant})
 
         db.session.delete(orm_device)
+        bump_generation(db.session)
         db.session.commit()
 
         results = {'result': 'ok', 'removed_device': data}
         return results
 
-    @staticmethod
-    def delete_all_devices(token):
+    @classmethod
+    def delete_all_devices(cls, token, selector=None, batch=DELETE_BATCH):
         """
-        Deletes all devices.
+        Deletes all devices - or only those matched by selector.
+
+        Devices are removed by set based deletes of (at most) batch devices,
+        each batch committed on its own, so that neither the transaction nor
+        the memory footprint grows with the number of devices.
 
         :param token: The authorization token (JWT).
-        :raises HTTPRequestError: If this device could not be found in
-        database.
+        :param selector: Optional device selector (see device_selector).
+        Criteria set to None are ignored; with no criteria at all, every
+        device is removed.
+        :param batch: How many devices are removed by each statement.
+        :return A generator yielding the lists of removed device ids, batch
+        by batch. Nothing is removed until it is consumed.
+        :raises HTTPRequestError: If no authorization token was provided (no
+        tenant was informed)
+        :raises HTTPRequestError: If the selector is invalid.
         """
         tenant = init_tenant_context(token, db)
-        json_devices = []
-
-        devices = db.session.query(Device)
-        for device in devices:
-            db.session.delete(device)
-            json_devices.append(serialize_full_device(device, tenant))
-
-        db.session.commit()
 
-        results = {
-            'result': 'ok', 
-            'removed_devices': json_devices
-        }
-
-        return results
+        selector = {key: value for key, value in (selector or {}).items() if value is not None}
+        conditions = device_selector(selector) if selector else []
+        selected = select([Device.id]).order_by(Device.id).limit(batch)
+        if conditions:
+            selected = selected.where(and_(*conditions))
+
+        def remove_batches():
+            while True:
+                device_ids = [row[0] for row in db.session.execute(selected)]
+                if not device_ids:
+                    return
+
+                db.session.execute(DeviceOverride.__table__.delete()
+                                   .where(DeviceOverride.did.in_(device_ids)))
+                db.session.execute(DeviceAttrsPsk.__table__.delete()
+                                   .where(DeviceAttrsPsk.device_id.in_(device_ids)))
+                db.session.execute(DeviceTemplateMap.__table__.delete()
+                                   .where(DeviceTemplateMap.device_id.in_(device_ids)))
+                result = db.session.execute(Device.__table__.delete()
+                                            .where(Device.id.in_(device_ids))
+                                            .returning(Device.id))
+                removed = [row[0] for row in result]
+                bump_generation(db.session)
+                db.session.commit()
+
+                LOGGER.debug(f" Removed {len(removed)} devices")
+                kafka_handler_instance = cls.kafka.getInstance(cls.kafka.kafkaNotifier)
+                kafka_handler_instance.remove_many([{'id': device_id} for device_id in removed],
+                                                   meta={"service": tenant})
+                yield removed
+
+        return remove_batches()
 
     @classmethod
     def update_device(cls, params, device_id, token):
@@ -571,21 +1179,15 @@ class DeviceHandler(object):
             validate_repeated_attrs(json_payload)
 
             tenant = init_tenant_context(token, db)
-            old_orm_device = assert_device_exists(device_id)
-            db.session.delete(old_orm_device)
-            db.session.flush()
-
-            # handled separately by parse_template_list
-            device_data.pop('templates')
-            updated_orm_device = Device(**device_data)
-            parse_template_list(json_payload.get('templates', []), updated_orm_device)
-            auto_create_template(json_payload, updated_orm_device)
-            updated_orm_device.id = device_id
-            updated_orm_device.updated = datetime.now()
-            updated_orm_device.created = old_orm_device.created
+            updated_orm_device = assert_device_exists(device_id)
 
-            db.session.add(updated_orm_device)
+            # Only what differs from the stored device is written
+            updated_orm_device.label = device_data['label']
+            update_template_list(json_payload.get('templates', []), updated_orm_device)
+            update_orm_overrides(json_payload.get('attrs', []), updated_orm_device)
+            updated_orm_device.updated = datetime.now()
 
+            bump_generation(db.session)
             db.session.commit()
         except IntegrityError as error:
             handle_consistency_exception(error)
@@ -603,6 +1205,283 @@ class DeviceHandler(object):
         }
         return result
 
+    @classmethod
+    def patch_device(cls, params, device_id, token):
+        """
+        Partially updates a device, following JSON merge patch semantics:
+        only the fields present in the patch (label, templates and attrs) are
+        validated and written. Listed attribute overrides are set, or removed
+        if their static_value is null; unlisted ones are left untouched - the
+        attrs array is merged by attribute id rather than replaced, unlike
+        RFC 7396 (see patch_orm_overrides).
+
+        :param params: Parameters received from request (content_type, data)
+        as created by Flask
+        :param device_id: The device to be updated.
+        :param token: The authorization token (JWT).
+        :return The updated device.
+        :rtype JSON
+        :raises HTTPRequestError: If no authorization token was provided (no
+        tenant was informed)
+        :raises HTTPRequestError: If this device could not be found in
+        database.
+        :raises HTTPRequestError: If the patch is invalid.
+        """
+        device_data, patch = parse_merge_patch(params.get('content_type'), params.get('data'),
+                                               device_schema)
+        unknown = set(patch) - {'label', 'templates', 'attrs'}
+        if unknown:
+            raise HTTPRequestError(400, 'Fields {} can not be patched'.format(', '.join(sorted(unknown))))
+
+        tenant = init_tenant_context(token, db)
+        orm_device = assert_device_exists(device_id)
+
+        changed = False
+        try:
+            if 'label' in device_data and device_data['label'] != orm_device.label:
+                orm_device.label = device_data['label']
+                changed = True
+
+            if 'templates' in patch:
+                templates = patch['templates'] or []
+                if not isinstance(templates, list):
+                    raise HTTPRequestError(400, 'templates must be a list of template ids')
+                previous = set(orm_template.id for orm_template in orm_device.templates)
+                update_template_list(templates, orm_device)
+                linked = set(orm_template.id for orm_template in orm_device.templates)
+                if linked != previous:
+                    changed = True
+                    # overrides of attributes from templates no longer associated
+                    for orm_override in list(orm_device.overrides):
+                        parent = orm_override.attr.parent or orm_override.attr
+                        if parent.template_id not in linked:
+                            orm_device.overrides.remove(orm_override)
+                            db.session.delete(orm_override)
+
+            if 'attrs' in patch and patch['attrs'] is None:
+                # removing the member removes every override
+                for orm_override in list(orm_device.overrides):
+                    orm_device.overrides.remove(orm_override)
+                    db.session.delete(orm_override)
+                    changed = True
+            elif 'attrs' in patch:
+                changed |= patch_orm_overrides(patch['attrs'], orm_device)
+
+            if changed:
+                orm_device.updated = datetime.now()
+                bump_generation(db.session)
+                db.session.commit()
+        except IntegrityError as error:
+            handle_consistency_exception(error)
+
+        full_device = serialize_full_device(orm_device, tenant)
+        if changed:
+            kafka_handler_instance = cls.kafka.getInstance(cls.kafka.kafkaNotifier)
+            kafka_handler_instance.update(full_device, meta={"service": tenant})
+
+        return {
+            'message': 'device updated' if changed else 'device not modified',
+            'device': full_device
+        }
+
+    @classmethod
+    def set_attr_overrides(cls, params, device_id, token):
+        """
+        Sets device specific values of attributes (and their metadata).
+
+        Overrides are upserted with a single statement (and removed, for null
+        values, with another one); the device itself is not rewritten, only
+        its 'updated' column is.
+
+        :param params: Parameters received from request (content_type, data).
+        The payload maps attribute labels (or ids) either to their new values
+        or to objects with 'static_value' and/or 'metadata' (which maps
+        metadata labels or ids to their new values).
+        :param device_id: The device to be updated.
+        :param token: The authorization token (JWT).
+        :return The updated device.
+        :rtype JSON
+        :raises HTTPRequestError: If no authorization token was provided (no
+        tenant was informed)
+        :raises HTTPRequestError: If this device could not be found in
+        database.
+        :raises HTTPRequestError: If an attribute is unknown or a value invalid.
+        """
+        values = parse_json_object(params.get('content_type'), params.get('data'))
+        if not values:
+            raise HTTPRequestError(400, "Payload must map attributes to their values")
+
+        tenant = init_tenant_context(token, db)
+
+        updated = db.session.execute(Device.__table__.update()
+                                     .where(Device.id == device_id)
+                                     .values(updated=datetime.now()))
+        if updated.rowcount == 0:
+            raise HTTPRequestError(404, "No such device: %s" % device_id)
+
+        candidates = (db.session.query(DeviceAttr.id, DeviceAttr.label)
+                      .join(DeviceTemplateMap, DeviceTemplateMap.template_id == DeviceAttr.template_id)
+                      .filter(DeviceTemplateMap.device_id == device_id)
+                      .all())
+
+        targets = {}
+        metadata_values = {}
+        for key, value in values.items():
+            attr_id = resolve_attr_key(candidates, key)
+            if isinstance(value, dict):
+                if 'static_value' in value:
+                    targets[attr_id] = value['static_value']
+                if value.get('metadata'):
+                    metadata_values[attr_id] = value['metadata']
+            else:
+                targets[attr_id] = value
+
+        if metadata_values:
+            children = (db.session.query(DeviceAttr.parent_id, DeviceAttr.id, DeviceAttr.label)
+                        .filter(DeviceAttr.parent_id.in_(metadata_values.keys()))
+                        .all())
+            for parent_id, metadata in metadata_values.items():
+                if not isinstance(metadata, dict):
+                    raise HTTPRequestError(400, "Metadata must map metadata attributes to their values")
+                siblings = [(attr_id, label) for parent, attr_id, label in children if parent == parent_id]
+                for key, value in metadata.items():
+                    targets[resolve_attr_key(siblings, key)] = value
+
+        targets = {attr_id: override_value(value) for attr_id, value in targets.items()}
+        removed = [attr_id for attr_id, value in targets.items() if value is None]
+        rows = [{'id': func.nextval('override_id'), 'did': device_id, 'aid': attr_id, 'static_value': value}
+                for attr_id, value in targets.items() if value is not None]
+
+        try:
+            if removed:
+                db.session.execute(DeviceOverride.__table__.delete().where(
+                    and_(DeviceOverride.did == device_id, DeviceOverride.aid.in_(removed))))
+            if rows:
+                upsert = pg_insert(DeviceOverride.__table__).values(rows)
+                upsert = upsert.on_conflict_do_update(
+                    constraint='overrides_did_aid_key',
+                    set_={'static_value': upsert.excluded.static_value})
+                db.session.execute(upsert)
+            bump_generation(db.session)
+            db.session.commit()
+        except IntegrityError as error:
+            handle_consistency_exception(error)
+
+        # both the response and the update event carry the full device (the
+        # attributes of every associated template, with the overrides applied),
+        # none of which was loaded by the statements above: it is read once,
+        # after the commit, so that it reflects concurrent overrides as well
+        orm_device = assert_device_exists(device_id, options=[joinedload(Device.overrides),
+                                                              noload(Device.pre_shared_keys)])
+        full_device = serialize_full_device(orm_device, tenant)
+        kafka_handler_instance = cls.kafka.getInstance(cls.kafka.kafkaNotifier)
+        kafka_handler_instance.update(full_device, meta={"service": tenant})
+
+        return {
+            'message': 'device attributes updated',
+            'device': full_device
+        }
+
+    @classmethod
+    def set_bulk_attr_overrides(cls, params, token):
+        """
+        Sets attribute values on every device matched by a selector.
+
+        All overrides are upserted by a single INSERT ... SELECT ... ON
+        CONFLICT statement (and removed, for null values, by a single DELETE),
+        and update events are published in batches.
+
+        :param params: Parameters received from request (content_type, data).
+        The payload carries a 'selector' (see device_selector) and 'attrs',
+        mapping attribute labels (or ids) to their new values. Keys are
+        resolved against the static attributes of the templates associated
+        with the selected devices only.
+        :param token: The authorization token (JWT).
+        :return The ids of the updated devices.
+        :rtype JSON
+        :raises HTTPRequestError: If no authorization token was provided (no
+        tenant was informed)
+        :raises HTTPRequestError: If the selector or attributes are invalid,
+        or an attribute is not a static attribute of those templates.
+        """
+        payload = parse_json_object(params.get('content_type'), params.get('data'))
+
+        conditions = device_selector(payload.get('selector'))
+        values = payload.get('attrs')
+        if not isinstance(values, dict) or not values:
+            raise HTTPRequestError(400, "attrs must map attributes to their values")
+        values = {key: override_value(value) for key, value in values.items()}
+
+        tenant = init_tenant_context(token, db)
+
+        selected = select([Device.id]).where(and_(*conditions))
+        # only the static attributes of the templates of the selected devices
+        # can be given device specific values
+        overridable = and_(DeviceAttr.type == 'static',
+                           DeviceAttr.template_id.in_(select([DeviceTemplateMap.template_id])
+                                                      .where(DeviceTemplateMap.device_id.in_(selected))))
+
+        keys = list(values.keys())
+        known = db.session.query(DeviceAttr.id, DeviceAttr.label).filter(
+            overridable,
+            or_(DeviceAttr.label.in_(keys), cast(DeviceAttr.id, String).in_(keys))).all()
+        targets = {}
+        for key in keys:
+            attr_ids = set(attr_id for attr_id, label in known if key in (label, str(attr_id)))
+            if not attr_ids:
+                raise HTTPRequestError(400, 'Unknown attribute {} in override list: not a static '
+                                            'attribute of the selected devices'.format(key))
+            for attr_id in attr_ids:
+                if attr_id in targets:
+                    raise HTTPRequestError(400, 'Attributes {} and {} refer to the same attribute'.format(
+                        targets[attr_id], key))
+                targets[attr_id] = key
+
+        affected = set()
+        try:
+            attr_ids = [attr_id for attr_id, key in targets.items() if values[key] is None]
+            if attr_ids:
+                result = db.session.execute(DeviceOverride.__table__.delete()
+                                            .where(and_(DeviceOverride.did.in_(selected),
+                                                        DeviceOverride.aid.in_(attr_ids)))
+                                            .returning(DeviceOverride.did))
+                affected.update(row[0] for row in result)
+
+            # the attributes resolved above, along with their values
+            pairs = [select([literal(attr_id, Integer).label('aid'),
+                             literal(values[key], String).label('value')])
+                     for attr_id, key in targets.items() if values[key] is not None]
+            if pairs:
+                pairs = union_all(*pairs).alias('pairs') if len(pairs) > 1 else pairs[0].alias('pairs')
+                source = (select([func.nextval('override_id'), DeviceTemplateMap.device_id,
+                                  DeviceAttr.id, pairs.c.value])
+                          .select_from(DeviceTemplateMap.__table__
+                                       .join(DeviceAttr.__table__,
+                                             DeviceAttr.template_id == DeviceTemplateMap.template_id)
+                                       .join(pairs, DeviceAttr.id == pairs.c.aid))
+                          .where(DeviceTemplateMap.device_id.in_(selected)))
+                upsert = pg_insert(DeviceOverride.__table__).from_select(
+                    ['id', 'did', 'aid', 'static_value'], source)
+                upsert = upsert.on_conflict_do_update(
+                    constraint='overrides_did_aid_key',
+                    set_={'static_value': upsert.excluded.static_value}).returning(DeviceOverride.did)
+                affected.update(row[0] for row in db.session.execute(upsert))
+
+            touch_devices(affected)
+            bump_generation(db.session)
+            db.session.commit()
+        except IntegrityError as error:
+            handle_consistency_exception(error)
+
+        LOGGER.debug(f" Updated attributes of {len(affected)} devices")
+
+        cls.notify_updates(affected, tenant)
+
+        return {
+            'message': 'devices updated',
+            'devices': sorted(affected)
+        }
+
     @classmethod
     def configure_device(cls, params, device_id, token):
         """
@@ -680,6 +1559,7 @@ class DeviceHandler(object):
         orm_device.templates.append(orm_template)
 
         try:
+            bump_generation(db.session)
             db.session.commit()
         except IntegrityError as error:
             handle_consistency_exception(error)
@@ -715,6 +1595,7 @@ class DeviceHandler(object):
         # removal cannot violate attribute constraints
 
         db.session.delete(relation)
+        bump_generation(db.session)
         db.session.commit()
         result = {
             'message': 'device updated',
@@ -723,15 +1604,181 @@ class DeviceHandler(object):
 
         return result
 
+    @classmethod
+    def notify_updates(cls, device_ids, tenant):
+        """ Publishes update events for the given devices, in batches """
+        kafka_handler_instance = cls.kafka.getInstance(cls.kafka.kafkaNotifier)
+        for orm_devices in iter_devices(sorted(device_ids)):
+            kafka_handler_instance.update_many(
+                [serialize_full_device(orm_device, tenant) for orm_device in orm_devices],
+                meta={"service": tenant})
+
+    @classmethod
+    def attach_template(cls, params, template_id, token):
+        """
+        Associates a template with every device matched by a selector.
+
+        Conflicts are checked for all devices by a single query; devices with
+        attributes clashing with the template ones are left untouched and
+        reported, the others are associated by a single INSERT ... SELECT.
+
+        :param params: Parameters received from request (content_type, data).
+        The payload carries a 'selector' (see device_selector).
+        :param template_id: The template to be added to the devices.
+        :param token: The authorization token (JWT).
+        :return The ids of the updated devices, and the attributes in conflict
+        for each device that could not be updated.
+        :rtype JSON
+        :raises HTTPRequestError: If no authorization token was provided (no
+        tenant was informed)
+        :raises HTTPRequestError: If this template could not be found in
+        database.
+        :raises HTTPRequestError: If the selector is invalid.
+        """
+        payload = parse_json_object(params.get('content_type'), params.get('data'))
+        conditions = device_selector(payload.get('selector'))
+        template_id = parse_template_id(template_id)
+
+        tenant = init_tenant_context(token, db)
+        assert_template_exists(template_id)
+
+        selected = select([Device.id]).where(and_(*conditions))
+        try:
+            attached, conflicts = link_template(template_id, selected)
+            touch_devices(attached)
+            bump_generation(db.session)
+            db.session.commit()
+        except IntegrityError as error:
+            handle_consistency_exception(error)
+
+        LOGGER.debug(f" Template {template_id} added to {len(attached)} devices")
+        cls.notify_updates(attached, tenant)
+
+        return {
+            'message': 'devices updated',
+            'devices': sorted(attached),
+            'conflicts': conflicts
+        }
+
+    @classmethod
+    def detach_template(cls, params, template_id, token):
+        """
+        Disassociates a template from every device matched by a selector,
+        using a single DELETE (plus one for the overrides and one for the pre
+        shared keys the devices had on the template attributes).
+
+        :param params: Parameters received from request (content_type, data).
+        The payload carries a 'selector' (see device_selector).
+        :param template_id: The template to be removed from the devices.
+        :param token: The authorization token (JWT).
+        :return The ids of the updated devices.
+        :rtype JSON
+        :raises HTTPRequestError: If no authorization token was provided (no
+        tenant was informed)
+        :raises HTTPRequestError: If this template could not be found in
+        database.
+        :raises HTTPRequestError: If the selector is invalid.
+        """
+        payload = parse_json_object(params.get('content_type'), params.get('data'))
+        conditions = device_selector(payload.get('selector'))
+        template_id = parse_template_id(template_id)
+
+        tenant = init_tenant_context(token, db)
+        assert_template_exists(template_id)
+
+        selected = select([Device.id]).where(and_(*conditions))
+        try:
+            detached = unlink_template(template_id, selected)
+            touch_devices(detached)
+            bump_generation(db.session)
+            db.session.commit()
+        except IntegrityError as error:
+            handle_consistency_exception(error)
+
+        LOGGER.debug(f" Template {template_id} removed from {len(detached)} devices")
+        cls.notify_updates(detached, tenant)
+
+        return {
+            'message': 'devices updated',
+            'devices': sorted(detached)
+        }
+
+    @classmethod
+    def move_template(cls, params, template_id, target_id, token):
+        """
+        Moves devices from a template to another one: the devices associated
+        with template_id (and matched by the optional selector) are associated
+        with target_id instead.
+
+        Conflicts with the target template are checked for all devices by a
+        single query, disregarding the template being replaced; devices in
+        conflict keep their current association and are reported.
+
+        :param params: Parameters received from request (content_type, data).
+        The optional payload carries a 'selector' (see device_selector).
+        :param template_id: The template the devices are moved from.
+        :param target_id: The template the devices are moved to.
+        :param token: The authorization token (JWT).
+        :return The ids of the moved devices, and the attributes in conflict
+        for each device that could not be moved.
+        :rtype JSON
+        :raises HTTPRequestError: If no authorization token was provided (no
+        tenant was informed)
+        :raises HTTPRequestError: If the target template could not be found in
+        database.
+        :raises HTTPRequestError: If the selector is invalid.
+        """
+        conditions = []
+        if params.get('data'):
+            payload = parse_json_object(params.get('content_type'), params.get('data'))
+            if payload.get('selector') is not None:
+                conditions = device_selector(payload['selector'])
+        template_id = parse_template_id(template_id)
+        target_id = parse_template_id(target_id)
+        if template_id == target_id:
+            raise HTTPRequestError(400, "Devices must be moved to a different template")
+
+        tenant = init_tenant_context(token, db)
+        assert_template_exists(target_id)
+
+        conditions.append(Device.id.in_(select([DeviceTemplateMap.device_id])
+                                        .where(DeviceTemplateMap.template_id == template_id)))
+        selected = select([Device.id]).where(and_(*conditions))
+        try:
+            conflicting = template_conflicts(target_id, selected, ignored=template_id)
+            conflicts = collect_conflicts(db.session.execute(conflicting))
+            movable = select([Device.id]).where(and_(
+                Device.id.in_(selected),
+                Device.id.notin_(select([conflicting.alias('conflicting').c.device_id]))))
+
+            moved = unlink_template(template_id, movable)
+            if moved:
+                link_template(target_id, select([Device.id]).where(Device.id.in_(moved)))
+            touch_devices(moved)
+            bump_generation(db.session)
+            db.session.commit()
+        except IntegrityError as error:
+            handle_consistency_exception(error)
+
+        LOGGER.debug(f" Moved {len(moved)} devices from template {template_id} to {target_id}")
+        cls.notify_updates(moved, tenant)
+
+        return {
+            'message': 'devices updated',
+            'devices': sorted(moved),
+            'conflicts': conflicts
+        }
+
     @staticmethod
+    @coalesced('template_devices', tenant_generation)
     def get_by_template(token, params, template_id):
         """
         Return a list of devices that have a particular template associated to
         it
 
         :param token: The authorization token (JWT).
-        :param params: Parameters received from request (page_number, per_page)
-        as created by Flask
+        :param params: Parameters received from request (page_number, per_page,
+        fields) as created by Flask
         :param template_id: The template to be considered
         :raises HTTPRequestError: If no authorization token was provided (no
         tenant was informed)
@@ -741,8 +1788,18 @@ class DeviceHandler(object):
         :rtype JSON
         """
         tenant = init_tenant_context(token, db)
+
+        cache_key = ('template_devices', template_id, LISTING_CACHE.normalize(params))
+        generation = current_generation(db.session)
+        result = LISTING_CACHE.get(tenant, generation, cache_key)
+        if result is not None:
+            LOGGER.debug(f" Device listing retrieved from cache")
+            return result
+
+        fields = parse_fields(params.get('fields'), DEVICE_FIELDS)
         page = (
             db.session.query(Device)
+            .options(*device_load_options(fields))
             .join(DeviceTemplateMap)
             .filter_by(template_id=template_id)
             .paginate(page=params.get('page_number'), 
@@ -750,7 +1807,7 @@ class DeviceHandler(object):
         )
         devices = []
         for d in page.items:
-            devices.append(serialize_full_device(d, tenant))
+            devices.append(serialize_full_device(d, tenant, fields=fields))
 
         result = {
             'pagination': {
@@ -761,6 +1818,7 @@ class DeviceHandler(object):
             },
             'devices': devices
         }
+        LISTING_CACHE.put(tenant, generation, cache_key, result)
         return result
 
     @classmethod
@@ -847,6 +1905,7 @@ class DeviceHandler(object):
             result.append( {'attribute': attr["label"], 'psk': psk_hex} )
 
         device_orm.updated = datetime.now()
+        bump_generation(db.session)
         db.session.commit()
 
         # send an update message on kafka
@@ -933,6 +1992,7 @@ class DeviceHandler(object):
             dest_psk_entry.psk = src_psk_entry.psk
 
         dest_device_orm.updated = datetime.now()
+        bump_generation(db.session)
         db.session.commit()
 
         dest_attr_ref['static_value'] = src_attr_ref['static_value']
@@ -942,6 +2002,20 @@ class DeviceHandler(object):
         kafka_handler_instance.update(dest_device, meta={"service": tenant})
 
 
+@register_job('device.create')
+def run_create_device(params, token, progress):
+    return DeviceHandler.create_device(params, token)
+
+
+@register_job('device.delete_all')
+def run_delete_all_devices(params, token, progress):
+    removed_devices = []
+    for device_ids in DeviceHandler.delete_all_devices(token, params.get('selector')):
+        removed_devices.extend(device_ids)
+        progress(len(removed_devices))
+    return {'result': 'ok', 'removed_devices': removed_devices}
+
+
 @device.route('/device', methods=['GET'])
 def flask_get_devices():
     """
@@ -967,6 +2041,7 @@ def flask_get_devices():
             'label': request.args.get('label', None),
             'template': request.args.get('template', None),
             'idsOnly': request.args.get('idsOnly', 'false'),
+            'fields': request.args.get('fields', None),
         }
 
         result = DeviceHandler.get_devices(token, params)
@@ -1000,6 +2075,11 @@ def flask_create_device():
             'data': request.data
         }
 
+        if is_async(request):
+            result = JobHandler.submit('device.create', params, token)
+            LOGGER.info(f" Device creation submitted as job {result['job']['id']}.")
+            return make_response(jsonify(result), 202)
+
         result = DeviceHandler.create_device(params, token)
         devices = result.get('devices')
         deviceId = devices[0].get('id')
@@ -1015,7 +2095,8 @@ def flask_create_device():
 @device.route('/device', methods=['DELETE'])
 def flask_delete_all_device():
     """
-    Creates and configures the given device (in json).
+    Removes all devices - or only those matching the given template and/or
+    label - streaming the ids of the removed devices as they are deleted.
 
     Check API description for more information about request parameters and
     headers.
@@ -1024,9 +2105,60 @@ def flask_delete_all_device():
         # retrieve the authorization token
         token = retrieve_auth_token(request)
 
-        result = DeviceHandler.delete_all_devices(token)
+        selector = {
+            'template': request.args.get('template', None),
+            'label': request.args.get('label', None)
+        }
+        if is_async(request):
+            result = JobHandler.submit('device.delete_all', {'selector': selector}, token)
+            LOGGER.info(f" Removal of all devices submitted as job {result['job']['id']}.")
+            return make_response(jsonify(result), 202)
+
+        removed = DeviceHandler.delete_all_devices(token, selector)
 
         LOGGER.info('Deleting all devices.')
+        # the first batch is removed before the response is started, so that
+        # failing to remove anything is still reported by the status code
+        first = next(removed, [])
+
+        def generate():
+            # the status code is already sent by the time later batches are
+            # removed: their failures are reported by the trailing result
+            yield '{"removed_devices": ['
+            separator = ''
+            try:
+                for device_ids in itertools.chain([first], removed):
+                    for device_id in device_ids:
+                        yield separator + json.dumps(device_id)
+                        separator = ', '
+            except Exception as error:
+                message = error.message if isinstance(error, HTTPRequestError) else 'Failed to remove devices'
+                LOGGER.error(f' Removal of all devices interrupted: {error}')
+                db.session.rollback()
+                yield '], "result": "error", "message": ' + json.dumps(message) + '}'
+                return
+            yield '], "result": "ok"}'
+
+        return Response(stream_with_context(generate()), status=200,
+                        mimetype='application/json')
+    except HTTPRequestError as e:
+        LOGGER.error(f' {e.message} - {e.error_code}.')
+
+        return format_response(e.error_code, e.message)
+
+@device.route('/device/id_space', methods=['GET'])
+def flask_get_id_space():
+    """
+    Reports how full the device id space of the tenant is.
+
+    Check API description for more information about request parameters and
+    headers.
+    """
+    try:
+        # retrieve the authorization token
+        token = retrieve_auth_token(request)
+
+        result = DeviceHandler.get_id_space(token)
         return make_response(jsonify(result), 200)
     except HTTPRequestError as e:
         LOGGER.error(f' {e.message} - {e.error_code}.')
@@ -1039,7 +2171,8 @@ def flask_get_device(device_id):
          # retrieve the authorization token
         token = retrieve_auth_token(request)
 
-        result = DeviceHandler.get_device(token, device_id)
+        result = DeviceHandler.get_device(token, device_id,
+                                          fields=request.args.get('fields', None))
         LOGGER.info(f' Getting the device with id {device_id}.')
         return make_response(jsonify(result), 200)
     except HTTPRequestError as e:
@@ -1088,6 +2221,72 @@ def flask_update_device(device_id):
         return format_response(e.error_code, e.message)
 
 
+@device.route('/device/<device_id>', methods=['PATCH'])
+def flask_patch_device(device_id):
+    try:
+        # retrieve the authorization token
+        token = retrieve_auth_token(request)
+
+        params = {
+            'content_type': request.headers.get('Content-Type'),
+            'data': request.data
+        }
+
+        LOGGER.info(f' Patching the device with id {device_id}.')
+        results = DeviceHandler.patch_device(params, device_id, token)
+        return make_response(jsonify(results), 200)
+    except HTTPRequestError as e:
+        LOGGER.error(f' {e.message} - {e.error_code}.')
+        if isinstance(e.message, dict):
+            return make_response(jsonify(e.message), e.error_code)
+
+        return format_response(e.error_code, e.message)
+
+
+@device.route('/device/attrs', methods=['PUT'])
+def flask_set_bulk_attr_overrides():
+    try:
+        # retrieve the authorization token
+        token = retrieve_auth_token(request)
+
+        params = {
+            'content_type': request.headers.get('Content-Type'),
+            'data': request.data
+        }
+
+        results = DeviceHandler.set_bulk_attr_overrides(params, token)
+        LOGGER.info(f" Updated attributes of {len(results['devices'])} devices.")
+        return make_response(jsonify(results), 200)
+    except HTTPRequestError as e:
+        LOGGER.error(f' {e.message} - {e.error_code}.')
+        if isinstance(e.message, dict):
+            return make_response(jsonify(e.message), e.error_code)
+
+        return format_response(e.error_code, e.message)
+
+
+@device.route('/device/<device_id>/attrs', methods=['PUT'])
+def flask_set_attr_overrides(device_id):
+    try:
+        # retrieve the authorization token
+        token = retrieve_auth_token(request)
+
+        params = {
+            'content_type': request.headers.get('Content-Type'),
+            'data': request.data
+        }
+
+        LOGGER.info(f' Updating attributes of the device with id {device_id}.')
+        results = DeviceHandler.set_attr_overrides(params, device_id, token)
+        return make_response(jsonify(results), 200)
+    except HTTPRequestError as e:
+        LOGGER.error(f' {e.message} - {e.error_code}.')
+        if isinstance(e.message, dict):
+            return make_response(jsonify(e.message), e.error_code)
+
+        return format_response(e.error_code, e.message)
+
+
 @device.route('/device/<device_id>/actuate', methods=['PUT'])
 def flask_configure_device(device_id):
     """
@@ -1160,6 +2359,7 @@ def flask_get_by_template(template_id):
         params = {
             'page_number': page_number,
             'per_page': per_page,
+            'fields': request.args.get('fields', None),
         }
 
         LOGGER.info(f' Getting devices with template id {template_id}.')
@@ -1173,6 +2373,72 @@ def flask_get_by_template(template_id):
         return format_response(e.error_code, e.message)
 
 
+@device.route('/device/template/<template_id>', methods=['POST'])
+def flask_attach_template(template_id):
+    try:
+        # retrieve the authorization token
+        token = retrieve_auth_token(request)
+
+        params = {
+            'content_type': request.headers.get('Content-Type'),
+            'data': request.data
+        }
+
+        LOGGER.info(f' Adding template with id {template_id} to many devices.')
+        result = DeviceHandler.attach_template(params, template_id, token)
+        return make_response(jsonify(result), 200)
+    except HTTPRequestError as e:
+        LOGGER.error(f' {e.message} - {e.error_code}.')
+        if isinstance(e.message, dict):
+            return make_response(jsonify(e.message), e.error_code)
+
+        return format_response(e.error_code, e.message)
+
+
+@device.route('/device/template/<template_id>', methods=['DELETE'])
+def flask_detach_template(template_id):
+    try:
+        # retrieve the authorization token
+        token = retrieve_auth_token(request)
+
+        params = {
+            'content_type': request.headers.get('Content-Type'),
+            'data': request.data
+        }
+
+        LOGGER.info(f' Removing template with id {template_id} from many devices.')
+        result = DeviceHandler.detach_template(params, template_id, token)
+        return make_response(jsonify(result), 200)
+    except HTTPRequestError as e:
+        LOGGER.error(f' {e.message} - {e.error_code}.')
+        if isinstance(e.message, dict):
+            return make_response(jsonify(e.message), e.error_code)
+
+        return format_response(e.error_code, e.message)
+
+
+@device.route('/device/template/<template_id>/move/<target_id>', methods=['POST'])
+def flask_move_template(template_id, target_id):
+    try:
+        # retrieve the authorization token
+        token = retrieve_auth_token(request)
+
+        params = {
+            'content_type': request.headers.get('Content-Type'),
+            'data': request.data
+        }
+
+        LOGGER.info(f' Moving devices from template {template_id} to template {target_id}.')
+        result = DeviceHandler.move_template(params, template_id, target_id, token)
+        return make_response(jsonify(result), 200)
+    except HTTPRequestError as e:
+        LOGGER.error(f' {e.message} - {e.error_code}.')
+        if isinstance(e.message, dict):
+            return make_response(jsonify(e.message), e.error_code)
+
+        return format_response(e.error_code, e.message)
+
+
 @device.route('/device/gen_psk/<device_id>', methods=['POST'])
 def flask_gen_psk(device_id):
     try:
@@ -1259,6 +2525,7 @@ def flask_internal_get_devices():
             'label': request.args.get('label', None),
             'template': request.args.get('template', None),
             'idsOnly': request.args.get('idsOnly', 'false'),
+            'fields': request.args.get('fields', None),
         }
 
         result = DeviceHandler.get_devices(token, params, True)
@@ -1279,7 +2546,8 @@ def flask_internal_get_device(device_id):
         # retrieve the authorization token
         token = retrieve_auth_token(request)
 
-        result = DeviceHandler.get_device(token, device_id, True)
+        result = DeviceHandler.get_device(token, device_id, True,
+                                          fields=request.args.get('fields', None))
         LOGGER.info(f'Get known device with id: {device_id}.')
         return make_response(jsonify(result), 200)
     except HTTPRequestError as e:
@@ -1,7 +1,8 @@
 """ Error pages definitions """
 
 import json
-from flask import make_response, jsonify
+from flask import make_response
+from DeviceManager.JsonEncoder import jsonify
 from DeviceManager.app import app
 
 
@@ -0,0 +1,95 @@
+"""
+    Allocates device ids without probing the database for free ones.
+
+    Every tenant owns a sequence (device_id) ranging over the whole 24 bit id
+    space. Each value drawn from it is mapped through a fixed permutation of
+    that space, so that consecutive devices do not get consecutive ids, and
+    formatted as the usual 5-6 digit hexadecimal device id. As the permutation
+    is a bijection, ids drawn from the sequence never collide with each other;
+    the only possible collisions are with ids that were not allocated here
+    (legacy random ids or ids chosen by clients), which are checked for in a
+    single query per allocation and skipped.
+"""
+from sqlalchemy.exc import DataError
+from sqlalchemy.sql import text
+
+from DeviceManager.DatabaseHandler import db
+from DeviceManager.DatabaseModels import Device
+from DeviceManager.utils import HTTPRequestError
+from DeviceManager.Logger import Log
+
+LOGGER = Log().color_log()
+
+ID_BITS = 24
+ID_SPACE = 1 << ID_BITS
+ID_MASK = ID_SPACE - 1
+
+
+def permute(value):
+    """
+    Bijective scrambling of the 24 bit id space: each step (multiplication
+    by an odd constant, addition, xor with a right shift) is invertible
+    modulo 2^24.
+    """
+    value = (value * 0x9e3779 + 0x7f4a7c) & ID_MASK
+    value ^= value >> 12
+    value = (value * 0x2c1b3d + 0x165667) & ID_MASK
+    value ^= value >> 11
+    return value
+
+
+def format_id(value):
+    """ Maps a sequence value to its device id """
+    return '%05x' % permute(value)
+
+
+def allocate_device_ids(session, count):
+    """
+    Allocates new device ids for the current tenant.
+
+    :param session: The database session of the current tenant
+    :param count: How many ids should be allocated
+    :return The new ids
+    :rtype list
+    :raises HTTPRequestError: If the id space of the tenant is exhausted
+    """
+    ids = []
+    while len(ids) < count:
+        needed = count - len(ids)
+        try:
+            values = session.execute(
+                text("SELECT nextval('device_id') FROM generate_series(1, :count)"),
+                {'count': needed}).fetchall()
+        except DataError as error:
+            LOGGER.error(f" Device id space exhausted: {error}")
+            raise HTTPRequestError(500, "Device id space exhausted")
+
+        candidates = [format_id(row[0]) for row in values]
+        taken = set(row[0] for row in
+                    session.query(Device.id).filter(Device.id.in_(candidates)).all())
+        if taken:
+            LOGGER.debug(f" Skipping {len(taken)} ids already in use")
+        ids.extend(candidate for candidate in candidates if candidate not in taken)
+
+    return ids
+
+
+def id_space_usage(session):
+    """
+    Reports how full the device id space of the current tenant is.
+
+    :param session: The database session of the current tenant
+    :return A dict with the id space capacity, how many ids were drawn from
+    the sequence so far, how many devices exist and the fraction of the id
+    space they use.
+    """
+    drawn = session.execute(text(
+        "SELECT CASE WHEN is_called THEN last_value + 1 ELSE 0 END FROM device_id")).scalar()
+    devices = session.query(Device.id).count()
+    return {
+        'capacity': ID_SPACE,
+        'allocated': drawn,
+        'available': ID_SPACE - drawn,
+        'devices': devices,
+        'usage': devices / ID_SPACE
+    }
@@ -2,7 +2,8 @@ import logging
 import re
 import copy
 import json
-from flask import Blueprint, request, jsonify, make_response
+from flask import Blueprint, request, make_response
+from DeviceManager.JsonEncoder import jsonify
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.sql import func
 
@@ -18,7 +19,9 @@ from DeviceManager.SerializationModels import import_schema
 from DeviceManager.SerializationModels import parse_payload, load_attrs
 from DeviceManager.SerializationModels import ValidationError
 from DeviceManager.TenancyManager import init_tenant_context
+from DeviceManager.QueryCache import bump_generation
 from DeviceManager.DeviceHandler import auto_create_template, serialize_full_device
+from DeviceManager.JobHandler import JobHandler, register_job, is_async
 
 importing = Blueprint('import', __name__)
 
@@ -183,6 +186,7 @@ class ImportHandler:
 
             ImportHandler().notifies_creation_to_kafka(saved_devices, tenant)
 
+            bump_generation(db.session)
             db.session.commit()
 
         except IntegrityError as e:
@@ -203,6 +207,11 @@ class ImportHandler:
         return results
 
 
+@register_job('import')
+def run_import_data(params, token, progress):
+    return ImportHandler.import_data(params['data'], token, params['content_type'])
+
+
 @importing.route('/import', methods=['POST'])
 def flask_import_data():
     try:
@@ -215,6 +224,11 @@ def flask_import_data():
         content_type = request.headers.get('Content-Type')
         data = request.data
 
+        if is_async(request):
+            result = JobHandler.submit('import', {'data': data, 'content_type': content_type}, token)
+            LOGGER.info(f" Import submitted as job {result['job']['id']}")
+            return make_response(jsonify(result), 202)
+
         result = ImportHandler.import_data(data, token, content_type)
 
         LOGGER.info(f" Imported data!")
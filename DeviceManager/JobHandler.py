@@ -0,0 +1,401 @@
+"""
+    Runs long operations outside of the requests that asked for them.
+
+    Requests carrying ?async=true do not perform the operation themselves:
+    they store a job in the tenant schema and are answered right away with
+    it. Jobs are run by a separate process (python -m DeviceManager.JobWorker,
+    or the entrypoint 'jobs' command), never by the web workers. Its threads
+    claim pending jobs with SELECT ... FOR UPDATE SKIP LOCKED - so that each
+    job is claimed exactly once, without workers waiting on each other - and
+    perform the very same operation the request would have. The job outcome
+    can be followed through GET /job/<id>.
+
+    A claimed job is leased for JOB_LEASE seconds, a lease renewed while the
+    job runs. Jobs whose lease expired (their worker died) are claimed again,
+    up to JOB_MAX_ATTEMPTS times, after which they are failed.
+
+    Jobs do not keep the authorization token of the request: only the claims
+    the operation needs (the tenant) are stored.
+"""
+import json
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+from flask import Blueprint, g, request, make_response
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql import text
+
+from DeviceManager.app import app
+from DeviceManager.conf import CONFIG
+from DeviceManager.DatabaseHandler import db
+from DeviceManager.DatabaseModels import Job
+from DeviceManager.JsonEncoder import jsonify, dumps
+from DeviceManager.SerializationModels import ValidationError
+from DeviceManager.TenancyManager import init_tenant_context, switch_tenant
+from DeviceManager.utils import format_response, HTTPRequestError, retrieve_auth_token
+from DeviceManager.utils import get_allowed_service, claims_token
+from DeviceManager.Logger import Log
+
+job = Blueprint('job', __name__)
+
+LOGGER = Log().color_log()
+
+# Functions performing each kind of job - see register_job
+JOB_RUNNERS = {}
+
+# Tenants whose schema is able to hold jobs
+JOB_TENANTS = text("SELECT table_schema FROM information_schema.tables WHERE table_name = 'jobs'")
+
+# Whether a tenant has jobs to be claimed, or expired - see claimable_tenants
+CLAIMABLE_PROBE = """
+    SELECT :tenant_{index} AS tenant WHERE EXISTS (
+        SELECT 1 FROM {schema}.jobs
+        WHERE status = 'pending' OR (status = 'running' AND locked_until < :now)
+    )
+"""
+
+# Fails the jobs whose lease expired too many times
+EXPIRE_JOBS = text("""
+    UPDATE jobs SET status = 'failed', finished = :now, locked_until = NULL,
+                    error = '"Job lease expired too many times"'
+    WHERE status = 'running' AND locked_until < :now AND attempts >= :max_attempts
+""")
+
+# Claims the oldest pending (or expired) job, skipping those being claimed by other workers
+CLAIM_JOB = text("""
+    UPDATE jobs SET status = 'running', started = :now, locked_until = :locked_until,
+                    attempts = attempts + 1
+    WHERE id = (
+        SELECT id FROM jobs
+        WHERE status = 'pending' OR (status = 'running' AND locked_until < :now)
+        ORDER BY created
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, kind, params, attempts
+""")
+
+
+def register_job(kind):
+    """
+    Registers the function performing a kind of job.
+
+    The function is called as runner(params, token, progress), where params
+    are the ones given to JobHandler.submit, token carries the claims of the
+    request that submitted the job and progress(count) records how far the
+    job has gone. Whatever it returns (as long as it is JSON serializable)
+    becomes the job result.
+    """
+    def decorator(runner):
+        JOB_RUNNERS[kind] = runner
+        return runner
+    return decorator
+
+
+def is_async(req):
+    """ Whether the request asks for its operation to be run as a job """
+    return req.args.get('async', 'false').lower() in ['true', '1']
+
+
+def encode(value):
+    return None if value is None else dumps(value).decode('utf-8')
+
+
+def decode(value):
+    return None if value is None else json.loads(value)
+
+
+def quote_schema(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def create_job(kind, params, token):
+    """
+    Builds a pending job, to be added to the session - along with whatever
+    else must be committed with it.
+
+    :param kind: The kind of job, as registered by register_job
+    :param params: The parameters given to the job runner. Byte strings
+    (request bodies) are stored as text.
+    :param token: The authorization token (JWT). Only its claims are stored,
+    not the token itself.
+    :rtype Job
+    """
+    claims = {'service': get_allowed_service(token)}
+    params = {key: value.decode('utf-8') if isinstance(value, bytes) else value
+              for key, value in params.items()}
+    return Job(id=str(uuid.uuid4()), kind=kind, status='pending', progress=0, attempts=0,
+               params=encode({'params': params, 'claims': claims}), created=datetime.now())
+
+
+def serialize_job(orm_job):
+    return {
+        'id': orm_job.id,
+        'kind': orm_job.kind,
+        'status': orm_job.status,
+        'progress': orm_job.progress,
+        'result': decode(orm_job.result),
+        'error': decode(orm_job.error),
+        'created': orm_job.created,
+        'started': orm_job.started,
+        'finished': orm_job.finished
+    }
+
+
+class JobLease(object):
+    """ Renews the lease of a claimed job while it runs, so that it is not claimed again """
+
+    def __init__(self, tenant, job_id, attempt, lease):
+        self.tenant = tenant
+        self.job_id = job_id
+        self.attempt = attempt
+        self.lease = lease
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='job-lease', daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.lease / 3):
+            try:
+                self.renew()
+            except Exception as error:
+                LOGGER.error(f" Failed to renew the lease of job {self.job_id}: {error}")
+
+    def renew(self):
+        jobs = Job.__table__
+        with app.app_context():
+            g.tenant = self.tenant
+            switch_tenant(self.tenant, db)
+            db.session.execute(jobs.update()
+                               .where(jobs.c.id == self.job_id)
+                               .where(jobs.c.attempts == self.attempt)
+                               .values(locked_until=datetime.now() + timedelta(seconds=self.lease)))
+            db.session.commit()
+
+
+class JobWorkers(object):
+
+    def __init__(self, workers=None, poll_interval=None, lease=None, max_attempts=None):
+        self.workers = CONFIG.job_workers if workers is None else workers
+        self.poll_interval = CONFIG.job_poll_interval if poll_interval is None else poll_interval
+        self.lease = CONFIG.job_lease if lease is None else lease
+        self.max_attempts = CONFIG.job_max_attempts if max_attempts is None else max_attempts
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.running = 0
+        self.done = 0
+        self.failed = 0
+
+    def run_forever(self):
+        """ Runs the worker threads, until stop is called """
+        LOGGER.info(f" Starting {self.workers} job workers")
+        threads = [threading.Thread(target=self.run, name='job-worker', daemon=True)
+                   for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                worked = self.work()
+            except Exception as error:
+                LOGGER.error(f" Job worker failed to claim jobs: {error}")
+                worked = False
+            if not worked:
+                self.stopped.wait(self.poll_interval)
+
+    def work(self):
+        """
+        Runs the oldest claimable job of the first tenant that has one.
+
+        :return Whether a job was run
+        """
+        for tenant in self.claimable_tenants():
+            claimed = self.claim(tenant)
+            if claimed is not None:
+                self.execute(tenant, *claimed)
+                return True
+        return False
+
+    @staticmethod
+    def claimable_tenants():
+        """
+        Finds the tenants that have jobs to be claimed (or expired), checking
+        every tenant schema with a single query - so that idle workers do not
+        connect to each tenant on every poll.
+        """
+        with app.app_context():
+            g.tenant = '__status_monitor__'
+            tenants = [row[0] for row in db.session.execute(JOB_TENANTS)]
+            if not tenants:
+                return []
+
+            query = ' UNION ALL '.join(CLAIMABLE_PROBE.format(index=index, schema=quote_schema(tenant))
+                                       for index, tenant in enumerate(tenants))
+            params = {'tenant_{}'.format(index): tenant for index, tenant in enumerate(tenants)}
+            params['now'] = datetime.now()
+            claimable = [row[0] for row in db.session.execute(text(query), params)]
+            db.session.commit()
+            return claimable
+
+    def claim(self, tenant):
+        """
+        Marks the oldest pending (or expired) job of the tenant as running,
+        leased to this worker.
+
+        :return The claimed job (id, kind, params and attempt), or None if
+        there is no job to be claimed
+        """
+        with app.app_context():
+            g.tenant = tenant
+            switch_tenant(tenant, db)
+            now = datetime.now()
+            db.session.execute(EXPIRE_JOBS, {'now': now, 'max_attempts': self.max_attempts})
+            claimed = db.session.execute(CLAIM_JOB, {
+                'now': now,
+                'locked_until': now + timedelta(seconds=self.lease)
+            }).fetchone()
+            db.session.commit()
+            return None if claimed is None else tuple(claimed)
+
+    def execute(self, tenant, job_id, kind, params, attempt):
+        """ Performs a claimed job, recording its outcome """
+        with self.lock:
+            self.running += 1
+
+        with app.app_context():
+            g.tenant = tenant
+            switch_tenant(tenant, db)
+            jobs = Job.__table__
+            # once the lease is lost, the job belongs to whichever worker claimed it again
+            this_attempt = (jobs.c.id == job_id) & (jobs.c.attempts == attempt)
+
+            def progress(count):
+                db.session.execute(jobs.update().where(this_attempt).values(progress=count))
+                db.session.commit()
+
+            outcome = {'status': 'failed'}
+            try:
+                runner = JOB_RUNNERS.get(kind)
+                if runner is None:
+                    raise HTTPRequestError(500, "Unknown job kind: {}".format(kind))
+                stored = json.loads(params)
+                with JobLease(tenant, job_id, attempt, self.lease):
+                    result = runner(stored['params'], claims_token(stored['claims']), progress)
+                outcome = {'status': 'done', 'result': encode(result)}
+            except HTTPRequestError as error:
+                outcome['error'] = encode(error.message)
+            except ValidationError as error:
+                outcome['error'] = encode({'message': 'failed to parse attr', 'errors': error.messages})
+            except Exception as error:
+                LOGGER.error(f" Job {job_id} ({kind}) failed: {error}")
+                outcome['error'] = encode(str(error))
+
+            try:
+                # whatever the job left behind must not be committed along with its outcome
+                db.session.rollback()
+                switch_tenant(tenant, db)
+                outcome['finished'] = datetime.now()
+                outcome['locked_until'] = None
+                db.session.execute(jobs.update().where(this_attempt).values(**outcome))
+                db.session.commit()
+            except SQLAlchemyError as error:
+                LOGGER.error(f" Failed to record the outcome of job {job_id}: {error}")
+            finally:
+                with self.lock:
+                    self.running -= 1
+                    if outcome['status'] == 'done':
+                        self.done += 1
+                    else:
+                        self.failed += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'running': self.running,
+                'done': self.done,
+                'failed': self.failed
+            }
+
+
+JOB_WORKERS = JobWorkers()
+
+
+class JobHandler(object):
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def submit(kind, params, token):
+        """
+        Stores a job, to be run by the first available worker.
+
+        :param kind: The kind of job, as registered by register_job
+        :param params: The parameters given to the job runner (see create_job)
+        :param token: The authorization token (JWT)
+        :return The stored job
+        :rtype JSON
+        :raises HTTPRequestError: If no authorization token was provided (no
+        tenant was informed)
+        """
+        init_tenant_context(token, db)
+
+        orm_job = create_job(kind, params, token)
+        result = {'job': serialize_job(orm_job)}
+        db.session.add(orm_job)
+        db.session.commit()
+
+        LOGGER.debug(f" Job {orm_job.id} ({kind}) submitted")
+        return result
+
+    @staticmethod
+    def get_job(job_id, token, kind=None):
+        """
+        Fetches a job.
+
+        :param job_id: The job id
+        :param token: The authorization token (JWT)
+        :param kind: If informed, only a job of this kind is fetched
+        :return The job, along with its result (or error) once finished
+        :rtype JSON
+        :raises HTTPRequestError: If no authorization token was provided (no
+        tenant was informed)
+        :raises HTTPRequestError: If the job does not exist
+        """
+        init_tenant_context(token, db)
+        orm_job = db.session.query(Job).filter_by(id=job_id).one_or_none()
+        if orm_job is None or (kind is not None and orm_job.kind != kind):
+            raise HTTPRequestError(404, "No such job: {}".format(job_id))
+        return serialize_job(orm_job)
+
+
+@job.route('/job/<job_id>', methods=['GET'])
+def flask_get_job(job_id):
+    try:
+        # retrieve the authorization token
+        token = retrieve_auth_token(request)
+
+        result = JobHandler.get_job(job_id, token)
+        return make_response(jsonify(result), 200)
+    except HTTPRequestError as e:
+        LOGGER.error(f" {e.message} - {e.error_code}.")
+        if isinstance(e.message, dict):
+            return make_response(jsonify(e.message), e.error_code)
+        return format_response(e.error_code, e.message)
+
+
+app.register_blueprint(job)
@@ -0,0 +1,15 @@
+"""
+    Runs asynchronous jobs (see JobHandler), apart from the web workers.
+
+    Usage: python -m DeviceManager.JobWorker
+"""
+from DeviceManager.JobHandler import JOB_WORKERS
+
+# registers the job runners
+import DeviceManager.DeviceHandler
+import DeviceManager.TemplateHandler
+import DeviceManager.ImportHandler
+
+
+if __name__ == '__main__':
+    JOB_WORKERS.run_forever()
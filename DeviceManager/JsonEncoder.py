@@ -0,0 +1,64 @@
+"""
+    JSON encoding used for responses and Kafka payloads.
+
+    When available (and not disabled by configuration) orjson is used, which
+    is considerably faster than the standard library encoder and handles
+    datetimes natively. Otherwise, the standard library encoder is used, with
+    datetimes encoded the same way (ISO 8601).
+"""
+import json
+from datetime import date, datetime
+from flask import current_app
+
+from DeviceManager.conf import CONFIG
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def default(obj):
+    """ Encodes objects the standard library encoder does not know about """
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+
+def stdlib_dumps(obj):
+    return json.dumps(obj, default=default, separators=(',', ':')).encode('utf-8')
+
+
+def orjson_dumps(obj):
+    # device attributes are keyed by (integer) template ids
+    return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def select_backend(name):
+    """
+    Selects the encoding function.
+
+    :param name: One of 'auto', 'orjson' or 'json'. If orjson is requested
+    but not installed, the standard library encoder is used.
+    :return A function encoding objects into UTF-8 JSON bytes
+    """
+    if name in ('auto', 'orjson') and orjson is not None:
+        return orjson_dumps
+    return stdlib_dumps
+
+
+dumps = select_backend(CONFIG.json_backend)
+
+
+def jsonify(*args, **kwargs):
+    """
+    Drop-in replacement of flask.jsonify, using the configured encoder.
+    """
+    if args and kwargs:
+        raise TypeError('jsonify() behavior undefined when passed both args and kwargs')
+    if len(args) == 1:
+        data = args[0]
+    else:
+        data = args or kwargs
+
+    return current_app.response_class(dumps(data), mimetype=current_app.config['JSONIFY_MIMETYPE'])
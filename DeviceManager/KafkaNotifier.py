@@ -8,6 +8,7 @@ from kafka.errors import KafkaTimeoutError
 
 from DeviceManager.conf import CONFIG
 from DeviceManager.Logger import Log
+from DeviceManager.JsonEncoder import dumps
 from datetime import datetime
 import time
 
@@ -43,7 +44,7 @@ class KafkaNotifier:
         self.kafka_address = CONFIG.kafka_host + ':' + CONFIG.kafka_port
         self.kf_prod = None
         
-        self.kf_prod = KafkaProducer(value_serializer=lambda v: json.dumps(v).encode('utf-8'),
+        self.kf_prod = KafkaProducer(value_serializer=dumps,
                                 bootstrap_servers=self.kafka_address)
 
         # Maps services to their managed topics
@@ -89,6 +90,23 @@ class KafkaNotifier:
         except KafkaTimeoutError:
             LOGGER.error(f" Kafka timed out.")
 
+    def send_notifications(self, event, devices, meta):
+        """
+        Publishes one notification per device, waiting for the whole batch to
+        be delivered at once.
+        """
+        try:
+            topic = self.get_topic(meta['service'], CONFIG.subject)
+            if topic is None:
+                LOGGER.error(f" Failed to retrieve named topic to publish to")
+                return
+
+            for device in devices:
+                self.kf_prod.send(topic, NotificationMessage(event, device, meta).to_json())
+            self.kf_prod.flush()
+        except KafkaTimeoutError:
+            LOGGER.error(f" Kafka timed out.")
+
     def send_raw(self, raw_data, tenant):
         try:
             topic = self.get_topic(tenant, CONFIG.subject)
@@ -1,4 +1,5 @@
-from flask import Blueprint, request, jsonify, make_response
+from flask import Blueprint, request, make_response
+from DeviceManager.JsonEncoder import jsonify
 
 from DeviceManager.conf import CONFIG
 from DeviceManager.Logger import Log
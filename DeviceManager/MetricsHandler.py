@@ -0,0 +1,41 @@
+""" Exposes internal performance counters of this device-manager instance """
+from flask import Blueprint, make_response
+from DeviceManager.JsonEncoder import jsonify
+
+from DeviceManager.app import app
+from DeviceManager.Logger import Log
+from DeviceManager.QueryCache import LISTING_CACHE
+from DeviceManager.RequestCoalescer import READ_COALESCER
+
+metrics = Blueprint('metrics', __name__)
+
+LOGGER = Log().color_log()
+
+
+class MetricsHandler:
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def get_metrics():
+        """
+        Fetches the counters of this worker process.
+
+        :return A JSON containing read coalescing and listing cache counters
+        :rtype JSON
+        """
+        return {
+            'coalescing': READ_COALESCER.stats(),
+            'listing_cache': LISTING_CACHE.stats()
+        }
+
+
+@metrics.route('/internal/metrics', methods=['GET'])
+def flask_get_metrics():
+    result = MetricsHandler.get_metrics()
+
+    return make_response(jsonify(result), 200)
+
+
+app.register_blueprint(metrics)
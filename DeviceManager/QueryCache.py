@@ -0,0 +1,125 @@
+"""
+    Caches listing results, keyed by the write generation of each tenant.
+
+    Every write performed on a tenant bumps its generation (a single row kept
+    in the tenant schema) within the same transaction as the write itself. As
+    cached entries are looked up using the generation read right before the
+    query, any committed write makes all previous entries of that tenant
+    unreachable - no explicit invalidation is ever needed.
+"""
+import threading
+from collections import OrderedDict
+from sqlalchemy.sql import text
+
+from DeviceManager.conf import CONFIG
+from DeviceManager.Logger import Log
+
+LOGGER = Log().color_log()
+
+
+def bump_generation(session):
+    """
+    Invalidates every cached listing of the current tenant.
+
+    This must be called inside the transaction that performs the write
+    (ideally right before its commit), so that the new generation becomes
+    visible at the same time as the written data.
+
+    :param session: The database session of the current tenant
+    """
+    session.execute(text("UPDATE write_generation SET generation = generation + 1"))
+
+
+def current_generation(session):
+    """
+    Retrieves the current write generation of the tenant.
+
+    :param session: The database session of the current tenant
+    :return The current generation, or None if it could not be determined
+    :rtype int
+    """
+    generation = session.execute(text("SELECT generation FROM write_generation")).scalar()
+    if isinstance(generation, int):
+        return generation
+    return None
+
+
+class QueryCache(object):
+    """ Bounded LRU cache of listing results, segmented by tenant generation """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(params):
+        """
+        Builds a hashable, order independent representation of the request
+        parameters, to be used as part of a cache key.
+        """
+        normalized = []
+        for key, value in params.items():
+            if isinstance(value, (list, tuple, set)):
+                value = tuple(sorted(value))
+            normalized.append((key, value))
+        return tuple(sorted(normalized, key=lambda item: item[0]))
+
+    def get(self, tenant, generation, key):
+        """
+        Retrieves a cached result.
+
+        :return The cached result or None if there is no valid entry
+        """
+        if generation is None or self.max_entries <= 0:
+            return None
+
+        with self.lock:
+            result = self.entries.get((tenant, generation, key))
+            if result is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end((tenant, generation, key))
+            self.hits += 1
+            return result
+
+    def put(self, tenant, generation, key, result):
+        """ Stores a result, dropping entries from older tenant generations """
+        if generation is None or self.max_entries <= 0:
+            return
+
+        with self.lock:
+            known = self.generations.get(tenant)
+            if known is not None and generation < known:
+                # A write has happened since this result was computed
+                return
+            if known is not None and generation > known:
+                stale = [entry for entry in self.entries if entry[0] == tenant]
+                LOGGER.debug(f" Dropping {len(stale)} stale cache entries of tenant {tenant}")
+                for entry in stale:
+                    del self.entries[entry]
+            self.generations[tenant] = generation
+
+            self.entries[(tenant, generation, key)] = result
+            self.entries.move_to_end((tenant, generation, key))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generations.clear()
+
+
+LISTING_CACHE = QueryCache(CONFIG.query_cache_size)
@@ -0,0 +1,131 @@
+"""
+    Collapses identical concurrent reads into a single execution.
+
+    The first request for a given key (the leader) runs the actual query and
+    serialization; every identical request arriving while it is in flight
+    (the followers) waits for and shares the leader's result - or error.
+
+    Requests are only collapsed within the same write generation of the
+    tenant (see QueryCache): a read issued once a write is committed never
+    shares the result of a call that started before that write. Followers
+    get their own copy of the result, so that none of them can alter what
+    the others (or the leader) return.
+"""
+import copy
+import functools
+import threading
+
+from DeviceManager.utils import get_allowed_service
+from DeviceManager.Logger import Log
+
+LOGGER = Log().color_log()
+
+
+def freeze(value):
+    """ Builds a hashable representation of request arguments """
+    if isinstance(value, dict):
+        return tuple(sorted(((key, freeze(item)) for key, item in value.items()),
+                            key=lambda entry: entry[0]))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, set):
+        return frozenset(freeze(item) for item in value)
+    return value
+
+
+class InFlightCall(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def do(self, key, fn):
+        """
+        Executes fn, unless an identical call is already in flight - in which
+        case its outcome is shared.
+
+        :param key: Hashable identification of the call
+        :param fn: Callable that actually performs the call
+        :return Whatever fn returns
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = InFlightCall()
+                self.calls[key] = call
+                self.leaders += 1
+                is_leader = True
+            else:
+                call.followers += 1
+                self.followers += 1
+                is_leader = False
+
+        if not is_leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result)
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as error:
+            call.error = error
+            raise
+        except BaseException:
+            # leader was interrupted (e.g. worker timeout): followers must not
+            # silently receive an empty result
+            call.error = RuntimeError("Coalesced request was interrupted")
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            if call.followers:
+                LOGGER.debug(f" {call.followers} request(s) coalesced into {key[1]}")
+            call.event.set()
+
+    def stats(self):
+        with self.lock:
+            total = self.leaders + self.followers
+            return {
+                'leaders': self.leaders,
+                'followers': self.followers,
+                'in_flight': len(self.calls),
+                'collapse_ratio': (self.followers / total) if total else 0.0
+            }
+
+
+READ_COALESCER = SingleFlight()
+
+
+def coalesced(route, generation):
+    """
+    Decorates a read handler whose first argument is the authorization token,
+    so that concurrent identical calls (same tenant, route, arguments and
+    write generation) are served by a single execution.
+
+    :param route: Name of the read, distinguishing it from other handlers
+    :param generation: Callable retrieving the current write generation of
+    the tenant from the token. Calls are not coalesced at all if it returns
+    None.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(token, *args, **kwargs):
+            current = generation(token)
+            if current is None:
+                return handler(token, *args, **kwargs)
+            key = (get_allowed_service(token), route, current, freeze(args), freeze(kwargs))
+            return READ_COALESCER.do(key, lambda: handler(token, *args, **kwargs))
+        return wrapper
+    return decorator
@@ -1,4 +1,5 @@
 # object to json sweetness
+import functools
 import json
 import re
 from marshmallow import Schema, fields, post_dump, post_load, ValidationError
@@ -78,23 +79,68 @@ class AttrSchema(Schema):
 attr_schema = AttrSchema()
 attr_list_schema = AttrSchema(many=True)
 
+# Attribute types listed as data_attrs, every other type is listed as config_attrs
+DATA_ATTR_TYPES = frozenset(['static', 'dynamic', 'actuator'])
+
+# Attribute lists a template might be serialized with
+ATTR_LISTS = ('attrs', 'data_attrs', 'config_attrs')
+
+def split_attrs(data, original, attr_lists=None):
+    """
+    Derives the data_attrs and config_attrs lists from the serialized attrs of
+    a template, so that its attributes are loaded and serialized only once.
+
+    :param data: The serialized template
+    :param original: The template that was serialized
+    :param attr_lists: Maps each attribute list to be kept to the attribute
+    fields it must be restricted to (empty for all of them). Every list is kept
+    in full if not informed.
+    :return The serialized template
+    """
+    attrs = data.pop('attrs', None)
+    if attrs is None:
+        return data
+    if attr_lists is None:
+        attr_lists = {name: frozenset() for name in ATTR_LISTS}
+
+    orm_attrs = getattr(original, 'attrs', None)
+    if orm_attrs is not None and len(orm_attrs) == len(attrs):
+        types = [orm_attr.type for orm_attr in orm_attrs]
+    else:
+        types = [attr.get('type') for attr in attrs]
+
+    lists = {'attrs': attrs}
+    if 'data_attrs' in attr_lists or 'config_attrs' in attr_lists:
+        lists['data_attrs'] = [attr for attr, attr_type in zip(attrs, types)
+                               if attr_type in DATA_ATTR_TYPES]
+        lists['config_attrs'] = [attr for attr, attr_type in zip(attrs, types)
+                                 if attr_type not in DATA_ATTR_TYPES]
+
+    for name, attr_fields in attr_lists.items():
+        if attr_fields:
+            data[name] = [{key: value for key, value in attr.items() if key in attr_fields}
+                          for attr in lists[name]]
+        else:
+            data[name] = lists[name]
+    return data
+
 class TemplateSchema(Schema):
     id = fields.Int(dump_only=True)
     import_id = fields.Int(load_only=True)
     label = fields.Str(required=True)
     created = fields.DateTime(dump_only=True)
     updated = fields.DateTime(dump_only=True)
+    # data_attrs and config_attrs are derived from attrs, once serialized
     attrs = fields.Nested(AttrSchema, many=True, dump_only=True)
-    data_attrs = fields.Nested(AttrSchema, many=True, dump_only=True)
-    config_attrs = fields.Nested(AttrSchema, many=True, dump_only=True)
 
     @post_load
     def set_import_id(self, data):
         return set_id_with_import_id(data)
 
-    @post_dump
-    def remove_null_values(self, data):
-        return {key: value for key, value in data.items() if value is not None}
+    @post_dump(pass_original=True)
+    def remove_null_values(self, data, original):
+        data = {key: value for key, value in data.items() if value is not None}
+        return split_attrs(data, original, self.context.get('attr_lists'))
 
 template_schema = TemplateSchema()
 template_list_schema = TemplateSchema(many=True)
@@ -134,6 +180,99 @@ class LogSchema(Schema):
 
 log_schema = LogSchema()
 
+ATTR_FIELDS = frozenset(['id', 'label', 'created', 'updated', 'type', 'value_type',
+                         'static_value', 'is_static_overridden', 'template_id', 'metadata'])
+
+DEVICE_FIELDS = {
+    'id': frozenset(),
+    'label': frozenset(),
+    'created': frozenset(),
+    'updated': frozenset(),
+    'templates': frozenset(),
+    'attrs': ATTR_FIELDS
+}
+
+TEMPLATE_FIELDS = {
+    'id': frozenset(),
+    'label': frozenset(),
+    'created': frozenset(),
+    'updated': frozenset(),
+    'attrs': ATTR_FIELDS,
+    'data_attrs': ATTR_FIELDS,
+    'config_attrs': ATTR_FIELDS
+}
+
+def parse_fields(selection, allowed):
+    """
+    Parses a sparse fieldset selection, such as 'id,label,attrs.label'
+
+    :param selection: Comma separated list of fields, as received in the request
+    :param allowed: Maps every selectable field to its selectable sub-fields
+    :return A dict mapping each selected field to the set of its selected
+    sub-fields (empty when the whole field was requested), or None if no
+    selection was made at all
+    :raises HTTPRequestError: If an unknown field is requested
+    """
+    if not selection:
+        return None
+
+    fields = {}
+    whole = set()
+    for item in selection.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, child = item.partition('.')
+        if name not in allowed or (child and child not in allowed[name]):
+            raise HTTPRequestError(400, "Unknown field {} in fields selection".format(item))
+        children = fields.setdefault(name, set())
+        if child:
+            children.add(child)
+        else:
+            whole.add(name)
+
+    if not fields:
+        return None
+    return {name: frozenset() if name in whole else frozenset(children)
+            for name, children in fields.items()}
+
+def dotted_fields(fields):
+    """ Converts a parsed field selection into marshmallow's 'only' notation """
+    only = set()
+    for name, children in fields.items():
+        if children:
+            only.update('{}.{}'.format(name, child) for child in children)
+        else:
+            only.add(name)
+    return frozenset(only)
+
+@functools.lru_cache(maxsize=128)
+def selective_schema(schema_class, only, many=False):
+    """
+    Returns a (shared) schema instance that only serializes the given fields
+
+    :param schema_class: The schema to be restricted
+    :param only: Frozen set of field names, dotted names restricting nested fields
+    :param many: Whether the schema serializes lists
+    """
+    return schema_class(only=tuple(sorted(only)), many=many)
+
+@functools.lru_cache(maxsize=128)
+def template_format_schema(only, attr_lists, many=False):
+    """
+    Returns a (shared) template schema instance that only serializes the given
+    fields and attribute lists
+
+    :param only: Frozen set of field names (None for all of them), attribute
+    fields being restricted through 'attrs'
+    :param attr_lists: Frozen set of (attribute list, attribute fields) pairs,
+    as expected by split_attrs
+    :param many: Whether the schema serializes lists
+    """
+    if only is not None:
+        only = tuple(sorted(only))
+    return TemplateSchema(only=only, many=many, context={'attr_lists': dict(attr_lists)})
+
 def parse_payload(content_type, data_request, schema):
     try:
         if (content_type is None) or (content_type != "application/json"):
@@ -147,6 +286,45 @@ def parse_payload(content_type, data_request, schema):
         raise HTTPRequestError(400, results)
     return data, json_payload
 
+def parse_json_object(content_type, data_request):
+    """
+    Parses a payload that must be a JSON object, with no schema attached.
+
+    :return The parsed object
+    """
+    if (content_type is None) or (content_type != "application/json"):
+        raise HTTPRequestError(400, "Payload must be valid JSON, and Content-Type set accordingly")
+    try:
+        json_payload = json.loads(data_request)
+    except ValueError:
+        raise HTTPRequestError(400, "Payload must be valid JSON, and Content-Type set accordingly")
+    if not isinstance(json_payload, dict):
+        raise HTTPRequestError(400, "Payload must be valid JSON, and Content-Type set accordingly")
+    return json_payload
+
+def parse_merge_patch(content_type, data_request, schema):
+    """
+    Parses a JSON merge patch (RFC 7396), validating only the fields it
+    carries.
+
+    :return The validated fields and the patch document itself
+    """
+    if content_type not in ("application/merge-patch+json", "application/json"):
+        raise HTTPRequestError(400, "Payload must be a JSON merge patch, and Content-Type set accordingly")
+    try:
+        json_payload = json.loads(data_request)
+    except ValueError:
+        raise HTTPRequestError(400, "Payload must be a JSON merge patch, and Content-Type set accordingly")
+    if not isinstance(json_payload, dict):
+        raise HTTPRequestError(400, "Payload must be a JSON merge patch, and Content-Type set accordingly")
+
+    try:
+        data = schema.load(json_payload, partial=True)
+    except ValidationError as errors:
+        results = {'message': 'failed to parse input', 'errors': errors.messages}
+        raise HTTPRequestError(400, results)
+    return data, json_payload
+
 def load_attrs(attr_list, parent_template, base_type, db):
     """
 
@@ -0,0 +1,137 @@
+"""
+    Publishes the device updates implied by template changes outside of the
+    requests that changed them.
+
+    A template may be used by a great number of devices, each of which must
+    be re-serialized and published once the template changes. Instead of
+    doing so while the client waits, the request stores a template.fanout
+    job (see JobHandler) in the very transaction that updates the template,
+    so that the publication is not lost once the update is acknowledged. The
+    job stores the template id only: the job process reads the ids of the
+    affected devices from the device_template index, then loads (one query
+    per batch), serializes and publishes the devices batch by batch; its
+    progress can be followed through GET /job/<id> (or GET
+    /template/fanout/<id>).
+
+    In compact mode (TEMPLATE_UPDATE_MODE=compact) devices are not published
+    at all: template.update events carry the attribute changes and the ids of
+    the affected devices instead, at most TEMPLATE_EVENT_CHUNK ids per event.
+"""
+from DeviceManager.DatabaseHandler import db
+from DeviceManager.conf import CONFIG
+from DeviceManager.BackendHandler import KafkaInstanceHandler
+from DeviceManager.DeviceHandler import iter_devices, iter_template_device_ids, serialize_full_device
+from DeviceManager.DeviceHandler import chunks, NOTIFY_BATCH
+from DeviceManager.JobHandler import create_job, register_job
+from DeviceManager.KafkaNotifier import DeviceEvent
+from DeviceManager.utils import get_allowed_service
+from DeviceManager.Logger import Log
+
+LOGGER = Log().color_log()
+
+FANOUT_JOB = 'template.fanout'
+
+
+def fanout_job(template_id, template, token, diff=None):
+    """
+    Builds the job publishing the device updates implied by a template
+    update, to be added to the session that updates the template.
+
+    :param template_id: The updated template
+    :param template: The serialized (updated) template
+    :param token: The authorization token (JWT)
+    :param diff: The attribute changes, if only those are to be published
+    (compact mode)
+    :return The job
+    :rtype Job
+    """
+    return create_job(FANOUT_JOB, {
+        'template_id': template_id,
+        'template': template,
+        'diff': diff
+    }, token)
+
+
+def publish_devices(tenant, template_id, template, kafka_handler, progress, batch=NOTIFY_BATCH):
+    """
+    Publishes the affected devices, batch by batch, followed by the
+    template.update event
+
+    :return How many devices were affected and how many were published
+    """
+    meta = {"service": tenant}
+    affected = []
+    published = 0
+    for device_ids in iter_template_device_ids(template_id, batch):
+        for orm_devices in iter_devices(device_ids, batch):
+            kafka_handler.update_many(
+                [serialize_full_device(orm_device, tenant) for orm_device in orm_devices],
+                meta=meta)
+            published += len(orm_devices)
+            # devices already published need not be kept around
+            db.session.expunge_all()
+        affected.extend(device_ids)
+        progress(published)
+
+    event = {
+        "event": DeviceEvent.TEMPLATE,
+        "data": {
+            "affected": affected,
+            "template": template
+        },
+        "meta": meta
+    }
+    kafka_handler.kafkaNotifier.send_raw(event, tenant)
+    return len(affected), published
+
+
+def publish_changes(tenant, template_id, template, diff, kafka_handler, progress):
+    """
+    Publishes the attribute changes, along with the affected devices
+
+    :return How many devices were affected and how many were published
+    """
+    meta = {"service": tenant}
+    # every event states how many parts there are, so all ids are read first
+    device_ids = [device_id for batch in iter_template_device_ids(template_id)
+                  for device_id in batch]
+    parts = list(chunks(device_ids, CONFIG.template_event_chunk)) or [[]]
+    template = {key: template.get(key) for key in ('id', 'label')}
+    published = 0
+    for index, part_ids in enumerate(parts):
+        event = {
+            "event": DeviceEvent.TEMPLATE,
+            "data": {
+                "template": template,
+                "diff": diff,
+                "affected": part_ids,
+                "part": index + 1,
+                "parts": len(parts)
+            },
+            "meta": meta
+        }
+        kafka_handler.kafkaNotifier.send_raw(event, tenant)
+        published += len(part_ids)
+        progress(published)
+    return len(device_ids), published
+
+
+@register_job(FANOUT_JOB)
+def run_fanout(params, token, progress):
+    tenant = get_allowed_service(token)
+    kafka = KafkaInstanceHandler()
+    kafka_handler = kafka.getInstance(kafka.kafkaNotifier)
+    template_id = params['template_id']
+    if params.get('diff') is not None:
+        total, published = publish_changes(tenant, template_id, params['template'], params['diff'],
+                                           kafka_handler, progress)
+    else:
+        total, published = publish_devices(tenant, template_id, params['template'], kafka_handler,
+                                           progress)
+    LOGGER.debug(f" Published the update of template {template_id} to {published} devices")
+    return {
+        'template_id': template_id,
+        'mode': 'full' if params.get('diff') is None else 'compact',
+        'total': total,
+        'published': published
+    }
@@ -1,18 +1,25 @@
 import logging
 import re
-from flask import Blueprint, request, jsonify, make_response
+from collections import deque
+from flask import Blueprint, request, make_response, Response, stream_with_context
+from DeviceManager.JsonEncoder import jsonify
 from flask_sqlalchemy import BaseQuery, Pagination
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.sql import text, collate, func
+from sqlalchemy.sql import text, collate, func, select, case, and_, literal, null
+from sqlalchemy.orm import load_only, noload
 
 from DeviceManager.DatabaseHandler import db
 from DeviceManager.DatabaseModels import handle_consistency_exception, assert_template_exists, assert_device_exists
-from DeviceManager.DatabaseModels import DeviceTemplate, DeviceAttr, DeviceTemplateMap
+from DeviceManager.DatabaseModels import DeviceTemplate, DeviceAttr, DeviceTemplateMap, load_attr_trees
+from DeviceManager.DatabaseModels import DeviceOverride, DeviceAttrsPsk, attr_tree, reserve_sequence_ids
 from DeviceManager.SerializationModels import template_list_schema, template_schema
 from DeviceManager.SerializationModels import attr_list_schema, attr_schema, metaattr_schema
-from DeviceManager.SerializationModels import parse_payload, load_attrs
+from DeviceManager.SerializationModels import parse_payload, parse_json_object
+from DeviceManager.SerializationModels import TEMPLATE_FIELDS, ATTR_LISTS
+from DeviceManager.SerializationModels import parse_fields, dotted_fields, template_format_schema
 from DeviceManager.SerializationModels import ValidationError
 from DeviceManager.TenancyManager import init_tenant_context
+from DeviceManager.QueryCache import bump_generation
 from DeviceManager.KafkaNotifier import KafkaNotifier, DeviceEvent
 
 from DeviceManager.app import app
@@ -22,7 +29,12 @@ from DeviceManager.Logger import Log
 from datetime import datetime
 
 from DeviceManager.BackendHandler import KafkaHandler, KafkaInstanceHandler
-from DeviceManager.DeviceHandler import serialize_full_device
+from DeviceManager.DeviceHandler import serialize_full_device, chunks, parse_template_id
+from DeviceManager.DeviceHandler import iter_template_device_ids
+from DeviceManager.DeviceHandler import BULK_INSERT_CHUNK, DELETE_BATCH
+from DeviceManager.TemplateFanout import fanout_job, FANOUT_JOB
+from DeviceManager.JobHandler import JobHandler, register_job, is_async, serialize_job
+from DeviceManager.conf import CONFIG
 
 import time
 import json
@@ -31,23 +43,14 @@ template = Blueprint('template', __name__)
 
 LOGGER = Log().color_log()
 
-def attr_format(attrs_format, result):
-    """ formats output attr list acording to user input """
+# How many device ids are read by each query when listing a template usage
+USAGE_BATCH = 1000
 
-    def remove(d,k):
-        try:
-            LOGGER.info(f' will remove {k}')
-            d.pop(k)
-        except KeyError:
-            pass
-
-    if attrs_format == 'split':
-        remove(result, 'attrs')
-    elif attrs_format == 'single':
-        remove(result, 'config_attrs')
-        remove(result, 'data_attrs')
-
-    return result
+# Attribute lists serialized by each attrs_format, all of them otherwise
+ATTRS_FORMATS = {
+    'single': ('attrs',),
+    'split': ('data_attrs', 'config_attrs')
+}
 
 def paginate(query, page, per_page=20, error_out=False):
     if error_out and page < 1:
@@ -63,6 +66,312 @@ def paginate(query, page, per_page=20, error_out=False):
 
     return Pagination(query, page, per_page, total, items)
 
+def requested_attr_lists(fields, attrs_format=None):
+    """
+    Maps each attribute list (attrs, data_attrs, config_attrs) to be serialized
+    to the attribute fields it is restricted to (empty for all of them)
+
+    :param fields: Parsed field selection, as returned by parse_fields
+    :param attrs_format: 'single' (attrs only), 'split' (data_attrs and
+    config_attrs only) or anything else for all of them
+    """
+    names = ATTRS_FORMATS.get(attrs_format, ATTR_LISTS)
+    if fields is None:
+        return {name: frozenset() for name in names}
+    return {name: fields[name] for name in names if name in fields}
+
+def merged_attr_fields(attr_lists):
+    """ Attribute fields needed by every requested list (empty for all of them) """
+    if any(not attr_fields for attr_fields in attr_lists.values()):
+        return frozenset()
+    return frozenset().union(*attr_lists.values())
+
+def template_load_options(fields):
+    """
+    Builds the query options needed to load templates for the given sparse
+    fieldset (as returned by parse_fields). Attributes are never loaded along
+    with the templates themselves: see load_template_attrs.
+    """
+    options = [noload(DeviceTemplate.attrs)]
+    if fields is not None:
+        columns = [name for name in ('label', 'created', 'updated') if name in fields]
+        options.append(load_only('id', *columns))
+    return options
+
+def load_template_attrs(templates, fields, attrs_format=None):
+    """
+    Loads the attribute trees of the given templates (in a single query), if
+    the sparse fieldset and attrs_format require them at all
+    """
+    if requested_attr_lists(fields, attrs_format):
+        load_attr_trees(templates, db.session)
+
+def template_dump_schema(fields, attrs_format=None, many=False):
+    """ Returns the schema that serializes the given sparse fieldset """
+    attr_lists = requested_attr_lists(fields, attrs_format)
+    if fields is None:
+        if attrs_format not in ATTRS_FORMATS:
+            return template_list_schema if many else template_schema
+        only = None
+    else:
+        only = {name: children for name, children in fields.items() if name not in ATTR_LISTS}
+        if attr_lists:
+            only['attrs'] = merged_attr_fields(attr_lists)
+        only = dotted_fields(only)
+    return template_format_schema(only, frozenset(attr_lists.items()), many)
+
+def device_counts(template_ids):
+    """
+    Counts the devices associated with each of the given templates, in a
+    single grouped query over the device_template index
+
+    :return A dict mapping each template id to its device count (templates
+    with no devices are left out)
+    """
+    if not template_ids:
+        return {}
+    rows = (db.session.query(DeviceTemplateMap.template_id, func.count(DeviceTemplateMap.device_id))
+            .filter(DeviceTemplateMap.template_id.in_(template_ids))
+            .group_by(DeviceTemplateMap.template_id)
+            .all())
+    return {template_id: count for template_id, count in rows}
+
+def delete_templates(template_ids):
+    """
+    Removes the given templates using set based deletes: every attribute (and
+    metadata) of theirs goes along with them, as well as any value or key
+    devices might still keep for those attributes.
+
+    :return The ids of the removed templates
+    """
+    attr_ids = select([attr_tree(template_ids, 'id').c.id])
+    db.session.execute(DeviceOverride.__table__.delete().where(DeviceOverride.aid.in_(attr_ids)))
+    db.session.execute(DeviceAttrsPsk.__table__.delete().where(DeviceAttrsPsk.attr_id.in_(attr_ids)))
+    db.session.execute(DeviceAttr.__table__.delete().where(DeviceAttr.id.in_(attr_ids)))
+    result = db.session.execute(DeviceTemplate.__table__.delete()
+                                .where(DeviceTemplate.id.in_(template_ids))
+                                .returning(DeviceTemplate.id))
+    return [row[0] for row in result]
+
+def clone_attrs(source_id, target_id, excluded=None, static_values=None):
+    """
+    Copies the attributes of a template, along with their whole metadata
+    hierarchy, into another one - using a single INSERT ... SELECT.
+
+    :param source_id: The template whose attributes are copied
+    :param target_id: The template receiving the copies
+    :param excluded: Labels of top level attributes not to be copied (their
+    metadata are not copied either)
+    :param static_values: Maps labels of top level attributes to the static
+    value their copies must have
+    """
+    attrs = DeviceAttr.__table__
+    where = attrs.c.label.notin_(excluded) if excluded else None
+    tree = attr_tree([source_id], 'label', 'type', 'value_type', 'static_value', 'template_id', 'parent_id',
+                     where=where)
+
+    # every copied attribute gets its own id, so that metadata can reference their copied parents
+    attr_ids = select([tree.c.id.label('old_id'), func.nextval('attr_id').label('new_id')]).cte('attr_ids')
+    parent_ids = attr_ids.alias('parent_ids')
+
+    top_level = tree.c.template_id.isnot(None)
+    static_value = tree.c.static_value
+    if static_values:
+        static_value = case([(and_(top_level, tree.c.label == label), literal(value))
+                             for label, value in static_values.items()],
+                            else_=tree.c.static_value)
+
+    copied = (select([attr_ids.c.new_id, tree.c.label, literal(datetime.now()), tree.c.type,
+                      tree.c.value_type, static_value, case([(top_level, literal(target_id))], else_=null()),
+                      parent_ids.c.new_id])
+              .select_from(tree.join(attr_ids, attr_ids.c.old_id == tree.c.id)
+                           .outerjoin(parent_ids, parent_ids.c.old_id == tree.c.parent_id)))
+    db.session.execute(attrs.insert().from_select(
+        ['id', 'label', 'created', 'type', 'value_type', 'static_value', 'template_id', 'parent_id'],
+        copied))
+
+def attr_key(attr):
+    """ Attributes (and metadata) are identified by their label and type """
+    if isinstance(attr, DeviceAttr):
+        return attr.label, attr.type
+    return attr.get('label'), attr.get('type')
+
+def diff_attrs(attrs_from_db, attrs_from_request):
+    """
+    Pairs the attributes stored in database with the requested ones sharing
+    their label and type, in linear time.
+
+    :return The matched (stored, requested) pairs, the stored attributes that
+    were not requested and the requested attributes that are not stored yet
+    (in request order)
+    """
+    requested = {}
+    for idx, attr_from_request in enumerate(attrs_from_request):
+        requested.setdefault(attr_key(attr_from_request), deque()).append(idx)
+
+    matched = []
+    removed = []
+    taken = set()
+    for attr_from_db in attrs_from_db:
+        candidates = requested.get(attr_key(attr_from_db))
+        if candidates:
+            idx = candidates.popleft()
+            taken.add(idx)
+            matched.append((attr_from_db, attrs_from_request[idx]))
+        else:
+            removed.append(attr_from_db)
+
+    added = [attr for idx, attr in enumerate(attrs_from_request) if idx not in taken]
+    return matched, removed, added
+
+class AttrChanges(object):
+    """
+    Records the changes applied to a list of attributes (or metadata) by a
+    template update, to be serialized once they are committed.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.added = []
+        # removed attributes are serialized before being deleted
+        self.removed = []
+        # (attribute, changes to its metadata) pairs
+        self.changed = []
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def to_json(self):
+        changed = []
+        for orm_attr, metadata_changes in self.changed:
+            attr = self.schema.dump(orm_attr)
+            if metadata_changes:
+                attr['metadata_changes'] = metadata_changes.to_json()
+            changed.append(attr)
+        return {
+            'added': [self.schema.dump(orm_attr) for orm_attr in self.added],
+            'removed': self.removed,
+            'changed': changed
+        }
+
+def load_template_batch(payloads):
+    """
+    Validates every template of a batch, before anything is written.
+
+    :param payloads: The templates, as received in the request
+    :return The loaded templates, each one with its loaded attributes (whose
+    metadata are kept under 'children')
+    :raises HTTPRequestError: If any template is invalid. Errors are reported
+    by the position of each invalid template in the batch.
+    """
+    templates = []
+    errors = {}
+    for idx, payload in enumerate(payloads):
+        try:
+            if not isinstance(payload, dict):
+                raise ValidationError({'_schema': ['Template must be a JSON object']})
+            attrs = payload.get('attrs', [])
+            if not isinstance(attrs, list):
+                raise ValidationError({'attrs': ['Not a valid list.']})
+            tpl = template_schema.load(payload)
+            try:
+                tpl['attrs'] = attr_list_schema.load(attrs)
+            except ValidationError as error:
+                raise ValidationError({'attrs': error.messages})
+            keys = [attr_key(attr) for attr in tpl['attrs']]
+            if len(set(keys)) < len(keys):
+                raise ValidationError({'attrs': ['a template can not have repeated attributes']})
+            templates.append(tpl)
+        except ValidationError as error:
+            errors[idx] = error.messages
+
+    if errors:
+        raise HTTPRequestError(400, {'message': 'failed to parse templates', 'errors': errors})
+    return templates
+
+def reserve_ids(column, count):
+    """ Reserves primary keys for count new rows, in a single query """
+    if not count:
+        return iter(())
+    return iter(reserve_sequence_ids(db.session, column.default, count))
+
+def template_batch_rows(templates):
+    """
+    Builds the rows to be inserted for a batch of loaded templates, drawing
+    the ids they were not given from the sequences in one query per table.
+
+    :return The template, attribute and metadata rows
+    """
+    attrs = [attr for tpl in templates for attr in tpl['attrs']]
+    children = [child for attr in attrs for child in attr.get('children', [])]
+    template_ids = reserve_ids(DeviceTemplate.__table__.c.id,
+                               sum(1 for tpl in templates if tpl.get('id') is None))
+    attr_ids = reserve_ids(DeviceAttr.__table__.c.id,
+                           sum(1 for attr in attrs + children if attr.get('id') is None))
+
+    now = datetime.now()
+
+    def attr_row(attr, template_id, parent_id):
+        if attr.get('id') is None:
+            attr['id'] = next(attr_ids)
+        return {
+            'id': attr['id'],
+            'label': attr['label'],
+            'type': attr['type'],
+            'value_type': attr['value_type'],
+            'static_value': attr.get('static_value'),
+            'template_id': template_id,
+            'parent_id': parent_id,
+            'created': now
+        }
+
+    template_rows = []
+    attr_rows = []
+    metadata_rows = []
+    for tpl in templates:
+        if tpl.get('id') is None:
+            tpl['id'] = next(template_ids)
+        template_rows.append({'id': tpl['id'], 'label': tpl['label'], 'created': now})
+        for attr in tpl['attrs']:
+            attr_rows.append(attr_row(attr, tpl['id'], None))
+            for child in attr.get('children', []):
+                metadata_rows.append(attr_row(child, None, attr['id']))
+    return template_rows, attr_rows, metadata_rows
+
+def insert_templates(templates):
+    """
+    Inserts a batch of loaded templates (see load_template_batch), along with
+    their attributes and metadata, using multi-row INSERT statements - a
+    fixed number of round trips, however many attributes each template has -
+    and reloads them once committed.
+
+    :return The created templates, in the given order
+    :raises HTTPRequestError: If template attribute constraints were
+    violated.
+    """
+    template_rows, attr_rows, metadata_rows = template_batch_rows(templates)
+
+    try:
+        # metadata reference their parent attributes, which must be inserted first
+        for table, rows in ((DeviceTemplate.__table__, template_rows),
+                            (DeviceAttr.__table__, attr_rows),
+                            (DeviceAttr.__table__, metadata_rows)):
+            for chunk in chunks(rows, BULK_INSERT_CHUNK):
+                db.session.execute(table.insert().values(chunk))
+        bump_generation(db.session)
+        db.session.commit()
+        LOGGER.debug(f" Created {len(template_rows)} templates in database")
+    except IntegrityError as e:
+        LOGGER.error(f' {e}')
+        raise HTTPRequestError(400, 'Template attribute constraints are violated by the request')
+
+    template_ids = [row['id'] for row in template_rows]
+    created = {orm_template.id: orm_template for orm_template in
+               db.session.query(DeviceTemplate).options(*template_load_options(None))
+               .filter(DeviceTemplate.id.in_(template_ids)).all()}
+    load_attr_trees(created.values(), db.session)
+    return [created[template_id] for template_id in template_ids if template_id in created]
+
 def refresh_template_update_column(db, template):
     if db.session.new or db.session.deleted:
         LOGGER.debug('The template structure has changed, refreshing "updated" column.')
@@ -82,7 +391,7 @@ class TemplateHandler():
         might be user-configurable too.
 
         :param params: Parameters received from request (page_number, per_page,
-        sort_by, attr, attr_type, label, attrs_format)
+        sort_by, attr, attr_type, label, attrs_format, fields, device_count)
         as created by Flask
         :param token: The authorization token (JWT).
         :return A JSON containing pagination information and the template list
@@ -96,6 +405,9 @@ class TemplateHandler():
         LOGGER.debug(f"... tenant context initialized.")
 
         pagination = {'page': params.get('page_number'), 'per_page': params.get('per_page'), 'error_out': False}
+        fields = parse_fields(params.get('fields'), TEMPLATE_FIELDS)
+        attrs_format = params.get('attrs_format')
+        load_options = template_load_options(fields)
 
         LOGGER.debug(f"Pagination configuration is {pagination}")
 
@@ -133,6 +445,7 @@ class TemplateHandler():
 
             # Always sort by DeviceTemplate.id
             page = db.session.query(DeviceTemplate) \
+                             .options(*load_options) \
                              .join(DeviceAttr, isouter=True) \
                              .filter(*parsed_query) \
                              .order_by(DeviceTemplate.id)
@@ -145,15 +458,16 @@ class TemplateHandler():
             page = paginate(page, **pagination)
         else:
             LOGGER.debug(f" Querying templates sorted by {sortBy}")
-            page = db.session.query(DeviceTemplate).order_by(sortBy).paginate(**pagination)
+            page = db.session.query(DeviceTemplate).options(*load_options) \
+                             .order_by(sortBy).paginate(**pagination)
+
+        load_template_attrs(page.items, fields, attrs_format)
+        templates = template_dump_schema(fields, attrs_format, many=True).dump(page.items)
 
-        templates = []
-        for template in page.items:
-            formatted_template = attr_format(params.get('attrs_format'), template_schema.dump(template))
-            LOGGER.debug(f"Adding resulting template to response...")
-            LOGGER.debug(f"Template is: {formatted_template['label']}")
-            templates.append(formatted_template)
-            LOGGER.debug(f"... template was added to response.")
+        if params.get('device_count'):
+            counts = device_counts([orm_template.id for orm_template in page.items])
+            for orm_template, json_template in zip(page.items, templates):
+                json_template['device_count'] = counts.get(orm_template.id, 0)
 
         result = {
             'pagination': {
@@ -190,23 +504,57 @@ class TemplateHandler():
         data_request = params.get('data')
         tpl, json_payload = parse_payload(content_type, data_request, template_schema)
 
-        loaded_template = DeviceTemplate(**tpl)
-        load_attrs(json_payload['attrs'], loaded_template, DeviceAttr, db)
-        db.session.add(loaded_template)
-
         try:
-            db.session.commit()
-            LOGGER.debug(f" Created template in database")
-        except IntegrityError as e:
-            LOGGER.error(f' {e}')
-            raise HTTPRequestError(400, 'Template attribute constraints are violated by the request')
+            tpl['attrs'] = [attr_schema.load(attr) for attr in json_payload.get('attrs', [])]
+        except ValidationError as errors:
+            results = {'message': 'failed to parse attr', 'errors': errors.messages}
+            raise HTTPRequestError(400, results)
+
+        # the template, its attributes and their metadata are inserted by
+        # three statements, instead of one (ORM flushed) INSERT per row
+        created = insert_templates([tpl])
 
         results = {
-            'template': template_schema.dump(loaded_template),
+            'template': template_schema.dump(created[0]),
             'result': 'ok'
         }
         return results
 
+    @staticmethod
+    def create_templates(params, token):
+        """
+        Creates a batch of templates.
+
+        Every template is validated before anything is written. Templates,
+        attributes and metadata are then inserted using multi-row INSERT
+        statements, all of them within a single transaction.
+
+        :param params: Parameters received from request (content_type, data)
+        as created by Flask
+        :param token: The authorization token (JWT).
+        :return The created templates, in request order.
+        :raises HTTPRequestError: If no authorization token was provided (no
+        tenant was informed)
+        :raises HTTPRequestError: If any template is invalid, in which case
+        none of them is created.
+        :raises HTTPRequestError: If template attribute constraints were
+        violated.
+        """
+        init_tenant_context(token, db)
+
+        payload = parse_json_object(params.get('content_type'), params.get('data'))
+        payloads = payload.get('templates')
+        if not isinstance(payloads, list) or not payloads:
+            raise HTTPRequestError(400, "Payload must contain a non-empty list of templates")
+
+        templates = load_template_batch(payloads)
+        created = insert_templates(templates)
+
+        return {
+            'templates': template_list_schema.dump(created),
+            'result': 'ok'
+        }
+
     @staticmethod
     def get_template(params, template_id, token):
         """
@@ -222,40 +570,162 @@ class TemplateHandler():
         database.
         """
         init_tenant_context(token, db)
-        tpl = assert_template_exists(template_id)
-        json_template = template_schema.dump(tpl)
-        attr_format(params.get('attr_format'), json_template)
-        return json_template
+        fields = parse_fields(params.get('fields'), TEMPLATE_FIELDS)
+        attrs_format = params.get('attrs_format')
+        tpl = assert_template_exists(template_id, options=template_load_options(fields))
+        load_template_attrs([tpl], fields, attrs_format)
+        return template_dump_schema(fields, attrs_format).dump(tpl)
 
     @staticmethod
-    def delete_all_templates(token):
+    def get_template_usage(template_id, token, with_ids=False, batch=USAGE_BATCH):
         """
-        Deletes all templates.
+        Fetches how many devices are associated with a template, straight from
+        the device_template index - no device is loaded at all.
 
+        :param template_id: The template whose usage is requested.
         :param token: The authorization token (JWT).
+        :param with_ids: Whether the ids of those devices are wanted as well.
+        :param batch: How many device ids are read by each query.
+        :return The usage summary (template_id, device_count) and, if with_ids
+        is set, a generator yielding the device ids (sorted) in lists of at
+        most batch ids - None otherwise.
+        :raises HTTPRequestError: If no authorization token was provided (no
+        tenant was informed)
         :raises HTTPRequestError: If this template could not be found in
         database.
         """
         init_tenant_context(token, db)
-        json_templates = []
+        template_id = parse_template_id(template_id)
+        assert_template_exists(template_id, options=template_load_options({}))
 
-        try:
-            templates = db.session.query(DeviceTemplate)
-            for template in templates:
-                db.session.delete(template)
-                json_templates.append(template_schema.dump(template))
+        usage = {
+            'template_id': template_id,
+            'device_count': device_counts([template_id]).get(template_id, 0)
+        }
+        if not with_ids:
+            return usage, None
+        return usage, iter_template_device_ids(template_id, batch)
+
+    @staticmethod
+    def delete_all_templates(token, verbose=False, batch=DELETE_BATCH):
+        """
+        Deletes all templates.
+
+        Whether any template is still used by devices is checked up front, by
+        a single query. Templates are then removed by set based deletes of (at
+        most) batch templates each, all of them within the same transaction.
+
+        :param token: The authorization token (JWT).
+        :param verbose: Whether the removed templates are to be returned in
+        full, instead of just their ids.
+        :param batch: How many templates are removed by each statement.
+        :raises HTTPRequestError: If no authorization token was provided (no
+        tenant was informed)
+        :raises HTTPRequestError: If any template is being currently used by
+        a device.
+        """
+        init_tenant_context(token, db)
 
+        in_use = [row[0] for row in db.session.query(DeviceTemplateMap.template_id).distinct().all()]
+        if in_use:
+            LOGGER.debug(f" Templates {in_use} are being used by devices")
+            raise HTTPRequestError(400, "Templates cannot be removed as they are being used by devices")
+
+        template_ids = [row[0] for row in
+                        db.session.query(DeviceTemplate.id).order_by(DeviceTemplate.id).all()]
+        removed = []
+        try:
+            for chunk in chunks(template_ids, batch):
+                if verbose:
+                    orm_templates = (db.session.query(DeviceTemplate)
+                                     .options(*template_load_options(None))
+                                     .filter(DeviceTemplate.id.in_(chunk))
+                                     .order_by(DeviceTemplate.id).all())
+                    load_attr_trees(orm_templates, db.session)
+                    removed.extend(template_list_schema.dump(orm_templates))
+                    # the removed templates must not linger in the session
+                    db.session.expunge_all()
+                    delete_templates(chunk)
+                else:
+                    removed.extend({'id': template_id} for template_id in delete_templates(chunk))
+
+            bump_generation(db.session)
             db.session.commit()
         except IntegrityError:
             raise HTTPRequestError(400, "Templates cannot be removed as they are being used by devices")
 
+        LOGGER.debug(f" Removed {len(template_ids)} templates")
         results = {
             'result': 'ok',
-            'removed': json_templates
+            'removed': removed
         }
 
         return results
 
+    @staticmethod
+    def clone_template(params, template_id, token):
+        """
+        Creates a copy of a template - its attributes and metadata included -
+        entirely inside the database.
+
+        :param params: Parameters received from request (content_type, data)
+        as created by Flask. The (optional) payload might set the label of
+        the copy, the labels of attributes to be left out ('exclude') and the
+        static values of copied attributes ('static_values').
+        :param template_id: The template to be copied.
+        :param token: The authorization token (JWT).
+        :return The created template.
+        :raises HTTPRequestError: If no authorization token was provided (no
+        tenant was informed)
+        :raises HTTPRequestError: If this template could not be found in
+        database.
+        :raises HTTPRequestError: If the requested edits are invalid.
+        """
+        init_tenant_context(token, db)
+        template_id = parse_template_id(template_id)
+
+        edits = {}
+        if params.get('data'):
+            edits = parse_json_object(params.get('content_type'), params.get('data'))
+
+        source = assert_template_exists(template_id, options=template_load_options({'label': frozenset()}))
+        label = edits.get('label', source.label)
+        excluded = edits.get('exclude', [])
+        static_values = edits.get('static_values', {})
+        if not isinstance(label, str) or not label:
+            raise HTTPRequestError(400, "Template label must be a non-empty string")
+        if not isinstance(excluded, list) or not isinstance(static_values, dict):
+            raise HTTPRequestError(400, "exclude must be a list and static_values an object")
+
+        labels = set(row[0] for row in
+                     db.session.query(DeviceAttr.label).filter(DeviceAttr.template_id == template_id).all())
+        unknown = (set(excluded) | set(static_values)) - labels
+        if unknown:
+            raise HTTPRequestError(400, "Unknown attributes: {}".format(', '.join(sorted(unknown))))
+        for attr_label, value in static_values.items():
+            if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+                raise HTTPRequestError(400, "Invalid static value for attribute {}".format(attr_label))
+            static_values[attr_label] = str(value)
+
+        try:
+            clone_id = db.session.execute(DeviceTemplate.__table__.insert()
+                                          .values(label=label, created=datetime.now())
+                                          .returning(DeviceTemplate.id)).scalar()
+            clone_attrs(template_id, clone_id, excluded, static_values)
+            bump_generation(db.session)
+            db.session.commit()
+            LOGGER.debug(f" Cloned template {template_id} into {clone_id}")
+        except IntegrityError as e:
+            LOGGER.error(f' {e}')
+            raise HTTPRequestError(400, 'Template attribute constraints are violated by the request')
+
+        clone = assert_template_exists(clone_id, options=template_load_options(None))
+        load_attr_trees([clone], db.session)
+        return {
+            'template': template_schema.dump(clone),
+            'result': 'ok'
+        }
+
     @staticmethod
     def remove_template(template_id, token):
         """
@@ -278,6 +748,7 @@ class TemplateHandler():
         json_template = template_schema.dump(tpl)
         try:
             db.session.delete(tpl)
+            bump_generation(db.session)
             db.session.commit()
         except IntegrityError:
             raise HTTPRequestError(400, "Templates cannot be removed as they are being used by devices")
@@ -305,7 +776,7 @@ class TemplateHandler():
         :raises HTTPRequestError: If this template could not be found in
         database.
         """
-        service = init_tenant_context(token, db)
+        init_tenant_context(token, db)
 
         content_type = params.get('content_type')
         data_request = params.get('data')
@@ -320,49 +791,51 @@ class TemplateHandler():
         old.label = updated['label']
 
         new = json_payload['attrs']
-        LOGGER.debug(f" Checking old template attributes")
-        def attrs_match(attr_from_db, attr_from_request):
-            return ((attr_from_db.label == attr_from_request["label"]) and
-              (attr_from_db.type == attr_from_request["type"]))
+        # metadata are validated along with their attributes
+        for attr in new:
+            attr_schema.load(attr)
 
+        LOGGER.debug(f" Checking old template attributes")
         def update_attr(attrs_from_db, attrs_from_request):
-            attrs_from_db.value_type = attrs_from_request.get('value_type', None)
-            attrs_from_db.static_value = attrs_from_request.get('static_value', None)
-
-        def validate_attr(attr_from_request, is_meta):
-            if is_meta is False:
-                attr_schema.load(attr_from_request)
-            else:
-                metaattr_schema.load(attr_from_request)
-
-        def analyze_attrs(attrs_from_db, attrs_from_request, parentAttr=None):
-            for attr_from_db in attrs_from_db:
-                found = False
-                for idx, attr_from_request in enumerate(attrs_from_request):
-                    validate_attr(attr_from_request, parentAttr is not None)
-                    if attrs_match(attr_from_db, attr_from_request):
-                        update_attr(attr_from_db, attr_from_request)
-                        if "metadata" in attr_from_request:
-                            analyze_attrs(attr_from_db.children, attr_from_request["metadata"], attr_from_db)
-                        attrs_from_request.pop(idx)
-                        found = True
-                        break
-                if not found:
-                    LOGGER.debug(f" Removing attribute {attr_from_db.label}")
-                    db.session.delete(attr_from_db)
-            if parentAttr and attrs_from_request is not None:
-                for attr_from_request in attrs_from_request:
+            value_type = attrs_from_request.get('value_type', None)
+            static_value = attrs_from_request.get('static_value', None)
+            changed = (attrs_from_db.value_type != value_type or
+                       attrs_from_db.static_value != (None if static_value is None else str(static_value)))
+            attrs_from_db.value_type = value_type
+            attrs_from_db.static_value = static_value
+            return changed
+
+        def analyze_attrs(attrs_from_db, attrs_from_request, changes, parentAttr=None):
+            matched, removed, added = diff_attrs(attrs_from_db, attrs_from_request)
+            for attr_from_db, attr_from_request in matched:
+                changed = update_attr(attr_from_db, attr_from_request)
+                metadata_changes = None
+                if "metadata" in attr_from_request:
+                    metadata_changes = AttrChanges(metaattr_schema)
+                    analyze_attrs(attr_from_db.children, attr_from_request["metadata"],
+                                  metadata_changes, attr_from_db)
+                if changed or metadata_changes:
+                    changes.changed.append((attr_from_db, metadata_changes))
+            for attr_from_db in removed:
+                LOGGER.debug(f" Removing attribute {attr_from_db.label}")
+                changes.removed.append(changes.schema.dump(attr_from_db))
+                db.session.delete(attr_from_db)
+            if parentAttr:
+                for attr_from_request in added:
                     orm_child = DeviceAttr(parent=parentAttr, **attr_from_request)
                     db.session.add(orm_child)
-            return attrs_from_request
+                    changes.added.append(orm_child)
+            return added
 
-        to_be_added = analyze_attrs(old.attrs, new)
+        changes = AttrChanges(attr_schema)
+        to_be_added = analyze_attrs(old.attrs, new, changes)
         for attr in to_be_added:
             LOGGER.debug(f" Adding new attribute {attr}")
             if "id" in attr:
                 del attr["id"]
             child = DeviceAttr(template=old, **attr)
             db.session.add(child)
+            changes.added.append(child)
             if "metadata" in attr and attr["metadata"] is not None:
                 for metadata in attr["metadata"]:
                     LOGGER.debug(f" Adding new metadata {metadata}")
@@ -371,41 +844,63 @@ class TemplateHandler():
         try:
             LOGGER.debug(f" Commiting new data...")
             refresh_template_update_column(db, old)
+            bump_generation(db.session)
+            db.session.flush()
+
+            # notify interested parties that a set of devices might have been
+            # implicitly updated - off this request, as they may be many. The
+            # job doing so is committed along with the update, so that it is
+            # never lost once the update is; it reads the affected devices
+            # itself.
+            updated = template_schema.dump(old)
+            # in compact mode, only the attribute changes are published
+            diff = changes.to_json() if CONFIG.template_update_mode == 'compact' else None
+            fanout = fanout_job(template_id, updated, token, diff=diff)
+            fanout_json = serialize_job(fanout)
+            db.session.add(fanout)
+
             db.session.commit()
             LOGGER.debug("... data committed.")
         except IntegrityError as error:
             LOGGER.debug(f"  ConsistencyException was thrown.")
             handle_consistency_exception(error)
 
-        # notify interested parties that a set of devices might have been implicitly updated
-        affected = db.session.query(DeviceTemplateMap) \
-                             .filter(DeviceTemplateMap.template_id==template_id) \
-                             .all()
-
-        affected_devices = []
-        
-        kafka_handler_instance = cls.kafka.getInstance(cls.kafka.kafkaNotifier)
-        for device in affected:
-            orm_device = assert_device_exists(device.device_id)
-            kafka_handler_instance.update(serialize_full_device(orm_device, service), meta={"service": service})
-            affected_devices.append(device.device_id)
-
-        event = {
-            "event": DeviceEvent.TEMPLATE,
-            "data": {
-                "affected": affected_devices,
-                "template": template_schema.dump(old)
-            },
-            "meta": {"service": service}
-        }
-        kafka_handler_instance.kafkaNotifier.send_raw(event, service)
-
         results = {
-            'updated': template_schema.dump(old),
-            'result': 'ok'
+            'updated': updated,
+            'result': 'ok',
+            'fanout': fanout_json
         }
         return results
 
+    @staticmethod
+    def get_fanout(task_id, token):
+        """
+        Fetches the progress of the publication of the device updates implied
+        by a template update.
+
+        :param task_id: The fan-out job, as returned by the template update.
+        :param token: The authorization token (JWT).
+        :return The job status and progress
+        :rtype JSON
+        :raises HTTPRequestError: If there is no such fan-out job.
+        """
+        return JobHandler.get_job(task_id, token, kind=FANOUT_JOB)
+
+
+@register_job('template.create_batch')
+def run_create_templates(params, token, progress):
+    return TemplateHandler.create_templates(params, token)
+
+
+@register_job('template.update')
+def run_update_template(params, token, progress):
+    return TemplateHandler.update_template(params, params['template_id'], token)
+
+
+@register_job('template.delete_all')
+def run_delete_all_templates(params, token, progress):
+    return TemplateHandler.delete_all_templates(token, params.get('verbose', False))
+
 
 @template.route('/template', methods=['GET'])
 def flask_get_templates():
@@ -423,7 +918,9 @@ def flask_get_templates():
             'attr': request.args.getlist('attr'),
             'attr_type': request.args.getlist('attr_type'),
             'label': request.args.get('label', None),
-            'attrs_format': request.args.get('attr_format', 'both')
+            'attrs_format': request.args.get('attr_format', 'both'),
+            'fields': request.args.get('fields', None),
+            'device_count': request.args.get('device_count', 'false').lower() in ['true', '1', '']
         }
 
         result = TemplateHandler.get_templates(params, token)
@@ -473,6 +970,35 @@ def flask_create_template():
         return format_response(error.error_code, error.message)
 
 
+@template.route('/template/batch', methods=['POST'])
+def flask_create_templates():
+    try:
+        # retrieve the authorization token
+        token = retrieve_auth_token(request)
+
+        params = {
+            'content_type': request.headers.get('Content-Type'),
+            'data': request.data
+        }
+
+        if is_async(request):
+            result = JobHandler.submit('template.create_batch', params, token)
+            LOGGER.info(f"Template batch creation submitted as job {result['job']['id']}")
+            return make_response(jsonify(result), 202)
+
+        result = TemplateHandler.create_templates(params, token)
+
+        LOGGER.info(f"Created {len(result['templates'])} templates")
+
+        return make_response(jsonify(result), 200)
+
+    except HTTPRequestError as error:
+        LOGGER.error(f" {error}")
+        if isinstance(error.message, dict):
+            return make_response(jsonify(error.message), error.error_code)
+        return format_response(error.error_code, error.message)
+
+
 @template.route('/template', methods=['DELETE'])
 def flask_delete_all_templates():
 
@@ -480,7 +1006,13 @@ def flask_delete_all_templates():
         # retrieve the authorization token
         token = retrieve_auth_token(request)
 
-        result = TemplateHandler.delete_all_templates(token)
+        verbose = request.args.get('verbose', 'false').lower() in ['true', '1']
+        if is_async(request):
+            result = JobHandler.submit('template.delete_all', {'verbose': verbose}, token)
+            LOGGER.info(f"Removal of all templates submitted as job {result['job']['id']}")
+            return make_response(jsonify(result), 202)
+
+        result = TemplateHandler.delete_all_templates(token, verbose)
 
         LOGGER.info(f"deleting all templates")
 
@@ -493,13 +1025,31 @@ def flask_delete_all_templates():
         return format_response(error.error_code, error.message)
 
 
+@template.route('/template/fanout/<task_id>', methods=['GET'])
+def flask_get_fanout(task_id):
+    try:
+        # retrieve the authorization token
+        token = retrieve_auth_token(request)
+
+        result = TemplateHandler.get_fanout(task_id, token)
+        return make_response(jsonify(result), 200)
+    except HTTPRequestError as e:
+        LOGGER.error(f" {e}")
+        if isinstance(e.message, dict):
+            return make_response(jsonify(e.message), e.error_code)
+        return format_response(e.error_code, e.message)
+
+
 @template.route('/template/<template_id>', methods=['GET'])
 def flask_get_template(template_id):
     try:
         # retrieve the authorization token
         token = retrieve_auth_token(request)
 
-        params = {'attrs_format': request.args.get('attr_format', 'both')}
+        params = {
+            'attrs_format': request.args.get('attr_format', 'both'),
+            'fields': request.args.get('fields', None)
+        }
 
         result = TemplateHandler.get_template(params, template_id, token)
         LOGGER.info(f"Getting template with id: {template_id}")
@@ -515,6 +1065,63 @@ def flask_get_template(template_id):
         return format_response(e.error_code, e.message)
 
 
+@template.route('/template/<template_id>/clone', methods=['POST'])
+def flask_clone_template(template_id):
+    try:
+        # retrieve the authorization token
+        token = retrieve_auth_token(request)
+
+        params = {
+            'content_type': request.headers.get('Content-Type'),
+            'data': request.data
+        }
+
+        result = TemplateHandler.clone_template(params, template_id, token)
+        LOGGER.info(f"Cloning template with id: {template_id}")
+        return make_response(jsonify(result), 200)
+    except HTTPRequestError as e:
+        LOGGER.error(f" {e.message}")
+        if isinstance(e.message, dict):
+            return make_response(jsonify(e.message), e.error_code)
+        return format_response(e.error_code, e.message)
+
+
+@template.route('/template/<template_id>/usage', methods=['GET'])
+def flask_get_template_usage(template_id):
+    """
+    Reports how many devices use a template and, if ids is set, streams the
+    ids of those devices.
+    """
+    try:
+        # retrieve the authorization token
+        token = retrieve_auth_token(request)
+
+        with_ids = request.args.get('ids', 'false').lower() in ['true', '1', '']
+        usage, device_ids = TemplateHandler.get_template_usage(template_id, token, with_ids)
+        LOGGER.info(f"Getting usage of template with id: {template_id}")
+
+        if device_ids is None:
+            return make_response(jsonify(usage), 200)
+
+        def generate():
+            yield '{{"template_id": {}, "device_count": {}, "devices": ['.format(
+                usage['template_id'], usage['device_count'])
+            separator = ''
+            for batch in device_ids:
+                for device_id in batch:
+                    yield separator + json.dumps(device_id)
+                    separator = ', '
+            yield ']}'
+
+        return Response(stream_with_context(generate()), status=200,
+                        mimetype='application/json')
+    except HTTPRequestError as e:
+        LOGGER.error(f" {e.message}")
+        if isinstance(e.message, dict):
+            return make_response(jsonify(e.message), e.error_code)
+        return format_response(e.error_code, e.message)
+
+
 @template.route('/template/<template_id>', methods=['DELETE'])
 def flask_remove_template(template_id):
     try:
@@ -546,6 +1153,12 @@ def flask_update_template(template_id):
             'data': request.data
         }
 
+        if is_async(request):
+            params['template_id'] = template_id
+            result = JobHandler.submit('template.update', params, token)
+            LOGGER.info(f"Update of template {template_id} submitted as job {result['job']['id']}")
+            return make_response(jsonify(result), 202)
+
         result = TemplateHandler.update_template(params, template_id, token)
         LOGGER.info(f"Updating template with id: {template_id}")
         return make_response(jsonify(result), 200)
@@ -6,60 +6,152 @@ from sqlalchemy.sql import exists, select, text, column
 from DeviceManager.utils import HTTPRequestError, decode_base64, get_allowed_service
 from .app import app
 
-def install_triggers(db, tenant, session=None):
-    query = """
-        SET search_path to {tenant};
-        -- template update/creation checks
-
-        CREATE FUNCTION validate_device_attrs() returns trigger as $$
-        DECLARE
-          conflict_count int;
-        BEGIN
-          conflict_count := (
-            select count(*) from attrs as a
-            left join device_template as dt on a.template_id = dt.template_id
-            left join devices as d on d.id = dt.device_id
-            where dt.template_id != NEW.template_id and
-                  dt.device_id in (select device_id from device_template where template_id = NEW.template_id) and
-                  a.label = NEW.label and a.type = NEW.type
-          );
-          IF (conflict_count != 0) THEN
-            RAISE 'Attribute % (%) has standing conflicts', NEW.label, NEW.id using ERRCODE = 'unique_violation';
-          END IF;
-          RETURN NEW;
-        END;
-        $$ language plpgsql;
-
-        CREATE TRIGGER validate_device_attrs_trigger BEFORE INSERT OR UPDATE ON attrs
-        FOR EACH ROW EXECUTE PROCEDURE validate_device_attrs();
-
-        -- template assignment checks
-
-        CREATE FUNCTION validate_device() returns trigger as $$
-        DECLARE
-          conflict_count int;
-        BEGIN
-          conflict_count := (
-            select count(*) from (
-              select * from attrs as attr
-              inner join device_template as dt on attr.template_id = dt.template_id
-              where dt.device_id = NEW.device_id
-            ) as curr
-            inner join attrs as nattrs on curr.label = nattrs.label and curr.type = nattrs.type and nattrs.template_id = NEW.template_id
-          );
-          IF (conflict_count != 0) THEN
-            RAISE 'Template (%) cannot be added to device (%) as it has standing attribute conflicts', NEW.template_id, NEW.device_id
-            using ERRCODE = 'unique_violation';
-          END IF;
-          RETURN NEW;
-        END;
-        $$ language plpgsql;
-
-        CREATE TRIGGER validate_device_trigger BEFORE INSERT OR UPDATE ON device_template
-        FOR EACH ROW EXECUTE PROCEDURE validate_device();
-    """.format(tenant=tenant)
+# Every conflict trigger ever installed, so that (re)installing is idempotent
+DROP_TRIGGERS = """
+    DROP TRIGGER IF EXISTS validate_device_attrs_trigger ON attrs;
+    DROP TRIGGER IF EXISTS validate_device_attrs_insert_trigger ON attrs;
+    DROP TRIGGER IF EXISTS validate_device_attrs_update_trigger ON attrs;
+    DROP TRIGGER IF EXISTS validate_device_trigger ON device_template;
+    DROP TRIGGER IF EXISTS validate_device_insert_trigger ON device_template;
+    DROP TRIGGER IF EXISTS validate_device_update_trigger ON device_template;
+"""
+
+# Checks each written row on its own (PostgreSQL < 10)
+ROW_TRIGGERS = """
+    -- template update/creation checks
+
+    CREATE OR REPLACE FUNCTION validate_device_attrs() returns trigger as $$
+    DECLARE
+      conflict_count int;
+    BEGIN
+      conflict_count := (
+        select count(*) from attrs as a
+        left join device_template as dt on a.template_id = dt.template_id
+        left join devices as d on d.id = dt.device_id
+        where dt.template_id != NEW.template_id and
+              dt.device_id in (select device_id from device_template where template_id = NEW.template_id) and
+              a.label = NEW.label and a.type = NEW.type
+      );
+      IF (conflict_count != 0) THEN
+        RAISE 'Attribute % (%) has standing conflicts', NEW.label, NEW.id using ERRCODE = 'unique_violation';
+      END IF;
+      RETURN NEW;
+    END;
+    $$ language plpgsql;
+
+    CREATE TRIGGER validate_device_attrs_trigger BEFORE INSERT OR UPDATE ON attrs
+    FOR EACH ROW EXECUTE PROCEDURE validate_device_attrs();
+
+    -- template assignment checks
+
+    CREATE OR REPLACE FUNCTION validate_device() returns trigger as $$
+    DECLARE
+      conflict_count int;
+    BEGIN
+      conflict_count := (
+        select count(*) from (
+          select * from attrs as attr
+          inner join device_template as dt on attr.template_id = dt.template_id
+          where dt.device_id = NEW.device_id
+        ) as curr
+        inner join attrs as nattrs on curr.label = nattrs.label and curr.type = nattrs.type and nattrs.template_id = NEW.template_id
+      );
+      IF (conflict_count != 0) THEN
+        RAISE 'Template (%) cannot be added to device (%) as it has standing attribute conflicts', NEW.template_id, NEW.device_id
+        using ERRCODE = 'unique_violation';
+      END IF;
+      RETURN NEW;
+    END;
+    $$ language plpgsql;
+
+    CREATE TRIGGER validate_device_trigger BEFORE INSERT OR UPDATE ON device_template
+    FOR EACH ROW EXECUTE PROCEDURE validate_device();
+"""
+
+# Checks all the rows written by a statement at once, using transition
+# tables (PostgreSQL >= 10). As a trigger using transition tables may only
+# fire on a single event, inserts and updates get a trigger each.
+STATEMENT_TRIGGERS = """
+    -- template update/creation checks
+
+    CREATE OR REPLACE FUNCTION validate_device_attrs_batch() returns trigger as $$
+    DECLARE
+      conflict record;
+    BEGIN
+      select n.label, n.id into conflict
+      from new_attrs as n
+      inner join device_template as own on own.template_id = n.template_id
+      inner join device_template as dt on dt.device_id = own.device_id and dt.template_id != n.template_id
+      inner join attrs as a on a.template_id = dt.template_id and a.label = n.label and a.type = n.type
+      limit 1;
+      IF FOUND THEN
+        RAISE 'Attribute % (%) has standing conflicts', conflict.label, conflict.id using ERRCODE = 'unique_violation';
+      END IF;
+      RETURN NULL;
+    END;
+    $$ language plpgsql;
+
+    CREATE TRIGGER validate_device_attrs_insert_trigger AFTER INSERT ON attrs
+    REFERENCING NEW TABLE AS new_attrs
+    FOR EACH STATEMENT EXECUTE PROCEDURE validate_device_attrs_batch();
+
+    CREATE TRIGGER validate_device_attrs_update_trigger AFTER UPDATE ON attrs
+    REFERENCING NEW TABLE AS new_attrs
+    FOR EACH STATEMENT EXECUTE PROCEDURE validate_device_attrs_batch();
+
+    -- template assignment checks
+
+    CREATE OR REPLACE FUNCTION validate_device_batch() returns trigger as $$
+    DECLARE
+      conflict record;
+    BEGIN
+      select n.device_id, n.template_id into conflict
+      from new_links as n
+      inner join device_template as dt on dt.device_id = n.device_id and dt.template_id != n.template_id
+      inner join attrs as curr on curr.template_id = dt.template_id
+      inner join attrs as nattrs on nattrs.template_id = n.template_id and nattrs.label = curr.label and nattrs.type = curr.type
+      limit 1;
+      IF FOUND THEN
+        RAISE 'Template (%) cannot be added to device (%) as it has standing attribute conflicts', conflict.template_id, conflict.device_id
+        using ERRCODE = 'unique_violation';
+      END IF;
+      RETURN NULL;
+    END;
+    $$ language plpgsql;
+
+    CREATE TRIGGER validate_device_insert_trigger AFTER INSERT ON device_template
+    REFERENCING NEW TABLE AS new_links
+    FOR EACH STATEMENT EXECUTE PROCEDURE validate_device_batch();
+
+    CREATE TRIGGER validate_device_update_trigger AFTER UPDATE ON device_template
+    REFERENCING NEW TABLE AS new_links
+    FOR EACH STATEMENT EXECUTE PROCEDURE validate_device_batch();
+"""
+
+def supports_transition_tables(session):
+    """ Whether the database server supports REFERENCING NEW TABLE (10+) """
+    version = session.execute("SHOW server_version_num").scalar()
+    try:
+        return int(version) >= 100000
+    except (TypeError, ValueError):
+        return False
+
+def install_triggers(db, tenant, session=None, statement_level=None):
+    """
+    Installs (or reinstalls) the triggers that keep devices from having two
+    attributes with the same label and type.
+
+    :param statement_level: Whether to validate each statement at once, using
+    transition tables, or each row on its own. By default, statement level
+    triggers are used whenever the server supports them.
+    """
     if session is None:
         session = db.session
+    if statement_level is None:
+        statement_level = supports_transition_tables(session)
+
+    query = "SET search_path to {tenant};".format(tenant=tenant) + DROP_TRIGGERS
+    query += STATEMENT_TRIGGERS if statement_level else ROW_TRIGGERS
     session.execute(query)
     session.commit()
 
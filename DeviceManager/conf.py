@@ -18,7 +18,17 @@ class Config(object):
                  device_subject="device-data",
                  status_timeout="5",
                  create_db=True,
-                 log_level="INFO"):
+                 log_level="INFO",
+                 query_cache_size="256",
+                 compression_min_size="1024",
+                 compression_level="6",
+                 json_backend="auto",
+                 template_update_mode="full",
+                 template_event_chunk="1000",
+                 job_workers="2",
+                 job_poll_interval="5",
+                 job_lease="60",
+                 job_max_attempts="3"):
         # Postgres configuration data
         self.dbname = os.environ.get('DBNAME', db)
         self.dbhost = os.environ.get('DBHOST', dbhost)
@@ -42,6 +52,31 @@ class Config(object):
         self.device_subject = os.environ.get('DEVICE_SUBJECT', device_subject)
         self.status_timeout = int(os.environ.get('STATUS_TIMEOUT', status_timeout))
 
+        # Maximum number of listing results kept in memory (0 disables caching)
+        self.query_cache_size = int(os.environ.get('QUERY_CACHE_SIZE', query_cache_size))
+
+        # Responses smaller than this (in bytes) are not compressed (negative disables compression)
+        self.compression_min_size = int(os.environ.get('COMPRESSION_MIN_SIZE', compression_min_size))
+        self.compression_level = int(os.environ.get('COMPRESSION_LEVEL', compression_level))
+
+        # JSON encoder used for responses and notifications: auto, orjson or json
+        self.json_backend = os.environ.get('JSON_BACKEND', json_backend)
+
+        # How template updates are published: full (an update event per affected
+        # device) or compact (template.update events carrying only the changes)
+        self.template_update_mode = os.environ.get('TEMPLATE_UPDATE_MODE', template_update_mode)
+        # Maximum number of device ids in each compact template.update event
+        self.template_event_chunk = int(os.environ.get('TEMPLATE_EVENT_CHUNK', template_event_chunk))
+
+        # Threads of the job process (DeviceManager.JobWorker) running asynchronous jobs
+        self.job_workers = int(os.environ.get('JOB_WORKERS', job_workers))
+        # Seconds between scans for pending jobs
+        self.job_poll_interval = float(os.environ.get('JOB_POLL_INTERVAL', job_poll_interval))
+        # Seconds a claimed job is leased for (renewed while it runs), and how
+        # many times a job whose lease expired is claimed before being failed
+        self.job_lease = float(os.environ.get('JOB_LEASE', job_lease))
+        self.job_max_attempts = int(os.environ.get('JOB_MAX_ATTEMPTS', job_max_attempts))
+
         # crypto configuration
         if not os.environ.get('DEV_MNGR_CRYPTO_PASS'):
            raise Exception("environment variable 'DEV_MNGR_CRYPTO_PASS' not configured")
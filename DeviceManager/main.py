@@ -9,6 +9,8 @@ import DeviceManager.TemplateHandler
 import DeviceManager.LoggerHandler
 import DeviceManager.ImportHandler
 import DeviceManager.ErrorManager
+import DeviceManager.MetricsHandler
+import DeviceManager.Compression
 
 from .DatabaseHandler import db
 from .TenancyManager import list_tenants
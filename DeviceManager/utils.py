@@ -2,7 +2,8 @@
 import base64
 import json
 import random
-from flask import make_response, jsonify
+from flask import make_response
+from DeviceManager.JsonEncoder import jsonify
 from Crypto.Cipher import AES
 
 from DeviceManager.conf import CONFIG
@@ -81,6 +82,20 @@ def get_allowed_service(token):
     except Exception as ex:
         raise ValueError("Invalid authentication token payload - not json object", ex)
 
+def claims_token(claims):
+    """
+        Builds an (unsigned) token carrying only the given claims, so that
+        operations performed apart from the request that asked for them (see
+        JobHandler) need not keep the request token around.
+
+        :param claims: The claims to be carried, as a dict
+        :returns: A token get_allowed_service is able to parse
+    """
+    def encode(data):
+        return base64.b64encode(json.dumps(data).encode()).decode().rstrip('=')
+
+    return '{}.{}.'.format(encode({'alg': 'none', 'typ': 'JWT'}), encode(claims))
+
 def encrypt(plain_text):
     # plain_text is padded so its length is multiple of cipher block size
     plain_text_pad = pad(plain_text)
@@ -0,0 +1,63 @@
+"""
+    Compares the creation of many devices through the bulk path (a single
+    request with ?count=N) against creating them one at a time (the per-device
+    path every device used to take).
+
+    Usage: python -m benchmarks.bulk_device_creation [devices] [sample]
+
+    The per-device path is measured on a sample and extrapolated to the full
+    number of devices. See benchmarks/common.py for the requirements.
+"""
+import json
+import sys
+import time
+
+from DeviceManager.DeviceHandler import DeviceHandler
+from DeviceManager.TemplateHandler import TemplateHandler
+
+from .common import make_token, tenant_context, clear_devices, timed
+
+
+def create_template(token, attrs=10):
+    data = json.dumps({
+        'label': 'benchmark sensor',
+        'attrs': [{'label': 'attr-{}'.format(i), 'type': 'static', 'value_type': 'string',
+                   'static_value': 'value'} for i in range(attrs)]
+    })
+    params = {'content_type': 'application/json', 'data': data}
+    return TemplateHandler.create_template(params, token)['template']
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    sample = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    token = make_token()
+
+    with tenant_context(token):
+        clear_devices()
+        template = create_template(token)
+        data = json.dumps({
+            'label': 'sensor',
+            'templates': [template['id']],
+            'attrs': [{'id': template['attrs'][0]['id'], 'label': 'attr-0',
+                       'template_id': str(template['id']), 'static_value': 'overridden'}]
+        })
+        params = {'count': '1', 'verbose': 'false', 'content_type': 'application/json', 'data': data}
+
+        start = time.perf_counter()
+        for _ in range(sample):
+            DeviceHandler.create_device(params, token)
+        per_device = (time.perf_counter() - start) / sample
+        print('{:40} {:9.3f} s  (extrapolated from {} devices)'.format(
+            'one device at a time ({})'.format(count), per_device * count, sample))
+        clear_devices()
+
+        with timed('bulk ?count={}'.format(count), count):
+            DeviceHandler.create_device(dict(params, count=str(count)), token)
+        clear_devices()
+
+        TemplateHandler.remove_template(template['id'], token)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+    Helpers shared by the benchmarks.
+
+    Benchmarks that touch the database need a PostgreSQL server reachable
+    with the usual settings (DBHOST, DBUSER, DBPASS, ...). They run on a
+    dedicated tenant, so existing data is never modified. Kafka notifications
+    are discarded, so that only the service itself is measured.
+"""
+import base64
+import json
+import time
+from contextlib import contextmanager
+from unittest.mock import MagicMock, patch
+
+from DeviceManager.app import app
+from DeviceManager.BackendHandler import KafkaInstanceHandler
+from DeviceManager.DatabaseHandler import db
+from DeviceManager.TenancyManager import init_tenant_context
+
+TENANT = 'benchmark'
+
+
+def make_token(service=TENANT):
+    """ Builds an (unsigned) authorization token for the given tenant """
+    payload = json.dumps({'service': service, 'username': 'benchmark'}).encode()
+    return 'Bearer {}.{}.{}'.format(base64.b64encode(b'model').decode(),
+                                    base64.b64encode(payload).decode(),
+                                    base64.b64encode(b'signature').decode())
+
+
+@contextmanager
+def tenant_context(token):
+    """ Request context bound to the benchmark tenant, without Kafka """
+    with app.test_request_context(headers={'Authorization': token}):
+        init_tenant_context(token, db)
+        with patch.object(KafkaInstanceHandler, 'getInstance', return_value=MagicMock()):
+            yield
+
+
+def clear_devices():
+    db.session.execute("DELETE FROM overrides; DELETE FROM pre_shared_keys; "
+                       "DELETE FROM device_template; DELETE FROM devices;")
+    db.session.commit()
+
+
+@contextmanager
+def timed(label, items=None):
+    start = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - start
+    if items:
+        print('{:40} {:9.3f} s  {:10.1f} items/s'.format(label, elapsed, items / elapsed))
+    else:
+        print('{:40} {:9.3f} s'.format(label, elapsed))
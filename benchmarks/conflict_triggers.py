@@ -0,0 +1,76 @@
+"""
+    Compares the attribute conflict triggers checking each written row on its
+    own against the ones checking each statement at once (through transition
+    tables, which require PostgreSQL 10 or later).
+
+    Usage: python -m benchmarks.conflict_triggers [devices] [attrs]
+
+    Measures a single statement associating a template with every device
+    (one device_template row per device) and one adding attrs attributes to
+    a template used by every device. See benchmarks/common.py for the
+    requirements.
+"""
+import json
+import sys
+
+from DeviceManager.DatabaseHandler import db
+from DeviceManager.DeviceHandler import DeviceHandler
+from DeviceManager.TemplateHandler import TemplateHandler
+from DeviceManager.TenancyManager import install_triggers, supports_transition_tables
+
+from .common import TENANT, make_token, tenant_context, clear_devices, timed
+
+
+def create_template(token, label, attrs=10):
+    data = json.dumps({
+        'label': label,
+        'attrs': [{'label': '{}-{}'.format(label, i), 'type': 'dynamic', 'value_type': 'float'}
+                  for i in range(attrs)]
+    })
+    params = {'content_type': 'application/json', 'data': data}
+    return TemplateHandler.create_template(params, token)['template']['id']
+
+
+def run(label, devices, attrs, base_id, extra_id):
+    with timed('{}: link {} devices'.format(label, devices), devices):
+        db.session.execute("INSERT INTO device_template (device_id, template_id) "
+                           "SELECT id, :template FROM devices", {'template': extra_id})
+    with timed('{}: add {} attributes'.format(label, attrs), attrs):
+        db.session.execute("INSERT INTO attrs (id, label, type, value_type, template_id, created) "
+                           "SELECT nextval('attr_id'), 'new-' || i, 'dynamic', 'float', :template, now() "
+                           "FROM generate_series(1, :count) AS i",
+                           {'template': base_id, 'count': attrs})
+    # keep every run starting from the same state
+    db.session.rollback()
+
+
+def main():
+    devices = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    attrs = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    token = make_token()
+
+    with tenant_context(token):
+        clear_devices()
+        base_id = create_template(token, 'base')
+        extra_id = create_template(token, 'extra')
+        params = {'count': str(devices), 'verbose': 'false', 'content_type': 'application/json',
+                  'data': json.dumps({'label': 'sensor', 'templates': [base_id]})}
+        DeviceHandler.create_device(params, token)
+
+        install_triggers(db, TENANT, statement_level=False)
+        run('row level', devices, attrs, base_id, extra_id)
+
+        if supports_transition_tables(db.session):
+            install_triggers(db, TENANT, statement_level=True)
+            run('statement level', devices, attrs, base_id, extra_id)
+        else:
+            print('statement level triggers require PostgreSQL 10 or later')
+
+        install_triggers(db, TENANT)
+        clear_devices()
+        TemplateHandler.remove_template(base_id, token)
+        TemplateHandler.remove_template(extra_id, token)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+    Compares the JSON encoders available to the service on realistic device
+    documents (as produced by serialize_full_device).
+
+    Usage: python -m benchmarks.json_encoding [devices] [repetitions]
+"""
+import sys
+import timeit
+from datetime import datetime
+
+from DeviceManager import JsonEncoder
+
+
+def build_devices(count, attrs_per_template=10):
+    devices = []
+    now = datetime.now().isoformat()
+    for i in range(count):
+        attrs = {}
+        for template_id in (1, 2):
+            attrs[template_id] = [{
+                'id': template_id * 100 + j,
+                'label': 'attr-{}'.format(j),
+                'type': 'dynamic' if j % 2 else 'static',
+                'value_type': 'float',
+                'static_value': '' if j % 2 else 'value-{}'.format(j),
+                'is_static_overridden': False,
+                'template_id': str(template_id),
+                'created': now,
+                'metadata': [{'id': 1000 + j, 'label': 'unit', 'type': 'meta',
+                              'value_type': 'string', 'static_value': 'celsius'}]
+            } for j in range(attrs_per_template)]
+        devices.append({
+            'id': '%05x' % i,
+            'label': 'device-{}'.format(i),
+            'created': datetime.now(),
+            'templates': [1, 2],
+            'attrs': attrs
+        })
+    return {'devices': devices, 'pagination': {'page': 1, 'total': 1, 'has_next': False}}
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    payload = build_devices(count)
+
+    backends = [('json', JsonEncoder.stdlib_dumps)]
+    if JsonEncoder.orjson is not None:
+        backends.append(('orjson', JsonEncoder.orjson_dumps))
+    else:
+        print('orjson is not installed, only the standard encoder is measured')
+
+    baseline = None
+    for name, dumps in backends:
+        elapsed = min(timeit.repeat(lambda: dumps(payload), number=repetitions, repeat=3))
+        per_call = elapsed / repetitions * 1000
+        baseline = baseline or per_call
+        print('{:8} {:9.3f} ms/listing  {:8d} bytes  x{:.1f}'.format(
+            name, per_call, len(dumps(payload)), baseline / per_call))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+    Counts the statements sent to the database (round trips) to create a
+    single template, flushing it through the ORM (one INSERT per attribute
+    and metadata, save for those psycopg2 batches) against the multi-row
+    INSERTs TemplateHandler.create_template issues.
+
+    Usage: python -m benchmarks.template_creation [attrs]
+
+    Every attribute of the template has a metadata attribute. See
+    benchmarks/common.py for the requirements.
+"""
+import json
+import sys
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from DeviceManager.DatabaseHandler import db
+from DeviceManager.DatabaseModels import DeviceTemplate, DeviceAttr
+from DeviceManager.QueryCache import bump_generation
+from DeviceManager.SerializationModels import load_attrs
+from DeviceManager.TemplateHandler import TemplateHandler
+
+from .common import make_token, tenant_context, timed
+
+
+@contextmanager
+def counted(label):
+    """ Prints how many statements were sent to the database within the block """
+    engine = db.get_engine()
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        yield
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+        print('{:40} {:9d} statements'.format(label, len(statements)))
+
+
+def template_payload(label, attrs):
+    return {
+        'label': label,
+        'attrs': [{'label': 'attr-{}'.format(i), 'type': 'dynamic', 'value_type': 'float',
+                   'metadata': [{'label': 'unit', 'type': 'meta', 'value_type': 'string',
+                                 'static_value': 'C'}]}
+                  for i in range(attrs)]
+    }
+
+
+def create_orm_template(payload):
+    orm_template = DeviceTemplate(label=payload['label'])
+    load_attrs(payload['attrs'], orm_template, DeviceAttr, db)
+    db.session.add(orm_template)
+    bump_generation(db.session)
+    db.session.commit()
+    return orm_template.id
+
+
+def main():
+    attrs = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    token = make_token()
+
+    with tenant_context(token):
+        payload = template_payload('orm', attrs)
+        with counted('orm flush: {} attributes'.format(attrs)), \
+                timed('orm flush: {} attributes'.format(attrs), attrs):
+            orm_id = create_orm_template(payload)
+
+        params = {'content_type': 'application/json',
+                  'data': json.dumps(template_payload('insert', attrs))}
+        with counted('create_template: {} attributes'.format(attrs)), \
+                timed('create_template: {} attributes'.format(attrs), attrs):
+            insert_id = TemplateHandler.create_template(params, token)['template']['id']
+
+        TemplateHandler.remove_template(orm_id, token)
+        TemplateHandler.remove_template(insert_id, token)
+
+
+if __name__ == '__main__':
+    main()
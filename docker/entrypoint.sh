@@ -52,6 +52,9 @@ if [ ${command} = 'start' ]; then
             retries=$((retries + 1))
         fi
     done
+elif [ ${command} = 'jobs' ] ; then
+    python docker/waitForDb.py -w 5 -r 5 || exit 1
+    exec python -m DeviceManager.JobWorker
 elif [ ${command} = 'migrate' ] ; then
     migrate
 elif [ ${command} = '020_stamp' ] ; then
@@ -0,0 +1,29 @@
+"""tenant write generation
+
+Revision ID: 3c1d2f7a9b40
+Revises: fabf2ca39860
+Create Date: 2026-10-19 09:12:41.203518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c1d2f7a9b40'
+down_revision = 'fabf2ca39860'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('write_generation',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('generation', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.execute("INSERT INTO write_generation (id, generation) VALUES (1, 0)")
+
+
+def downgrade():
+    op.drop_table('write_generation')
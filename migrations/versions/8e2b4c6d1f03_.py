@@ -0,0 +1,26 @@
+"""device id sequence
+
+Revision ID: 8e2b4c6d1f03
+Revises: 3c1d2f7a9b40
+Create Date: 2026-10-19 11:02:17.482913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e2b4c6d1f03'
+down_revision = '3c1d2f7a9b40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # covers the whole 24 bit device id space (see DeviceManager.IdAllocator)
+    op.execute(sa.schema.CreateSequence(sa.Sequence('device_id', start=0, minvalue=0,
+                                                    maxvalue=16777215)))
+
+
+def downgrade():
+    op.execute(sa.schema.DropSequence(sa.Sequence('device_id')))
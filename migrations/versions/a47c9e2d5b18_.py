@@ -0,0 +1,30 @@
+"""unique device attribute overrides
+
+Revision ID: a47c9e2d5b18
+Revises: 8e2b4c6d1f03
+Create Date: 2026-10-19 13:26:54.018227
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a47c9e2d5b18'
+down_revision = '8e2b4c6d1f03'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # keep only the most recent override of each device attribute
+    op.execute("""
+        DELETE FROM overrides AS o
+        USING overrides AS newer
+        WHERE o.did = newer.did AND o.aid = newer.aid AND o.id < newer.id
+    """)
+    op.create_unique_constraint('overrides_did_aid_key', 'overrides', ['did', 'aid'])
+
+
+def downgrade():
+    op.drop_constraint('overrides_did_aid_key', 'overrides', type_='unique')
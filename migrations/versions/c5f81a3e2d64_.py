@@ -0,0 +1,151 @@
+"""statement level attribute conflict triggers
+
+Revision ID: c5f81a3e2d64
+Revises: a47c9e2d5b18
+Create Date: 2026-10-19 15:02:11.530912
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5f81a3e2d64'
+down_revision = 'a47c9e2d5b18'
+branch_labels = None
+depends_on = None
+
+
+DROP_TRIGGERS = """
+    DROP TRIGGER IF EXISTS validate_device_attrs_trigger ON attrs;
+    DROP TRIGGER IF EXISTS validate_device_attrs_insert_trigger ON attrs;
+    DROP TRIGGER IF EXISTS validate_device_attrs_update_trigger ON attrs;
+    DROP TRIGGER IF EXISTS validate_device_trigger ON device_template;
+    DROP TRIGGER IF EXISTS validate_device_insert_trigger ON device_template;
+    DROP TRIGGER IF EXISTS validate_device_update_trigger ON device_template;
+"""
+
+ROW_TRIGGERS = """
+    -- template update/creation checks
+
+    CREATE OR REPLACE FUNCTION validate_device_attrs() returns trigger as $$
+    DECLARE
+      conflict_count int;
+    BEGIN
+      conflict_count := (
+        select count(*) from attrs as a
+        left join device_template as dt on a.template_id = dt.template_id
+        left join devices as d on d.id = dt.device_id
+        where dt.template_id != NEW.template_id and
+              dt.device_id in (select device_id from device_template where template_id = NEW.template_id) and
+              a.label = NEW.label and a.type = NEW.type
+      );
+      IF (conflict_count != 0) THEN
+        RAISE 'Attribute % (%) has standing conflicts', NEW.label, NEW.id using ERRCODE = 'unique_violation';
+      END IF;
+      RETURN NEW;
+    END;
+    $$ language plpgsql;
+
+    CREATE TRIGGER validate_device_attrs_trigger BEFORE INSERT OR UPDATE ON attrs
+    FOR EACH ROW EXECUTE PROCEDURE validate_device_attrs();
+
+    -- template assignment checks
+
+    CREATE OR REPLACE FUNCTION validate_device() returns trigger as $$
+    DECLARE
+      conflict_count int;
+    BEGIN
+      conflict_count := (
+        select count(*) from (
+          select * from attrs as attr
+          inner join device_template as dt on attr.template_id = dt.template_id
+          where dt.device_id = NEW.device_id
+        ) as curr
+        inner join attrs as nattrs on curr.label = nattrs.label and curr.type = nattrs.type and nattrs.template_id = NEW.template_id
+      );
+      IF (conflict_count != 0) THEN
+        RAISE 'Template (%) cannot be added to device (%) as it has standing attribute conflicts', NEW.template_id, NEW.device_id
+        using ERRCODE = 'unique_violation';
+      END IF;
+      RETURN NEW;
+    END;
+    $$ language plpgsql;
+
+    CREATE TRIGGER validate_device_trigger BEFORE INSERT OR UPDATE ON device_template
+    FOR EACH ROW EXECUTE PROCEDURE validate_device();
+"""
+
+STATEMENT_TRIGGERS = """
+    -- template update/creation checks
+
+    CREATE OR REPLACE FUNCTION validate_device_attrs_batch() returns trigger as $$
+    DECLARE
+      conflict record;
+    BEGIN
+      select n.label, n.id into conflict
+      from new_attrs as n
+      inner join device_template as own on own.template_id = n.template_id
+      inner join device_template as dt on dt.device_id = own.device_id and dt.template_id != n.template_id
+      inner join attrs as a on a.template_id = dt.template_id and a.label = n.label and a.type = n.type
+      limit 1;
+      IF FOUND THEN
+        RAISE 'Attribute % (%) has standing conflicts', conflict.label, conflict.id using ERRCODE = 'unique_violation';
+      END IF;
+      RETURN NULL;
+    END;
+    $$ language plpgsql;
+
+    CREATE TRIGGER validate_device_attrs_insert_trigger AFTER INSERT ON attrs
+    REFERENCING NEW TABLE AS new_attrs
+    FOR EACH STATEMENT EXECUTE PROCEDURE validate_device_attrs_batch();
+
+    CREATE TRIGGER validate_device_attrs_update_trigger AFTER UPDATE ON attrs
+    REFERENCING NEW TABLE AS new_attrs
+    FOR EACH STATEMENT EXECUTE PROCEDURE validate_device_attrs_batch();
+
+    -- template assignment checks
+
+    CREATE OR REPLACE FUNCTION validate_device_batch() returns trigger as $$
+    DECLARE
+      conflict record;
+    BEGIN
+      select n.device_id, n.template_id into conflict
+      from new_links as n
+      inner join device_template as dt on dt.device_id = n.device_id and dt.template_id != n.template_id
+      inner join attrs as curr on curr.template_id = dt.template_id
+      inner join attrs as nattrs on nattrs.template_id = n.template_id and nattrs.label = curr.label and nattrs.type = curr.type
+      limit 1;
+      IF FOUND THEN
+        RAISE 'Template (%) cannot be added to device (%) as it has standing attribute conflicts', conflict.template_id, conflict.device_id
+        using ERRCODE = 'unique_violation';
+      END IF;
+      RETURN NULL;
+    END;
+    $$ language plpgsql;
+
+    CREATE TRIGGER validate_device_insert_trigger AFTER INSERT ON device_template
+    REFERENCING NEW TABLE AS new_links
+    FOR EACH STATEMENT EXECUTE PROCEDURE validate_device_batch();
+
+    CREATE TRIGGER validate_device_update_trigger AFTER UPDATE ON device_template
+    REFERENCING NEW TABLE AS new_links
+    FOR EACH STATEMENT EXECUTE PROCEDURE validate_device_batch();
+"""
+
+
+def supports_transition_tables():
+    # REFERENCING NEW TABLE is only available since PostgreSQL 10
+    return int(op.get_bind().execute("SHOW server_version_num").scalar()) >= 100000
+
+
+def upgrade():
+    if supports_transition_tables():
+        op.execute(DROP_TRIGGERS + STATEMENT_TRIGGERS)
+
+
+def downgrade():
+    if supports_transition_tables():
+        op.execute(DROP_TRIGGERS + ROW_TRIGGERS)
+        op.execute("DROP FUNCTION IF EXISTS validate_device_attrs_batch(); "
+                   "DROP FUNCTION IF EXISTS validate_device_batch();")
@@ -0,0 +1,38 @@
+"""asynchronous jobs
+
+Revision ID: d7e3a91b0c52
+Revises: c5f81a3e2d64
+Create Date: 2026-10-19 17:41:06.318250
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7e3a91b0c52'
+down_revision = 'c5f81a3e2d64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('jobs',
+    sa.Column('id', sa.String(length=36), nullable=False),
+    sa.Column('kind', sa.String(length=64), nullable=False),
+    sa.Column('status', sa.String(length=16), nullable=False),
+    sa.Column('params', sa.Text(), nullable=False),
+    sa.Column('progress', sa.Integer(), nullable=False),
+    sa.Column('result', sa.Text(), nullable=True),
+    sa.Column('error', sa.Text(), nullable=True),
+    sa.Column('created', sa.DateTime(), nullable=True),
+    sa.Column('started', sa.DateTime(), nullable=True),
+    sa.Column('finished', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('jobs_status_created_idx', 'jobs', ['status', 'created'], unique=False)
+
+
+def downgrade():
+    op.drop_index('jobs_status_created_idx', table_name='jobs')
+    op.drop_table('jobs')
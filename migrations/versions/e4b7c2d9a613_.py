@@ -0,0 +1,26 @@
+"""job leases
+
+Revision ID: e4b7c2d9a613
+Revises: d7e3a91b0c52
+Create Date: 2026-10-19 18:25:47.602214
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4b7c2d9a613'
+down_revision = 'd7e3a91b0c52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('jobs', sa.Column('locked_until', sa.DateTime(), nullable=True))
+    op.add_column('jobs', sa.Column('attempts', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    op.drop_column('jobs', 'attempts')
+    op.drop_column('jobs', 'locked_until')
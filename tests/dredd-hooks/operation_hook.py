@@ -132,6 +132,7 @@ def remove_filters(transaction):
 @hooks.before('Templates > Template info > Get template info')
 @hooks.before('Templates > Template info > Update template info')
 @hooks.before('Templates > Template info > Delete template')
+@hooks.before('Templates > Template info > Clone template')
 def register_new_template(transaction):
     template_id = create_sample_template()
     if not 'proprietary' in transaction:
@@ -162,6 +163,11 @@ def update_onlyids_query(transaction):
 
 @hooks.before('Devices > Device info > Get the current list of devices > Example 1')
 @hooks.before('Devices > Device info > Get the current list of devices associated with given template')
+@hooks.before('Templates > Template info > Get template usage')
+@hooks.before('Devices > Device info > Add a template to many devices')
+@hooks.before('Devices > Device info > Remove a template from many devices')
+@hooks.before('Devices > Device info > Move devices to another template')
+@hooks.before('Devices > Device info > Set attribute values of many devices')
 def create_single_device(transaction):
     template_id = create_sample_template()
     if not 'proprietary' in transaction:
@@ -241,6 +247,8 @@ def create_single_device_and_gen_psk(transaction):
 @hooks.before('Devices > Device info > Delete device')
 @hooks.before('Devices > PSK Manipulation > Generate PSK')
 @hooks.before('Devices > Device info > Delete all devices')
+@hooks.before('Devices > Device info > Partially update device info')
+@hooks.before('Devices > Device info > Set device attribute values')
 def create_device_and_update_device_id(transaction):
     device_id = create_single_device(transaction)
     transaction['fullPath'] = transaction['fullPath'].replace('efac', device_id)
@@ -312,16 +320,10 @@ def update_expected_ids_single_device_delete(transaction):
 
 @hooks.before('Devices > Device info > Delete all devices')
 def update_expected_ids_single_device_actuator_delete(transaction):
-    template_id = transaction['proprietary']['template_id']
     device_id = transaction['proprietary']['device_id']
 
     expected_body = json.loads(transaction['expected']['body'])
-    str_template_id = "{}".format(template_id)
-    expected_body["removed_devices"][0]["attrs"][str_template_id] = expected_body["removed_devices"][0]["attrs"].pop("4865")
-    for attr in expected_body["removed_devices"][0]["attrs"][str_template_id]:
-        attr['template_id'] = str_template_id
-    expected_body["removed_devices"][0]["templates"] = [str_template_id]
-    expected_body["removed_devices"][0]["id"] = device_id
+    expected_body["removed_devices"] = [device_id]
     transaction['expected']['body'] = json.dumps(expected_body)
 
 @hooks.before('Devices > Device info > Get the current list of devices associated with given template')
@@ -345,6 +347,9 @@ def update_expected_ids_multiple_devices(transaction):
 @hooks.before('Templates > Template info > Get template info')
 @hooks.before('Templates > Template info > Update template info')
 @hooks.before('Templates > Template info > Delete template')
+@hooks.before('Templates > Template info > Clone template')
+@hooks.before('Templates > Template info > Get template usage')
+@hooks.before('Devices > Device info > Remove a template from many devices')
 def update_template_id(transaction):
     template_id = transaction['proprietary']['template_id']
     transaction['fullPath'] = transaction['fullPath'].replace('4865', '{}'.format(template_id))
@@ -399,3 +404,151 @@ def order_attributes(transaction):
     sort_attributes(template['templates'][0], 'data_attrs')
     sort_attributes(template['templates'][0], 'attrs')
     transaction['real']['body'] = json.dumps(template)
+
+
+def create_firmware_template():
+    template = {
+        "label": "FirmwareModel",
+        "attrs": [
+            {
+                "label": "firmware",
+                "type": "static",
+                "value_type": "string",
+                "static_value": "http://firmware/2.0.0"
+            }
+        ]
+    }
+    params = {
+        'content_type': 'application/json',
+        'data': json.dumps(template)
+    }
+
+    result = TemplateHandler.create_template(params, generate_token())
+    return result['template']['id']
+
+def get_attr_id(template_id, label):
+    template = TemplateHandler.get_template({}, template_id, generate_token())
+    return next(attr['id'] for attr in template['attrs'] if attr['label'] == label)
+
+def update_device_selector(transaction):
+    device_id = transaction['proprietary']['device_id']
+    request_body = json.loads(transaction['request']['body'])
+    request_body['selector'] = {'ids': [device_id]}
+    transaction['request']['body'] = json.dumps(request_body)
+
+def update_expected_updated_devices(transaction):
+    device_id = transaction['proprietary']['device_id']
+    expected_body = json.loads(transaction['expected']['body'])
+    expected_body['devices'] = [device_id]
+    if 'conflicts' in expected_body:
+        expected_body['conflicts'] = {}
+    transaction['expected']['body'] = json.dumps(expected_body)
+
+
+@hooks.before('Templates > Template info > Get template usage')
+def update_usage_ids_query(transaction):
+    transaction['fullPath'] = transaction['fullPath'].replace('ids=false', 'ids=true')
+
+
+@hooks.before('Templates > Template info > Get template update progress')
+@hooks.before('Jobs > Job > Get job')
+def create_fanout_job(transaction):
+    template_id = create_sample_template()
+    template = {
+        "label": "SensorModel",
+        "attrs": [
+            {
+                "label": "temperature",
+                "type": "dynamic",
+                "value_type": "float"
+            }
+        ]
+    }
+    params = {
+        'content_type': 'application/json',
+        'data': json.dumps(template)
+    }
+
+    result = TemplateHandler.update_template(params, template_id, generate_token())
+    job_id = result['fanout']['id']
+    transaction['fullPath'] = re.sub(r'[0-9a-f]{8}(-[0-9a-f]{4}){3}-[0-9a-f]{12}', job_id,
+                                     transaction['fullPath'])
+
+
+@hooks.before_validation('Templates > Template info > Get template update progress')
+@hooks.before_validation('Jobs > Job > Get job')
+def update_expected_job_status(transaction):
+    # the job is run by the job process meanwhile: its outcome is whatever it got to
+    job = json.loads(transaction['real']['body'])
+    expected_body = json.loads(transaction['expected']['body'])
+    for key in ['status', 'progress', 'result', 'error', 'started', 'finished']:
+        expected_body[key] = job[key]
+    transaction['expected']['body'] = json.dumps(expected_body)
+
+
+@hooks.before_validation('Templates > Template info > Clone template')
+def order_cloned_attributes(transaction):
+    for body in ['expected', 'real']:
+        result = json.loads(transaction[body]['body'])
+        sort_attributes(result['template'], 'attrs')
+        sort_attributes(result['template'], 'data_attrs')
+        transaction[body]['body'] = json.dumps(result)
+
+
+@hooks.before('Devices > Device info > Add a template to many devices')
+def update_attached_template_id(transaction):
+    # the device is associated with the sample template already
+    template_id = create_firmware_template()
+    transaction['fullPath'] = transaction['fullPath'].replace('4865', '{}'.format(template_id))
+
+
+@hooks.before('Devices > Device info > Move devices to another template')
+def update_move_template_ids(transaction):
+    template_id = transaction['proprietary']['template_id']
+    target_id = create_firmware_template()
+    transaction['fullPath'] = '/device/template/{}/move/{}'.format(template_id, target_id)
+
+
+@hooks.before('Devices > Device info > Add a template to many devices')
+@hooks.before('Devices > Device info > Remove a template from many devices')
+@hooks.before('Devices > Device info > Move devices to another template')
+def update_template_selector(transaction):
+    update_device_selector(transaction)
+    update_expected_updated_devices(transaction)
+
+
+@hooks.before('Devices > Device info > Set attribute values of many devices')
+def update_bulk_attr_values(transaction):
+    template_id = transaction['proprietary']['template_id']
+    update_device_selector(transaction)
+    request_body = json.loads(transaction['request']['body'])
+    request_body['selector']['template'] = template_id
+    request_body['attrs'] = {'model-id': 'model-002'}
+    transaction['request']['body'] = json.dumps(request_body)
+    update_expected_updated_devices(transaction)
+
+
+@hooks.before('Devices > Device info > Partially update device info')
+def update_patched_attr_ids(transaction):
+    template_id = transaction['proprietary']['template_id']
+    request_body = json.loads(transaction['request']['body'])
+    request_body['attrs'][0]['id'] = get_attr_id(template_id, 'model-id')
+    request_body['attrs'][0]['template_id'] = '{}'.format(template_id)
+    transaction['request']['body'] = json.dumps(request_body)
+
+
+@hooks.before('Devices > Device info > Set device attribute values')
+def update_attr_values(transaction):
+    transaction['request']['body'] = json.dumps({'model-id': '10'})
+
+
+@hooks.before_validation('Devices > Device info > Partially update device info')
+@hooks.before_validation('Devices > Device info > Set device attribute values')
+def update_expected_overridden_device(transaction):
+    update_expected_ids_single_device_update(transaction)
+    # the overridden attribute (model-id) is the first one, once ordered
+    str_template_id = "{}".format(transaction['proprietary']['template_id'])
+    for body in ['expected', 'real']:
+        result = json.loads(transaction[body]['body'])
+        sort_attributes(result['device']['attrs'], str_template_id)
+        transaction[body]['body'] = json.dumps(result)
@@ -0,0 +1,65 @@
+import gzip
+import json
+import zlib
+import unittest
+from unittest.mock import patch
+from flask import Response
+
+from DeviceManager.app import app
+from DeviceManager.Compression import compress_response, negotiate_encoding
+
+
+class TestCompression(unittest.TestCase):
+
+    payload = json.dumps({'devices': [{'id': str(i), 'label': 'device'} for i in range(200)]})
+
+    def test_negotiate_encoding(self):
+        with app.test_request_context(headers={'Accept-Encoding': 'deflate;q=0.5, gzip'}):
+            from flask import request
+            self.assertEqual(negotiate_encoding(request.accept_encodings), 'gzip')
+
+        with app.test_request_context(headers={'Accept-Encoding': 'br'}):
+            from flask import request
+            self.assertIsNone(negotiate_encoding(request.accept_encodings))
+
+    def test_compress_gzip(self):
+        with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+            response = compress_response(Response(self.payload, mimetype='application/json'))
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertIn('Accept-Encoding', response.vary)
+            self.assertEqual(gzip.decompress(response.get_data()).decode(), self.payload)
+
+    def test_compress_deflate(self):
+        with app.test_request_context(headers={'Accept-Encoding': 'deflate'}):
+            response = compress_response(Response(self.payload, mimetype='application/json'))
+            self.assertEqual(response.headers['Content-Encoding'], 'deflate')
+            self.assertEqual(zlib.decompress(response.get_data()).decode(), self.payload)
+
+    def test_skip_small_or_unaccepted(self):
+        with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+            response = compress_response(Response('{}', mimetype='application/json'))
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(response.get_data(), b'{}')
+
+        with app.test_request_context():
+            response = compress_response(Response(self.payload, mimetype='application/json'))
+            self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_compress_stream(self):
+        def generate():
+            for i in range(100):
+                yield '{"id": "%05x"}\n' % i
+
+        with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+            response = compress_response(Response(generate(), mimetype='application/json'))
+            self.assertTrue(response.is_streamed)
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            data = gzip.decompress(b''.join(response.response)).decode()
+            self.assertEqual(data, ''.join('{"id": "%05x"}\n' % i for i in range(100)))
+
+    @patch('DeviceManager.Compression.CONFIG')
+    def test_disabled(self, config_mock):
+        config_mock.compression_min_size = -1
+        with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+            response = compress_response(Response(self.payload, mimetype='application/json'))
+            self.assertNotIn('Content-Encoding', response.headers)
@@ -5,9 +5,11 @@ from unittest.mock import Mock, MagicMock, patch
 
 
 from DeviceManager.DatabaseHandler import MultiTenantSQLAlchemy, before_request
+from DeviceManager.app import app
 
 from flask import Flask, g
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.engine.url import make_url
 
 class TestDatabaseHandler(unittest.TestCase):
 
@@ -34,6 +36,16 @@ class TestDatabaseHandler(unittest.TestCase):
 
         self.assertIsNotNone(MultiTenantSQLAlchemy().get_engine(self.app, 'test_bind_sql_alchemy'))
 
+    def test_batch_mode(self):
+        options = {}
+        MultiTenantSQLAlchemy().apply_driver_hacks(
+            app, make_url('postgresql+psycopg2://postgres@postgres/dojot_devm'), options)
+        self.assertTrue(options['use_batch_mode'])
+
+        options = {}
+        MultiTenantSQLAlchemy().apply_driver_hacks(app, make_url('sqlite://'), options)
+        self.assertNotIn('use_batch_mode', options)
+
     def test_before_request(self):
         with self.app.test_request_context():
             result = before_request()
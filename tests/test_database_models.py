@@ -0,0 +1,73 @@
+import unittest
+from unittest.mock import Mock, MagicMock
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql
+
+from DeviceManager.DatabaseHandler import db
+from DeviceManager.DatabaseModels import Device, DeviceTemplate, DeviceAttr, load_attr_trees
+from DeviceManager.DatabaseModels import prefetch_sequence_ids
+
+from alchemy_mock.mocking import AlchemyMagicMock
+
+
+class TestDatabaseModels(unittest.TestCase):
+
+    def test_load_attr_trees(self):
+        templates = [DeviceTemplate(id=1, label='SensorModel'), DeviceTemplate(id=2, label='Empty')]
+        session = MagicMock()
+        query = session.query.return_value.select_entity_from.return_value.order_by.return_value
+        query.all.return_value = [
+            DeviceAttr(id=1, label='temperature', type='dynamic', value_type='float', template_id=1),
+            DeviceAttr(id=2, label='unit', type='meta', value_type='string', parent_id=1),
+            DeviceAttr(id=3, label='scale', type='meta', value_type='string', parent_id=2),
+            DeviceAttr(id=4, label='model', type='static', value_type='string', template_id=1)
+        ]
+
+        load_attr_trees(templates, session)
+
+        # a single recursive query, whatever the depth of the attribute trees
+        session.query.assert_called_once_with(DeviceAttr)
+        tree = session.query.return_value.select_entity_from.call_args[0][0]
+        sql = str(tree.select().compile(dialect=postgresql.dialect()))
+        self.assertTrue(sql.startswith('WITH RECURSIVE attr_tree'))
+
+        self.assertEqual([attr.id for attr in templates[0].attrs], [1, 4])
+        self.assertEqual(templates[1].attrs, [])
+        temperature = templates[0].attrs[0]
+        self.assertEqual([child.id for child in temperature.children], [2])
+        self.assertEqual([child.id for child in temperature.children[0].children], [3])
+        self.assertEqual(templates[0].attrs[1].children, [])
+
+        session.reset_mock()
+        load_attr_trees([], session)
+        session.query.assert_not_called()
+
+    def test_attr_repr(self):
+        attr = DeviceAttr(id=2, label='unit', type='meta', value_type='string', parent_id=1)
+        self.assertEqual(repr(attr),
+                         "<Attr(label='unit', type='meta', value_type='string', children='', parent=1)>")
+
+    def test_prefetch_sequence_ids(self):
+        template = DeviceTemplate(label='sensor')
+        attrs = [DeviceAttr(label='attr-{}'.format(i), type='dynamic', value_type='float',
+                            template=template) for i in range(3)]
+        kept = DeviceAttr(id=42, label='kept', type='dynamic', value_type='float')
+        device = Device(id='00001', label='sensor')
+
+        reserved = {'template_id': [[(7,)]], 'attr_id': [[(10,), (11,), (12,)]]}
+        session = AlchemyMagicMock()
+        session.new = [template, kept, device] + attrs
+        session.execute.side_effect = lambda query, params: Mock(
+            fetchall=Mock(return_value=reserved[params['sequence']].pop()))
+
+        prefetch_sequence_ids(session, None, None)
+
+        # a single query per sequence
+        self.assertEqual(session.execute.call_count, 2)
+        self.assertEqual(template.id, 7)
+        self.assertEqual(sorted(attr.id for attr in attrs), [10, 11, 12])
+        self.assertEqual(kept.id, 42)
+        self.assertEqual(device.id, '00001')
+
+    def test_prefetch_listener(self):
+        self.assertTrue(event.contains(db.session, 'before_flush', prefetch_sequence_ids))
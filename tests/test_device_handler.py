@@ -3,14 +3,18 @@ import json
 import unittest
 from unittest.mock import Mock, MagicMock, patch, call
 from flask import Flask
+from sqlalchemy.dialects import postgresql
 
 from DeviceManager.DeviceHandler import DeviceHandler, flask_delete_all_device, flask_get_device, flask_remove_device, flask_add_template_to_device, flask_remove_template_from_device, flask_gen_psk,flask_internal_get_device
 from DeviceManager.utils import HTTPRequestError
-from DeviceManager.DatabaseModels import Device, DeviceAttrsPsk, DeviceAttr
+from DeviceManager.DeviceHandler import serialize_full_device, device_load_options
+from DeviceManager.DeviceHandler import device_selector, label_condition, override_value
+from DeviceManager.DatabaseModels import Device, DeviceAttrsPsk, DeviceAttr, DeviceTemplate, DeviceOverride
 from DeviceManager.DatabaseModels import assert_device_exists
 from DeviceManager.BackendHandler import KafkaInstanceHandler
+from DeviceManager.QueryCache import QueryCache
 import DeviceManager.DatabaseModels
-from DeviceManager.SerializationModels import ValidationError
+from DeviceManager.SerializationModels import ValidationError, DEVICE_FIELDS, parse_fields
 
 from .token_test_generator import generate_token
 
@@ -21,12 +25,12 @@ class TestDeviceHandler(unittest.TestCase):
 
     app = Flask(__name__)
 
-    @patch('flask_sqlalchemy._QueryProperty.__get__')
-    def test_generate_deviceId(self, query_property_getter_mock):
-        query_property_getter_mock.return_value.filter_by.return_value.first.return_value = None
-        self.assertIsNotNone(DeviceHandler.generate_device_id())
+    @patch('DeviceManager.DeviceHandler.allocate_device_ids')
+    def test_generate_deviceId(self, allocate_mock):
+        allocate_mock.return_value = ['4f0a2']
+        self.assertEqual(DeviceHandler.generate_device_id(), '4f0a2')
 
-        query_property_getter_mock.return_value.filter_by.return_value.first.return_value = 'existed_device_id'
+        allocate_mock.side_effect = HTTPRequestError(500, "Device id space exhausted")
         with pytest.raises(HTTPRequestError):
             DeviceHandler.generate_device_id()
 
@@ -71,6 +75,24 @@ class TestDeviceHandler(unittest.TestCase):
         self.assertTrue(json.dumps(result['devices']))
         self.assertIsNotNone(result)
 
+    @patch('DeviceManager.DeviceHandler.db')
+    def test_get_devices_sensitive_data(self, db_mock):
+        db_mock.session = UnifiedAlchemyMagicMock()
+        db_mock.session.paginate().items = [Device(id=1, label='test_device1')]
+        params_query = {'page_number': 1, 'per_page': 1, 'sortBy': None,
+                        'attr': [], 'idsOnly': 'false', 'attr_type': []}
+        token = generate_token()
+        cache = QueryCache(10)
+
+        with patch('DeviceManager.DeviceHandler.LISTING_CACHE', cache), \
+                patch('DeviceManager.DeviceHandler.current_generation', return_value=3):
+            DeviceHandler.get_devices(token, params_query, True)
+            # listings with pre shared keys are never cached
+            self.assertEqual(cache.stats()['entries'], 0)
+
+            DeviceHandler.get_devices(token, params_query)
+            self.assertEqual(cache.stats()['entries'], 1)
+
     @patch('DeviceManager.DeviceHandler.db')
     def test_list_devicesId(self, db_mock):
         db_mock.session = AlchemyMagicMock()
@@ -93,6 +115,36 @@ class TestDeviceHandler(unittest.TestCase):
         result = DeviceHandler.get_device(token, 'device_id')
         self.assertIsNotNone(result)
 
+    def test_serialize_device_fields(self):
+        attr = DeviceAttr(id=3, label='temperature', type='dynamic', value_type='float', template_id=1)
+        template = DeviceTemplate(id=1, label='sensor', attrs=[attr])
+        device = Device(id='5b1a', label='device', templates=[template], overrides=[])
+
+        result = serialize_full_device(device, 'admin',
+                                       fields=parse_fields('label,attrs.label', DEVICE_FIELDS))
+        self.assertEqual(result, {'label': 'device', 'attrs': {1: [{'label': 'temperature'}]}})
+
+        result = serialize_full_device(device, 'admin', fields=parse_fields('id', DEVICE_FIELDS))
+        self.assertEqual(result, {'id': '5b1a'})
+
+        self.assertEqual(device_load_options(None), [])
+        self.assertTrue(device_load_options(parse_fields('id', DEVICE_FIELDS)))
+
+    def test_serialize_device_overridden_flag(self):
+        temperature = DeviceAttr(id=3, label='temperature', type='static', value_type='float',
+                                 static_value='0', template_id=1)
+        humidity = DeviceAttr(id=4, label='humidity', type='static', value_type='float',
+                              static_value='0', template_id=1)
+        template = DeviceTemplate(id=1, label='sensor', attrs=[temperature, humidity])
+        device = Device(id='5b1a', label='device', templates=[template],
+                        overrides=[DeviceOverride(aid=4, attr=humidity, static_value='50')])
+
+        # the flag is computed even though static values are not selected
+        fields = parse_fields('attrs.is_static_overridden', DEVICE_FIELDS)
+        result = serialize_full_device(device, 'admin', fields=fields)
+        self.assertEqual(result, {'attrs': {1: [{'is_static_overridden': False},
+                                                {'is_static_overridden': True}]}})
+
     @patch('DeviceManager.DeviceHandler.db')
     @patch('flask_sqlalchemy._QueryProperty.__get__')
     def test_delete_device(self, db_mock, query_property_getter_mock):
@@ -106,17 +158,42 @@ class TestDeviceHandler(unittest.TestCase):
             self.assertEqual(result['result'], 'ok')
 
     @patch('DeviceManager.DeviceHandler.db')
-    @patch('flask_sqlalchemy._QueryProperty.__get__')
-    def test_delete_all_devices(self, db_mock, query_property_getter_mock):
+    def test_delete_all_devices(self, db_mock):
         db_mock.session = AlchemyMagicMock()
         token = generate_token()
 
-        db_mock.session.query(Device).return_value = [
-            Device(id=1, label='device_label')]
-        result = DeviceHandler.delete_all_devices(token)
+        statements = []
+        pending = [[('0001',), ('0002',)], [('0003',)], []]
+        removing = [[('0001',), ('0002',)], [('0003',)]]
+        def execute(stmt, *args, **kwargs):
+            sql = str(stmt.compile(dialect=postgresql.dialect())) if hasattr(stmt, 'compile') else str(stmt)
+            statements.append(sql)
+            if sql.startswith('SELECT devices.id'):
+                return pending.pop(0)
+            if sql.startswith('DELETE FROM devices'):
+                return removing.pop(0)
+            return MagicMock()
+        db_mock.session.execute.side_effect = execute
+
+        with patch.object(KafkaInstanceHandler, "getInstance", return_value=MagicMock()) as kafka_mock:
+            result = DeviceHandler.delete_all_devices(token, {'template': '4865', 'label': None}, batch=2)
+            # nothing is removed until the result is consumed
+            self.assertFalse([sql for sql in statements if sql.startswith('DELETE')])
+            self.assertEqual(list(result), [['0001', '0002'], ['0003']])
+            self.assertEqual(kafka_mock.return_value.remove_many.call_count, 2)
+            kafka_mock.return_value.remove_many.assert_called_with([{'id': '0003'}], meta={'service': 'admin'})
+
+        selects = [sql for sql in statements if sql.startswith('SELECT devices.id')]
+        self.assertEqual(len(selects), 3)
+        self.assertIn('device_template.template_id', selects[0])
+        self.assertIn('LIMIT', selects[0])
+        deletes = [sql.split(' WHERE')[0] for sql in statements if sql.startswith('DELETE')]
+        self.assertEqual(deletes[:4], ['DELETE FROM overrides', 'DELETE FROM pre_shared_keys',
+                                       'DELETE FROM device_template', 'DELETE FROM devices'])
+        self.assertGreaterEqual(db_mock.session.commit.call_count, 2)
 
-        self.assertIsNotNone(result)
-        self.assertEqual(result['result'], 'ok')
+        with self.assertRaises(HTTPRequestError):
+            DeviceHandler.delete_all_devices(token, {'template': 'abc'})
 
     @patch('DeviceManager.DeviceHandler.db')
     @patch('flask_sqlalchemy._QueryProperty.__get__')
@@ -305,6 +382,44 @@ class TestDeviceHandler(unittest.TestCase):
                     with self.assertRaises(HTTPRequestError):
                         result = DeviceHandler.create_device(params, token)
 
+    @patch('DeviceManager.DeviceHandler.db')
+    def test_create_devices_bulk(self, db_mock):
+        db_mock.session = AlchemyMagicMock()
+        token = generate_token()
+
+        attr = DeviceAttr(id=3, label='temperature', type='static', value_type='float',
+                          static_value='0', template_id=1)
+        template = DeviceTemplate(id=1, label='sensor', attrs=[attr])
+        data = '{"label": "sensor", "templates": [1], ' \
+               '"attrs": [{"id": 3, "label": "temperature", "template_id": "1", "static_value": "10"}]}'
+
+        with patch('DeviceManager.DeviceHandler.assert_template_exists', return_value=template), \
+                patch.object(DeviceHandler, 'generate_device_ids', return_value=['00001', '00002', '00003']), \
+                patch.object(KafkaInstanceHandler, "getInstance", return_value=MagicMock()) as kafka_mock:
+            params = {'count': '3', 'verbose': 'false',
+                      'content_type': 'application/json', 'data': data}
+            result = DeviceHandler.create_device(params, token)
+
+        self.assertEqual(result['message'], 'devices created')
+        self.assertEqual(result['devices'], [
+            {'id': '00001', 'label': 'sensor_0'},
+            {'id': '00002', 'label': 'sensor_1'},
+            {'id': '00003', 'label': 'sensor_2'}
+        ])
+        # a single multi-row statement for each table
+        inserts = [args[0] for args, _ in db_mock.session.execute.call_args_list
+                   if hasattr(args[0], 'table')]
+        self.assertEqual([insert.table.name for insert in inserts],
+                         ['devices', 'device_template', 'overrides'])
+        self.assertIn('nextval', str(inserts[2].compile(dialect=postgresql.dialect())))
+
+        create_mock = kafka_mock.return_value.create
+        self.assertEqual(create_mock.call_count, 3)
+        event = create_mock.call_args[0][0]
+        self.assertEqual(event['templates'], [1])
+        self.assertEqual(event['attrs'][1][0]['static_value'], '10')
+        self.assertTrue(event['attrs'][1][0]['is_static_overridden'])
+
     @patch('DeviceManager.DeviceHandler.db')
     @patch('flask_sqlalchemy._QueryProperty.__get__')
     def test_update_device(self, db_mock_session, query_property_getter_mock):
@@ -321,6 +436,362 @@ class TestDeviceHandler(unittest.TestCase):
             self.assertEqual(result['message'], 'device updated')
             self.assertIsNotNone(result['device'])
 
+    @patch('DeviceManager.DeviceHandler.db')
+    def test_update_device_diff(self, db_mock):
+        db_mock.session = AlchemyMagicMock()
+        token = generate_token()
+
+        kept_attr = DeviceAttr(id=3, label='temperature', type='static', value_type='float',
+                               static_value='0', template_id=1)
+        removed_attr = DeviceAttr(id=4, label='key', type='static', value_type='psk', template_id=2)
+        kept = DeviceTemplate(id=1, label='sensor', attrs=[kept_attr])
+        removed = DeviceTemplate(id=2, label='secure', attrs=[removed_attr])
+        added = DeviceTemplate(id=3, label='extra', attrs=[])
+
+        changed_override = DeviceOverride(aid=3, attr=kept_attr, static_value='5')
+        stale_override = DeviceOverride(aid=4, attr=removed_attr, static_value='x')
+        psk = DeviceAttrsPsk(attr_id=4, device_id='5b1a', psk=b'key', attrs=removed_attr)
+        device = Device(id='5b1a', label='old', templates=[kept, removed],
+                        overrides=[changed_override, stale_override], pre_shared_keys=[psk])
+
+        data = '{"label": "new", "templates": [1, 3], ' \
+               '"attrs": [{"id": 3, "label": "temperature", "template_id": "1", "static_value": "10"}]}'
+
+        with patch('DeviceManager.DeviceHandler.assert_device_exists', return_value=device), \
+                patch('DeviceManager.DeviceHandler.assert_template_exists', return_value=added) as template_mock, \
+                patch.object(KafkaInstanceHandler, "getInstance", return_value=MagicMock()):
+            params = {'content_type': 'application/json', 'data': data}
+            result = DeviceHandler.update_device(params, '5b1a', token)
+
+        self.assertEqual(result['message'], 'device updated')
+        self.assertEqual(device.label, 'new')
+        self.assertEqual([template.id for template in device.templates], [1, 3])
+        template_mock.assert_called_once_with(3, db_mock.session)
+        self.assertEqual(changed_override.static_value, '10')
+
+        deleted = [args[0] for args, _ in db_mock.session.delete.call_args_list]
+        self.assertIn(stale_override, deleted)
+        self.assertIn(psk, deleted)
+        self.assertNotIn(changed_override, deleted)
+
+    @patch('DeviceManager.DeviceHandler.db')
+    def test_patch_device(self, db_mock):
+        db_mock.session = AlchemyMagicMock()
+        token = generate_token()
+
+        metadata = DeviceAttr(id=5, label='unit', type='meta', value_type='string', static_value='C')
+        temperature = DeviceAttr(id=3, label='temperature', type='static', value_type='float',
+                                 static_value='0', template_id=1, children=[metadata])
+        humidity = DeviceAttr(id=4, label='humidity', type='static', value_type='float',
+                              static_value='0', template_id=1)
+        template = DeviceTemplate(id=1, label='sensor', attrs=[temperature, humidity])
+        humidity_override = DeviceOverride(aid=4, attr=humidity, static_value='50')
+        device = Device(id='5b1a', label='old', templates=[template], overrides=[humidity_override],
+                        pre_shared_keys=[])
+
+        data = '{"label": "new", "attrs": [{"id": 3, "template_id": "1", "static_value": "10", ' \
+               '"metadata": [{"id": 5, "static_value": "F"}]}]}'
+
+        with patch('DeviceManager.DeviceHandler.assert_device_exists', return_value=device), \
+                patch.object(KafkaInstanceHandler, "getInstance", return_value=MagicMock()) as kafka_mock:
+            params = {'content_type': 'application/merge-patch+json', 'data': data}
+            result = DeviceHandler.patch_device(params, '5b1a', token)
+
+            self.assertEqual(result['message'], 'device updated')
+            self.assertEqual(device.label, 'new')
+            # unlisted overrides are left untouched
+            self.assertEqual(sorted((o.attr.id, o.static_value) for o in device.overrides),
+                             [(3, '10'), (4, '50'), (5, 'F')])
+            kafka_mock.return_value.update.assert_called_once()
+
+            # null removes the override, and an unchanged patch writes nothing
+            params['data'] = '{"attrs": [{"id": 4, "template_id": 1, "static_value": null}]}'
+            DeviceHandler.patch_device(params, '5b1a', token)
+            self.assertEqual(sorted(o.attr.id for o in device.overrides), [3, 5])
+
+            result = DeviceHandler.patch_device(params, '5b1a', token)
+            self.assertEqual(result['message'], 'device not modified')
+
+            with self.assertRaises(HTTPRequestError):
+                params['data'] = '{"id": "other"}'
+                DeviceHandler.patch_device(params, '5b1a', token)
+
+            with self.assertRaises(HTTPRequestError):
+                params['data'] = '{"label": null}'
+                DeviceHandler.patch_device(params, '5b1a', token)
+
+            with self.assertRaises(HTTPRequestError):
+                params['data'] = '{"attrs": [{"id": 42, "template_id": 1, "static_value": "1"}]}'
+                DeviceHandler.patch_device(params, '5b1a', token)
+
+            # malformed overrides are rejected as bad requests
+            for data in ['{"attrs": ["temperature"]}',
+                         '{"attrs": [{"id": 3, "template_id": "abc", "static_value": "1"}]}',
+                         '{"attrs": [{"id": 3, "static_value": "1"}]}',
+                         '{"attrs": [{"id": 3, "template_id": 1, "metadata": [5]}]}']:
+                params['data'] = data
+                with pytest.raises(HTTPRequestError) as error:
+                    DeviceHandler.patch_device(params, '5b1a', token)
+                self.assertEqual(error.value.error_code, 400)
+
+    @patch('DeviceManager.DeviceHandler.db')
+    def test_set_attr_overrides(self, db_mock):
+        db_mock.session = AlchemyMagicMock()
+        token = generate_token()
+
+        db_mock.session.query.return_value.join.return_value.filter.return_value.all.return_value = [
+            (3, 'temperature'), (4, 'humidity')]
+        db_mock.session.query.return_value.filter.return_value.all.return_value = [(3, 5, 'unit')]
+        device = Device(id='5b1a', label='device', templates=[], overrides=[], pre_shared_keys=[])
+
+        data = '{"temperature": {"static_value": "10", "metadata": {"unit": "F"}}, "4": null}'
+        with patch('DeviceManager.DeviceHandler.assert_device_exists', return_value=device), \
+                patch.object(KafkaInstanceHandler, "getInstance", return_value=MagicMock()) as kafka_mock:
+            params = {'content_type': 'application/json', 'data': data}
+            result = DeviceHandler.set_attr_overrides(params, '5b1a', token)
+
+        self.assertEqual(result['message'], 'device attributes updated')
+        kafka_mock.return_value.update.assert_called_once()
+
+        statements = [str(args[0].compile(dialect=postgresql.dialect()))
+                      for args, _ in db_mock.session.execute.call_args_list if hasattr(args[0], 'table')]
+        self.assertTrue(statements[0].startswith('UPDATE devices'))
+        self.assertTrue(statements[1].startswith('DELETE FROM overrides'))
+        self.assertIn('ON CONFLICT ON CONSTRAINT overrides_did_aid_key DO UPDATE', statements[2])
+        upsert = [args[0] for args, _ in db_mock.session.execute.call_args_list][-2]
+        self.assertEqual(sorted(upsert.compile(dialect=postgresql.dialect()).params[key]
+                                for key in ('aid_m0', 'aid_m1')), [3, 5])
+
+    def test_override_value(self):
+        self.assertEqual(override_value('10'), '10')
+        self.assertEqual(override_value(10), '10')
+        self.assertEqual(override_value(True), 'true')
+        self.assertIsNone(override_value(None))
+        with self.assertRaises(HTTPRequestError):
+            override_value({'value': 10})
+
+    @patch('DeviceManager.DeviceHandler.db')
+    def test_set_attr_overrides_values(self, db_mock):
+        db_mock.session = AlchemyMagicMock()
+        token = generate_token()
+        db_mock.session.query.return_value.join.return_value.filter.return_value.all.return_value = [
+            (3, 'temperature'), (4, 'enabled')]
+        device = Device(id='5b1a', label='device', templates=[], overrides=[], pre_shared_keys=[])
+
+        # non string values are stored just as by PUT /device/attrs
+        with patch('DeviceManager.DeviceHandler.assert_device_exists', return_value=device), \
+                patch.object(KafkaInstanceHandler, "getInstance", return_value=MagicMock()):
+            params = {'content_type': 'application/json', 'data': '{"temperature": 10.5, "enabled": true}'}
+            DeviceHandler.set_attr_overrides(params, '5b1a', token)
+
+        upsert = [args[0] for args, _ in db_mock.session.execute.call_args_list][-2]
+        values = upsert.compile(dialect=postgresql.dialect()).params
+        self.assertEqual(sorted(values[key] for key in ('static_value_m0', 'static_value_m1')),
+                         ['10.5', 'true'])
+
+    @patch('DeviceManager.DeviceHandler.db')
+    def test_set_attr_overrides_errors(self, db_mock):
+        db_mock.session = AlchemyMagicMock()
+        token = generate_token()
+        db_mock.session.query.return_value.join.return_value.filter.return_value.all.return_value = [
+            (3, 'temperature'), (4, 'temperature')]
+
+        params = {'content_type': 'application/json', 'data': '["temperature"]'}
+        with self.assertRaises(HTTPRequestError):
+            DeviceHandler.set_attr_overrides(params, '5b1a', token)
+
+        params['data'] = '{"temperature": "10"}'
+        with self.assertRaises(HTTPRequestError) as error:
+            DeviceHandler.set_attr_overrides(params, '5b1a', token)
+        self.assertIn('ambiguous', error.exception.message)
+
+        params['data'] = '{"pressure": "10"}'
+        with self.assertRaises(HTTPRequestError):
+            DeviceHandler.set_attr_overrides(params, '5b1a', token)
+
+        db_mock.session.execute.return_value.rowcount = 0
+        params['data'] = '{"3": "10"}'
+        with self.assertRaises(HTTPRequestError) as error:
+            DeviceHandler.set_attr_overrides(params, '5b1a', token)
+        self.assertEqual(error.exception.error_code, 404)
+
+    @patch('DeviceManager.DeviceHandler.db')
+    def test_set_bulk_attr_overrides(self, db_mock):
+        db_mock.session = AlchemyMagicMock()
+        token = generate_token()
+        db_mock.session.query.return_value.filter.return_value.all.return_value = [(3, 'firmware')]
+        db_mock.session.query.return_value.options.return_value.filter.return_value.all.return_value = [
+            Device(id='00001', label='sensor_1', templates=[], overrides=[]),
+            Device(id='00002', label='sensor_2', templates=[], overrides=[])
+        ]
+
+        statements = []
+        def execute(statement, *args):
+            statements.append(statement)
+            return [('00001',), ('00002',)] if hasattr(statement, 'table') else MagicMock()
+        db_mock.session.execute.side_effect = execute
+
+        data = '{"selector": {"template": 1, "label": "sensor_"}, "attrs": {"firmware": "http://fw/2.0"}}'
+        with patch.object(KafkaInstanceHandler, "getInstance", return_value=MagicMock()) as kafka_mock:
+            params = {'content_type': 'application/json', 'data': data}
+            result = DeviceHandler.set_bulk_attr_overrides(params, token)
+
+        self.assertEqual(result['devices'], ['00001', '00002'])
+        # keys are resolved against the static attributes of the templates of the selected devices
+        resolution = str(db_mock.session.query.return_value.filter.call_args_list[0][0][0]
+                         .compile(dialect=postgresql.dialect()))
+        self.assertIn('attrs.type = %(type_1)s AND attrs.template_id IN (SELECT device_template.template_id',
+                      resolution)
+        self.assertIn('LIKE', resolution)
+        sql = [str(statement.compile(dialect=postgresql.dialect()))
+               for statement in statements if hasattr(statement, 'table')]
+        self.assertTrue(sql[0].startswith('INSERT INTO overrides (id, did, aid, static_value) SELECT'))
+        self.assertIn('ON CONFLICT ON CONSTRAINT overrides_did_aid_key DO UPDATE', sql[0])
+        self.assertIn('LIKE', sql[0])
+        self.assertTrue(sql[1].startswith('UPDATE devices'))
+
+        # null values remove the overrides of the resolved attributes
+        statements.clear()
+        data = '{"selector": {"ids": ["00001"]}, "attrs": {"firmware": null}}'
+        with patch.object(KafkaInstanceHandler, "getInstance", return_value=MagicMock()):
+            DeviceHandler.set_bulk_attr_overrides({'content_type': 'application/json', 'data': data}, token)
+        delete = [statement for statement in statements if hasattr(statement, 'table')][0].compile(
+            dialect=postgresql.dialect())
+        self.assertTrue(str(delete).startswith('DELETE FROM overrides'))
+        self.assertEqual(set(delete.params.values()), {'00001', 3})
+
+        # a single batch of notifications
+        update_many = kafka_mock.return_value.update_many
+        update_many.assert_called_once()
+        self.assertEqual([device['id'] for device in update_many.call_args[0][0]], ['00001', '00002'])
+
+    @patch('DeviceManager.DeviceHandler.db')
+    def test_set_bulk_attr_overrides_errors(self, db_mock):
+        db_mock.session = AlchemyMagicMock()
+        token = generate_token()
+        db_mock.session.query.return_value.filter.return_value.all.return_value = [(3, 'firmware')]
+
+        params = {'content_type': 'application/json'}
+        invalid = [
+            '{"attrs": {"firmware": "1.0"}}',
+            '{"selector": {}, "attrs": {"firmware": "1.0"}}',
+            '{"selector": {"ids": "00001"}, "attrs": {"firmware": "1.0"}}',
+            '{"selector": {"template": 1}, "attrs": {}}',
+            '{"selector": {"template": 1}, "attrs": {"firmware": [1]}}',
+            '{"selector": {"template": 1}, "attrs": {"version": "1.0"}}',
+            '{"selector": {"template": 1}, "attrs": {"firmware": "1.0", "3": "2.0"}}'
+        ]
+        for data in invalid:
+            params['data'] = data
+            with self.assertRaises(HTTPRequestError):
+                DeviceHandler.set_bulk_attr_overrides(params, token)
+
+    @patch('DeviceManager.DeviceHandler.db')
+    def test_attach_template(self, db_mock):
+        db_mock.session = AlchemyMagicMock()
+        token = generate_token()
+        db_mock.session.query.return_value.filter.return_value.all.return_value = [
+            Device(id='00001', label='sensor_1', templates=[], overrides=[])]
+
+        statements = []
+        def execute(statement, *args):
+            if not hasattr(statement, 'compile'):
+                return MagicMock()
+            sql = str(statement.compile(dialect=postgresql.dialect()))
+            statements.append(sql)
+            if sql.startswith('SELECT DISTINCT device_template.device_id'):
+                return [('00002', 'temperature', 'dynamic')]
+            if sql.startswith('INSERT INTO device_template'):
+                return [('00001',)]
+            return MagicMock()
+        db_mock.session.execute.side_effect = execute
+
+        params = {'content_type': 'application/json', 'data': '{"selector": {"label": "sensor_"}}'}
+        with patch('DeviceManager.DeviceHandler.assert_template_exists'), \
+                patch.object(KafkaInstanceHandler, "getInstance", return_value=MagicMock()) as kafka_mock:
+            result = DeviceHandler.attach_template(params, '4', token)
+
+        self.assertEqual(result['devices'], ['00001'])
+        self.assertEqual(result['conflicts'], {'00002': [{'label': 'temperature', 'type': 'dynamic'}]})
+        insert = [sql for sql in statements if sql.startswith('INSERT INTO device_template')][0]
+        self.assertIn('SELECT devices.id', insert)
+        self.assertIn('ON CONFLICT DO NOTHING', insert)
+        self.assertEqual(kafka_mock.return_value.update_many.call_count, 1)
+
+        for data in ['{}', '{"selector": {}}', '[]']:
+            params['data'] = data
+            with self.assertRaises(HTTPRequestError):
+                DeviceHandler.attach_template(params, '4', token)
+        params['data'] = '{"selector": {"label": "sensor_"}}'
+        with self.assertRaises(HTTPRequestError):
+            DeviceHandler.attach_template(params, 'four', token)
+
+    @patch('DeviceManager.DeviceHandler.db')
+    def test_detach_template(self, db_mock):
+        db_mock.session = AlchemyMagicMock()
+        token = generate_token()
+        db_mock.session.query.return_value.filter.return_value.all.return_value = []
+
+        statements = []
+        def execute(statement, *args):
+            if not hasattr(statement, 'compile'):
+                return MagicMock()
+            sql = str(statement.compile(dialect=postgresql.dialect()))
+            statements.append(sql)
+            if sql.startswith('DELETE FROM device_template'):
+                return [('00001',)]
+            return MagicMock()
+        db_mock.session.execute.side_effect = execute
+
+        params = {'content_type': 'application/json', 'data': '{"selector": {"ids": ["00001"]}}'}
+        with patch('DeviceManager.DeviceHandler.assert_template_exists') as exists_mock, \
+                patch.object(KafkaInstanceHandler, "getInstance", return_value=MagicMock()):
+            result = DeviceHandler.detach_template(params, '4', token)
+            exists_mock.assert_called_once_with(4)
+        self.assertEqual(result['devices'], ['00001'])
+
+        # unknown templates are reported, rather than detached from no device
+        with patch('DeviceManager.DeviceHandler.assert_template_exists',
+                   side_effect=HTTPRequestError(404, "No such template: 4")):
+            with pytest.raises(HTTPRequestError) as error:
+                DeviceHandler.detach_template(params, '4', token)
+            self.assertEqual(error.value.error_code, 404)
+
+    @patch('DeviceManager.DeviceHandler.db')
+    def test_move_template(self, db_mock):
+        db_mock.session = AlchemyMagicMock()
+        token = generate_token()
+        db_mock.session.query.return_value.filter.return_value.all.return_value = []
+
+        statements = []
+        def execute(statement, *args):
+            if not hasattr(statement, 'compile'):
+                return MagicMock()
+            sql = str(statement.compile(dialect=postgresql.dialect()))
+            statements.append(sql)
+            if sql.startswith('SELECT DISTINCT device_template.device_id'):
+                return []
+            if sql.startswith('DELETE FROM device_template'):
+                return [('00001',), ('00002',)]
+            if sql.startswith('INSERT INTO device_template'):
+                return [('00001',), ('00002',)]
+            return MagicMock()
+        db_mock.session.execute.side_effect = execute
+
+        with patch('DeviceManager.DeviceHandler.assert_template_exists'), \
+                patch.object(KafkaInstanceHandler, "getInstance", return_value=MagicMock()):
+            result = DeviceHandler.move_template({'data': b''}, '4', '5', token)
+
+        self.assertEqual(result['devices'], ['00001', '00002'])
+        self.assertEqual(result['conflicts'], {})
+        changes = [sql.split(' ')[0] + ' ' + sql.split(' ')[2] for sql in statements
+                   if sql.startswith(('DELETE', 'INSERT'))]
+        self.assertEqual(changes, ['DELETE overrides', 'DELETE pre_shared_keys',
+                                   'DELETE device_template', 'INSERT device_template'])
+
+        with self.assertRaises(HTTPRequestError):
+            DeviceHandler.move_template({'data': b''}, '4', '4', token)
+
     @patch('DeviceManager.DeviceHandler.db')
     @patch('flask_sqlalchemy._QueryProperty.__get__')
     def test_configure_device(self, db_mock_session, query_property_getter_mock):
@@ -360,9 +831,43 @@ class TestDeviceHandler(unittest.TestCase):
             with patch("DeviceManager.DeviceHandler.retrieve_auth_token") as auth_mock:
                 auth_mock.return_value = generate_token()
                 result = flask_delete_all_device()
-                self.assertFalse(json.loads(result.response[0])['removed_devices'])
-                self.assertEqual(json.loads(result.response[0])['result'], 'ok')
-                
+                self.assertTrue(result.is_streamed)
+                self.assertFalse(json.loads(result.get_data())['removed_devices'])
+                self.assertEqual(json.loads(result.get_data())['result'], 'ok')
+
+    def test_endpoint_delete_all_devices_errors(self):
+        def batches(error, removed=()):
+            for device_ids in removed:
+                yield device_ids
+            raise error
+
+        with self.app.test_request_context():
+            with patch("DeviceManager.DeviceHandler.retrieve_auth_token") as auth_mock, \
+                    patch("DeviceManager.DeviceHandler.db"), \
+                    patch.object(DeviceHandler, "delete_all_devices") as mock_delete:
+                auth_mock.return_value = generate_token()
+
+                # failing to remove the first batch is reported by the status code
+                mock_delete.return_value = batches(HTTPRequestError(400, "Selector template must be a template id"))
+                result = flask_delete_all_device()
+                self.assertEqual(result.status, '400 BAD REQUEST')
+
+                # later failures end the (already started) response
+                mock_delete.return_value = batches(HTTPRequestError(500, "Failed to remove devices"),
+                                                   [['0001', '0002']])
+                result = flask_delete_all_device()
+                self.assertEqual(result.status, '200 OK')
+                body = json.loads(result.get_data())
+                self.assertEqual(body['removed_devices'], ['0001', '0002'])
+                self.assertEqual(body['result'], 'error')
+                self.assertEqual(body['message'], 'Failed to remove devices')
+
+    def test_selector_label(self):
+        sql = device_selector({'label': 'sensor_'})[0].compile(dialect=postgresql.dialect())
+        # the same match as GET /device?label=
+        self.assertEqual(str(sql), str(label_condition('sensor_').compile(dialect=postgresql.dialect())))
+        self.assertEqual(list(sql.params.values()), ['%sensor_%'])
+
     @patch('DeviceManager.DeviceHandler.db')
     @patch('flask_sqlalchemy._QueryProperty.__get__')
     def test_endpoint_get_device(self, db_mock, query_property_getter_mock):
@@ -0,0 +1,61 @@
+import pytest
+import re
+import unittest
+from sqlalchemy.exc import DataError
+
+from DeviceManager.IdAllocator import permute, format_id, allocate_device_ids, id_space_usage
+from DeviceManager.IdAllocator import ID_SPACE
+from DeviceManager.utils import HTTPRequestError
+
+from alchemy_mock.mocking import AlchemyMagicMock
+
+
+class TestIdAllocator(unittest.TestCase):
+
+    def test_permute_is_bijective(self):
+        sample = [permute(value) for value in range(0, ID_SPACE, 97)]
+        self.assertEqual(len(set(sample)), len(sample))
+        self.assertTrue(all(0 <= value < ID_SPACE for value in sample))
+
+        edges = [permute(value) for value in list(range(4096)) + list(range(ID_SPACE - 4096, ID_SPACE))]
+        self.assertEqual(len(set(edges)), len(edges))
+
+    def test_format_id(self):
+        regex = re.compile(r'^[0-9a-f]{5,6}$')
+        for value in (0, 1, 2, 1000, ID_SPACE - 1):
+            self.assertRegex(format_id(value), regex)
+        self.assertNotEqual(format_id(1), format_id(2))
+
+    def test_allocate(self):
+        session = AlchemyMagicMock()
+        session.execute.return_value.fetchall.return_value = [(1,), (2,), (3,)]
+        session.query.return_value.filter.return_value.all.return_value = []
+
+        ids = allocate_device_ids(session, 3)
+        self.assertEqual(ids, [format_id(1), format_id(2), format_id(3)])
+        session.execute.assert_called_once()
+
+    def test_allocate_skips_ids_in_use(self):
+        session = AlchemyMagicMock()
+        session.execute.return_value.fetchall.side_effect = [[(1,), (2,)], [(3,)]]
+        session.query.return_value.filter.return_value.all.side_effect = [[(format_id(1),)], []]
+
+        ids = allocate_device_ids(session, 2)
+        self.assertEqual(ids, [format_id(2), format_id(3)])
+
+    def test_allocate_exhausted(self):
+        session = AlchemyMagicMock()
+        session.execute.side_effect = DataError('nextval', {}, Exception('reached maximum value'))
+        with pytest.raises(HTTPRequestError):
+            allocate_device_ids(session, 1)
+
+    def test_id_space_usage(self):
+        session = AlchemyMagicMock()
+        session.execute.return_value.scalar.return_value = 10
+        session.query.return_value.count.return_value = 8
+
+        usage = id_space_usage(session)
+        self.assertEqual(usage['capacity'], ID_SPACE)
+        self.assertEqual(usage['allocated'], 10)
+        self.assertEqual(usage['available'], ID_SPACE - 10)
+        self.assertEqual(usage['devices'], 8)
@@ -0,0 +1,225 @@
+import json
+import pytest
+import unittest
+from unittest.mock import MagicMock, patch
+
+from flask import Flask
+from sqlalchemy.dialects import postgresql
+
+from DeviceManager.DatabaseModels import Job
+from DeviceManager.JobHandler import JobHandler, JobWorkers, JobLease, JOB_RUNNERS, CLAIM_JOB
+from DeviceManager.JobHandler import register_job, is_async, serialize_job, flask_get_job
+from DeviceManager.TemplateHandler import flask_delete_all_templates
+from DeviceManager.utils import HTTPRequestError, get_allowed_service
+
+from .token_test_generator import generate_token
+
+from alchemy_mock.mocking import AlchemyMagicMock
+
+
+class TestJobHandler(unittest.TestCase):
+
+    app = Flask(__name__)
+
+    @patch('DeviceManager.JobHandler.db')
+    def test_submit(self, db_mock):
+        db_mock.session = AlchemyMagicMock()
+        token = generate_token()
+
+        result = JobHandler.submit('import', {'data': b'{"templates": []}', 'content_type': 'application/json'}, token)
+
+        job = result['job']
+        self.assertEqual(job['kind'], 'import')
+        self.assertEqual(job['status'], 'pending')
+        self.assertEqual(job['progress'], 0)
+        self.assertIsNone(job['result'])
+        self.assertNotIn('params', job)
+
+        orm_job = db_mock.session.add.call_args[0][0]
+        self.assertEqual(orm_job.id, job['id'])
+        stored = json.loads(orm_job.params)
+        # the token itself is not kept, only what the job needs of it
+        self.assertEqual(stored['claims'], {'service': 'admin'})
+        self.assertNotIn(token, orm_job.params)
+        self.assertEqual(stored['params']['data'], '{"templates": []}')
+
+    @patch('DeviceManager.JobHandler.db')
+    def test_get_job(self, db_mock):
+        db_mock.session = AlchemyMagicMock()
+        token = generate_token()
+        orm_job = Job(id='1', kind='template.delete_all', status='done', progress=0,
+                      params='{}', result='{"result": "ok", "removed": []}')
+        db_mock.session.query.return_value.filter_by.return_value.one_or_none.return_value = orm_job
+
+        result = JobHandler.get_job('1', token)
+        self.assertEqual(result['status'], 'done')
+        self.assertEqual(result['result'], {'result': 'ok', 'removed': []})
+        self.assertIsNone(result['error'])
+
+        db_mock.session.query.return_value.filter_by.return_value.one_or_none.return_value = None
+        with pytest.raises(HTTPRequestError) as error:
+            JobHandler.get_job('2', token)
+        self.assertEqual(error.value.error_code, 404)
+
+    def test_claim_skips_locked_jobs(self):
+        sql = str(CLAIM_JOB.compile(dialect=postgresql.dialect()))
+        self.assertIn('FOR UPDATE SKIP LOCKED', sql)
+        # jobs whose lease expired are claimed again
+        self.assertIn("status = 'running' AND locked_until < %(now)s", sql)
+        self.assertIn('RETURNING id, kind, params, attempts', sql)
+
+    @patch('DeviceManager.JobHandler.switch_tenant')
+    @patch('DeviceManager.JobHandler.db')
+    def test_claim(self, db_mock, switch_mock):
+        db_mock.session = AlchemyMagicMock()
+        db_mock.session.execute.return_value.fetchone.return_value = ('1', 'import', '{}', 2)
+
+        workers = JobWorkers(workers=0, lease=30, max_attempts=3)
+        self.assertEqual(workers.claim('admin'), ('1', 'import', '{}', 2))
+
+        (expire, expire_params), (claim, claim_params) = [call[0] for call in db_mock.session.execute.call_args_list]
+        self.assertIn("'failed'", str(expire))
+        self.assertEqual(expire_params['max_attempts'], 3)
+        self.assertEqual((claim_params['locked_until'] - claim_params['now']).total_seconds(), 30)
+        switch_mock.assert_called_once_with('admin', db_mock)
+
+    @patch('DeviceManager.JobHandler.db')
+    def test_claimable_tenants(self, db_mock):
+        db_mock.session = AlchemyMagicMock()
+        queries = []
+
+        def execute(statement, params=None):
+            queries.append((str(statement), params))
+            return [('admin',), ('other',)] if len(queries) == 1 else [('other',)]
+        db_mock.session.execute.side_effect = execute
+
+        self.assertEqual(JobWorkers.claimable_tenants(), ['other'])
+        # every tenant is checked by a single query
+        self.assertEqual(len(queries), 2)
+        sql, params = queries[1]
+        self.assertIn('FROM "admin".jobs', sql)
+        self.assertIn('FROM "other".jobs', sql)
+        self.assertEqual((params['tenant_0'], params['tenant_1']), ('admin', 'other'))
+
+    @patch('DeviceManager.JobHandler.switch_tenant')
+    @patch('DeviceManager.JobHandler.db')
+    def test_lease_renew(self, db_mock, switch_mock):
+        db_mock.session = AlchemyMagicMock()
+        JobLease('admin', '1', 2, 60).renew()
+
+        statement = db_mock.session.execute.call_args[0][0]
+        params = statement.compile(dialect=postgresql.dialect()).params
+        self.assertEqual(params['attempts_1'], 2)
+        self.assertIsNotNone(params['locked_until'])
+        db_mock.session.commit.assert_called_with()
+
+    @patch('DeviceManager.JobHandler.switch_tenant')
+    @patch('DeviceManager.JobHandler.db')
+    def test_execute(self, db_mock, switch_mock):
+        db_mock.session = AlchemyMagicMock()
+        statements = []
+        db_mock.session.execute.side_effect = lambda statement, *args: statements.append(
+            statement.compile(dialect=postgresql.dialect()).params)
+
+        @register_job('test.count')
+        def run_count(params, token, progress):
+            progress(1)
+            progress(2)
+            return {'count': params['count'], 'service': get_allowed_service(token)}
+
+        try:
+            workers = JobWorkers(workers=0)
+            params = json.dumps({'params': {'count': 2}, 'claims': {'service': 'admin'}})
+            workers.execute('admin', '1', 'test.count', params, 1)
+        finally:
+            del JOB_RUNNERS['test.count']
+
+        self.assertEqual([statement['progress'] for statement in statements[:2]], [1, 2])
+        self.assertEqual(statements[-1]['status'], 'done')
+        self.assertEqual(json.loads(statements[-1]['result']), {'count': 2, 'service': 'admin'})
+        self.assertIsNotNone(statements[-1]['finished'])
+        self.assertIsNone(statements[-1]['locked_until'])
+        # only this attempt's outcome is recorded
+        self.assertEqual(statements[-1]['attempts_1'], 1)
+        self.assertEqual(workers.stats(), {'running': 0, 'done': 1, 'failed': 0})
+
+    @patch('DeviceManager.JobHandler.switch_tenant')
+    @patch('DeviceManager.JobHandler.db')
+    def test_execute_failure(self, db_mock, switch_mock):
+        db_mock.session = AlchemyMagicMock()
+        statements = []
+        db_mock.session.execute.side_effect = lambda statement, *args: statements.append(
+            statement.compile(dialect=postgresql.dialect()).params)
+
+        @register_job('test.fail')
+        def run_fail(params, token, progress):
+            raise HTTPRequestError(400, {'message': 'Templates in use', 'templates': [1]})
+
+        try:
+            workers = JobWorkers(workers=0)
+            params = json.dumps({'params': {}, 'claims': {'service': 'admin'}})
+            workers.execute('admin', '1', 'test.fail', params, 1)
+            workers.execute('admin', '2', 'test.unknown', params, 1)
+        finally:
+            del JOB_RUNNERS['test.fail']
+
+        self.assertEqual(statements[0]['status'], 'failed')
+        self.assertEqual(json.loads(statements[0]['error']), {'message': 'Templates in use', 'templates': [1]})
+        self.assertEqual(json.loads(statements[1]['error']), 'Unknown job kind: test.unknown')
+        # nothing the job did is committed along with its outcome
+        self.assertEqual(db_mock.session.rollback.call_count, 2)
+        self.assertEqual(workers.stats()['failed'], 2)
+
+    def test_work(self):
+        workers = JobWorkers(workers=0)
+        workers.claimable_tenants = MagicMock(return_value=['admin', 'other'])
+        workers.claim = MagicMock(side_effect=[None, ('1', 'import', '{}', 1)])
+        workers.execute = MagicMock()
+
+        self.assertTrue(workers.work())
+        workers.execute.assert_called_once_with('other', '1', 'import', '{}', 1)
+
+        workers.claim = MagicMock(return_value=None)
+        self.assertFalse(workers.work())
+
+    def test_serialize_job(self):
+        orm_job = Job(id='1', kind='import', status='failed', progress=0,
+                      params='{"claims": {"service": "admin"}}', error='"No such template: 1"')
+        result = serialize_job(orm_job)
+        self.assertNotIn('params', result)
+        self.assertEqual(result['error'], 'No such template: 1')
+
+    def test_is_async(self):
+        with self.app.test_request_context('/template?async=true'):
+            from flask import request
+            self.assertTrue(is_async(request))
+        with self.app.test_request_context('/template'):
+            from flask import request
+            self.assertFalse(is_async(request))
+
+    def test_endpoint_get_job(self):
+        with self.app.test_request_context():
+            with patch("DeviceManager.JobHandler.retrieve_auth_token") as auth_mock:
+                auth_mock.return_value = generate_token()
+
+                with patch.object(JobHandler, "get_job") as mock_job:
+                    mock_job.return_value = {'id': '1', 'status': 'running', 'progress': 10}
+                    result = flask_get_job('1')
+                    self.assertEqual(result.status, '200 OK')
+
+                    mock_job.side_effect = HTTPRequestError(404, "No such job: 1")
+                    result = flask_get_job('1')
+                    self.assertEqual(result.status, '404 NOT FOUND')
+
+    def test_endpoint_async(self):
+        with self.app.test_request_context('/template?async=true'):
+            with patch("DeviceManager.TemplateHandler.retrieve_auth_token") as auth_mock:
+                auth_mock.return_value = generate_token()
+
+                with patch.object(JobHandler, "submit") as mock_submit:
+                    mock_submit.return_value = {'job': {'id': '1', 'status': 'pending'}}
+                    result = flask_delete_all_templates()
+                    self.assertEqual(result.status, '202 ACCEPTED')
+                    self.assertEqual(json.loads(result.response[0])['job']['id'], '1')
+                    mock_submit.assert_called_once_with('template.delete_all', {'verbose': False},
+                                                        auth_mock.return_value)
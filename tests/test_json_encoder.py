@@ -0,0 +1,40 @@
+import json
+import unittest
+from datetime import datetime
+from unittest.mock import patch
+
+from DeviceManager.app import app
+from DeviceManager import JsonEncoder
+
+
+class TestJsonEncoder(unittest.TestCase):
+
+    document = {'id': '5b1a', 'created': datetime(2018, 3, 1, 10, 30), 'attrs': {1: [{'id': 3}]}}
+
+    def test_stdlib_dumps(self):
+        data = JsonEncoder.stdlib_dumps(self.document)
+        self.assertIsInstance(data, bytes)
+        self.assertEqual(json.loads(data.decode()), {
+            'id': '5b1a', 'created': '2018-03-01T10:30:00', 'attrs': {'1': [{'id': 3}]}
+        })
+
+    def test_select_backend(self):
+        self.assertEqual(JsonEncoder.select_backend('json'), JsonEncoder.stdlib_dumps)
+        with patch('DeviceManager.JsonEncoder.orjson', None):
+            self.assertEqual(JsonEncoder.select_backend('auto'), JsonEncoder.stdlib_dumps)
+            self.assertEqual(JsonEncoder.select_backend('orjson'), JsonEncoder.stdlib_dumps)
+
+    def test_backends_agree(self):
+        if JsonEncoder.orjson is None:
+            self.skipTest('orjson is not installed')
+        self.assertEqual(json.loads(JsonEncoder.orjson_dumps(self.document)),
+                         json.loads(JsonEncoder.stdlib_dumps(self.document)))
+
+    def test_jsonify(self):
+        with app.test_request_context():
+            response = JsonEncoder.jsonify({'message': 'ok'})
+            self.assertEqual(response.mimetype, 'application/json')
+            self.assertEqual(json.loads(response.get_data()), {'message': 'ok'})
+
+            response = JsonEncoder.jsonify(message='ok', status=200)
+            self.assertEqual(json.loads(response.get_data()), {'message': 'ok', 'status': 200})
@@ -39,6 +39,23 @@ class TestKafkaNotifier(unittest.TestCase):
             with patch.object(KafkaNotifier, "get_topic", return_value=None):
                 self.assertIsNone(KafkaNotifier().send_notification(DeviceEvent.CREATE, data, meta={"service": 'admin'}))
 
+    def test_send_notifications(self):
+        devices = [{'label': 'device_{}'.format(i), 'id': str(i), 'templates': [1], 'attrs': {}}
+                   for i in range(3)]
+
+        with patch.object(KafkaNotifier, "__init__", lambda x: None):
+            KafkaNotifier.kf_prod = Mock()
+            with patch.object(KafkaNotifier, "get_topic", return_value='topic'):
+                KafkaNotifier().send_notifications(DeviceEvent.UPDATE, devices, meta={"service": 'admin'})
+            self.assertEqual(KafkaNotifier.kf_prod.send.call_count, 3)
+            KafkaNotifier.kf_prod.flush.assert_called_once()
+
+            # nothing is sent when the topic is unknown
+            KafkaNotifier.kf_prod = Mock()
+            with patch.object(KafkaNotifier, "get_topic", return_value=None):
+                KafkaNotifier().send_notifications(DeviceEvent.UPDATE, devices, meta={"service": 'admin'})
+            KafkaNotifier.kf_prod.send.assert_not_called()
+
     def test_send_raw(self):
         event = {
             "event": DeviceEvent.TEMPLATE,
@@ -0,0 +1,72 @@
+import pytest
+import unittest
+from unittest.mock import Mock, MagicMock, patch
+
+from DeviceManager.QueryCache import QueryCache, bump_generation, current_generation
+
+from alchemy_mock.mocking import AlchemyMagicMock
+
+
+class TestQueryCache(unittest.TestCase):
+
+    def test_normalize(self):
+        first = QueryCache.normalize({'attr': ['b=2', 'a=1'], 'label': 'dev', 'page_number': 1})
+        second = QueryCache.normalize({'page_number': 1, 'label': 'dev', 'attr': ['a=1', 'b=2']})
+        self.assertEqual(first, second)
+        self.assertEqual(hash(first), hash(second))
+
+    def test_get_put(self):
+        cache = QueryCache(10)
+        self.assertIsNone(cache.get('admin', 1, 'key'))
+
+        cache.put('admin', 1, 'key', {'devices': []})
+        self.assertEqual(cache.get('admin', 1, 'key'), {'devices': []})
+        self.assertIsNone(cache.get('other', 1, 'key'))
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 2)
+
+    def test_new_generation_invalidates_tenant(self):
+        cache = QueryCache(10)
+        cache.put('admin', 1, 'key', 'old')
+        cache.put('other', 1, 'key', 'other')
+
+        self.assertIsNone(cache.get('admin', 2, 'key'))
+        cache.put('admin', 2, 'key', 'new')
+        self.assertEqual(cache.get('admin', 2, 'key'), 'new')
+        self.assertIsNone(cache.get('admin', 1, 'key'))
+        self.assertEqual(cache.get('other', 1, 'key'), 'other')
+
+        # results computed before a write must not be stored
+        cache.put('admin', 1, 'late', 'stale')
+        self.assertIsNone(cache.get('admin', 1, 'late'))
+
+    def test_eviction(self):
+        cache = QueryCache(2)
+        cache.put('admin', 1, 'a', 'a')
+        cache.put('admin', 1, 'b', 'b')
+        cache.get('admin', 1, 'a')
+        cache.put('admin', 1, 'c', 'c')
+
+        self.assertEqual(cache.get('admin', 1, 'a'), 'a')
+        self.assertIsNone(cache.get('admin', 1, 'b'))
+        self.assertEqual(cache.get('admin', 1, 'c'), 'c')
+
+    def test_disabled(self):
+        cache = QueryCache(0)
+        cache.put('admin', 1, 'key', 'value')
+        self.assertIsNone(cache.get('admin', 1, 'key'))
+
+        cache = QueryCache(10)
+        cache.put('admin', None, 'key', 'value')
+        self.assertIsNone(cache.get('admin', None, 'key'))
+
+    def test_generation(self):
+        session = AlchemyMagicMock()
+        self.assertIsNone(bump_generation(session))
+        session.execute.assert_called_once()
+
+        session.execute.return_value.scalar.return_value = 7
+        self.assertEqual(current_generation(session), 7)
+
+        session.execute.return_value.scalar.return_value = None
+        self.assertIsNone(current_generation(session))
@@ -0,0 +1,119 @@
+import pytest
+import json
+import threading
+import unittest
+from unittest.mock import Mock, MagicMock, patch
+from flask import Flask
+
+from DeviceManager.RequestCoalescer import SingleFlight, coalesced, freeze
+from DeviceManager.MetricsHandler import flask_get_metrics
+from DeviceManager.utils import HTTPRequestError
+
+from .token_test_generator import generate_token
+
+
+class TestRequestCoalescer(unittest.TestCase):
+
+    app = Flask(__name__)
+
+    def test_freeze(self):
+        self.assertEqual(freeze({'attr': ['a', 'b'], 'label': None}),
+                         freeze({'label': None, 'attr': ['a', 'b']}))
+        self.assertEqual(freeze(('device_id', True)), ('device_id', True))
+        self.assertEqual(freeze('device_id'), 'device_id')
+
+    def test_concurrent_calls_are_collapsed(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def query():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return {'id': 'efac'}
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flight.do('key', query)))
+        leader.start()
+        started.wait()
+
+        followers = [threading.Thread(target=lambda: results.append(flight.do('key', query)))
+                     for _ in range(3)]
+        for follower in followers:
+            follower.start()
+        while flight.stats()['followers'] < 3:
+            pass
+        release.set()
+
+        leader.join()
+        for follower in followers:
+            follower.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'id': 'efac'}] * 4)
+        # every request gets its own copy of the result
+        self.assertEqual(len(set(id(result) for result in results)), 4)
+        stats = flight.stats()
+        self.assertEqual(stats['leaders'], 1)
+        self.assertEqual(stats['followers'], 3)
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertEqual(stats['collapse_ratio'], 0.75)
+
+    def test_errors_are_shared(self):
+        flight = SingleFlight()
+
+        def query():
+            raise HTTPRequestError(404, "No such device: efac")
+
+        with self.assertRaises(HTTPRequestError):
+            flight.do('key', query)
+
+        # once finished, a new call is executed again
+        self.assertEqual(flight.do('key', lambda: 'ok'), 'ok')
+        self.assertEqual(flight.stats()['leaders'], 2)
+
+    def test_coalesced_decorator(self):
+        handler = Mock(return_value='result')
+        wrapped = coalesced('device', lambda token: 7)(handler)
+        token = generate_token()
+
+        with patch('DeviceManager.RequestCoalescer.READ_COALESCER') as coalescer_mock:
+            coalescer_mock.do.side_effect = lambda key, fn: fn()
+            self.assertEqual(wrapped(token, 'efac', sensitive_data=True), 'result')
+            handler.assert_called_once_with(token, 'efac', sensitive_data=True)
+            # flights are keyed by the write generation
+            key = coalescer_mock.do.call_args[0][0]
+            self.assertEqual(key[:3], ('admin', 'device', 7))
+
+        with self.assertRaises(ValueError):
+            wrapped(None, 'efac')
+
+    def test_coalesced_generation_changes(self):
+        generations = [1, 1, 2]
+        handler = Mock(side_effect=lambda token, device_id: {'id': device_id})
+        wrapped = coalesced('device', lambda token: generations.pop(0))(handler)
+        token = generate_token()
+
+        with patch('DeviceManager.RequestCoalescer.READ_COALESCER') as coalescer_mock:
+            coalescer_mock.do.side_effect = lambda key, fn: fn()
+            for _ in range(3):
+                wrapped(token, 'efac')
+            keys = [args[0] for args, _ in coalescer_mock.do.call_args_list]
+            self.assertEqual(keys[0], keys[1])
+            self.assertNotEqual(keys[1], keys[2])
+
+            # with no known generation, calls are not coalesced at all
+            coalescer_mock.do.reset_mock()
+            wrapped = coalesced('device', lambda token: None)(handler)
+            self.assertEqual(wrapped(token, 'efac'), {'id': 'efac'})
+            coalescer_mock.do.assert_not_called()
+
+    def test_endpoint_get_metrics(self):
+        with self.app.test_request_context():
+            result = flask_get_metrics()
+            self.assertEqual(result.status, '200 OK')
+            payload = json.loads(result.response[0])
+            self.assertIn('collapse_ratio', payload['coalescing'])
+            self.assertIn('hits', payload['listing_cache'])
@@ -0,0 +1,67 @@
+import pytest
+import unittest
+
+from DeviceManager.SerializationModels import DEVICE_FIELDS, TEMPLATE_FIELDS
+from DeviceManager.SerializationModels import parse_fields, dotted_fields
+from DeviceManager.SerializationModels import template_schema, template_format_schema
+from DeviceManager.DatabaseModels import DeviceTemplate, DeviceAttr
+from DeviceManager.utils import HTTPRequestError
+
+
+class TestSerializationModels(unittest.TestCase):
+
+    def test_parse_fields(self):
+        self.assertIsNone(parse_fields(None, DEVICE_FIELDS))
+        self.assertIsNone(parse_fields(' , ', DEVICE_FIELDS))
+
+        fields = parse_fields('id, label,attrs.label,attrs.type', DEVICE_FIELDS)
+        self.assertEqual(fields, {
+            'id': frozenset(),
+            'label': frozenset(),
+            'attrs': frozenset(['label', 'type'])
+        })
+
+        # requesting the whole field supersedes any sub-field selection
+        fields = parse_fields('attrs.label,attrs', DEVICE_FIELDS)
+        self.assertEqual(fields, {'attrs': frozenset()})
+
+    def test_parse_fields_unknown(self):
+        with pytest.raises(HTTPRequestError):
+            parse_fields('id,persistence', DEVICE_FIELDS)
+
+        with pytest.raises(HTTPRequestError):
+            parse_fields('attrs.unknown', TEMPLATE_FIELDS)
+
+        with pytest.raises(HTTPRequestError):
+            parse_fields('label.id', TEMPLATE_FIELDS)
+
+    def test_dotted_fields(self):
+        fields = parse_fields('label,data_attrs.label,data_attrs.id', TEMPLATE_FIELDS)
+        self.assertEqual(dotted_fields(fields),
+                         frozenset(['label', 'data_attrs.label', 'data_attrs.id']))
+
+    def test_template_attr_lists(self):
+        template = DeviceTemplate(id=1, label='SensorModel', attrs=[
+            DeviceAttr(id=1, label='temperature', type='dynamic', value_type='float'),
+            DeviceAttr(id=2, label='protocol', type='meta', value_type='string', static_value='mqtt')
+        ])
+
+        result = template_schema.dump(template)
+        self.assertEqual([attr['label'] for attr in result['attrs']], ['temperature', 'protocol'])
+        self.assertEqual([attr['label'] for attr in result['data_attrs']], ['temperature'])
+        self.assertEqual([attr['label'] for attr in result['config_attrs']], ['protocol'])
+
+        result = template_format_schema(None, frozenset([('data_attrs', frozenset()),
+                                                         ('config_attrs', frozenset())])).dump(template)
+        self.assertNotIn('attrs', result)
+        self.assertEqual(len(result['data_attrs']), 1)
+
+        # each list keeps its own attribute fields
+        result = template_format_schema(
+            frozenset(['label', 'attrs.id', 'attrs.label']),
+            frozenset([('attrs', frozenset(['id'])), ('config_attrs', frozenset(['label']))])).dump(template)
+        self.assertEqual(result, {
+            'label': 'SensorModel',
+            'attrs': [{'id': 1}, {'id': 2}],
+            'config_attrs': [{'label': 'protocol'}]
+        })
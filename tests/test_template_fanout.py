@@ -0,0 +1,81 @@
+import json
+import unittest
+from unittest.mock import MagicMock, patch
+
+from DeviceManager.TemplateFanout import run_fanout, fanout_job, publish_devices
+from DeviceManager.TemplateHandler import TemplateHandler
+from DeviceManager.DatabaseModels import Device
+from DeviceManager.utils import HTTPRequestError
+
+from .token_test_generator import generate_token
+
+from alchemy_mock.mocking import AlchemyMagicMock
+
+
+class TestTemplateFanout(unittest.TestCase):
+
+    @patch('DeviceManager.TemplateFanout.db')
+    def test_publish_devices(self, db_mock):
+        db_mock.session = AlchemyMagicMock()
+        kafka_handler = MagicMock()
+        progress = MagicMock()
+        batches = [[Device(id='00001', label='a', templates=[], overrides=[]),
+                    Device(id='00002', label='b', templates=[], overrides=[])],
+                   [Device(id='00003', label='c', templates=[], overrides=[])]]
+
+        # device ids are read from the device_template index, page by page
+        pages = [['00001', '00002'], ['00003', '00004']]
+        with patch('DeviceManager.TemplateFanout.iter_template_device_ids',
+                   return_value=iter(pages)) as ids_mock, \
+                patch('DeviceManager.TemplateFanout.iter_devices',
+                      side_effect=[iter(batches[:1]), iter(batches[1:])]) as iter_mock:
+            result = publish_devices('admin', 1, {'id': 1}, kafka_handler, progress, batch=2)
+            ids_mock.assert_called_once_with(1, 2)
+            self.assertEqual([call[0] for call in iter_mock.call_args_list], [(pages[0], 2), (pages[1], 2)])
+
+        # 00004 was removed meanwhile
+        self.assertEqual(result, (4, 3))
+        self.assertEqual([call[0][0] for call in progress.call_args_list], [2, 3])
+        self.assertEqual(kafka_handler.update_many.call_count, 2)
+        event = kafka_handler.kafkaNotifier.send_raw.call_args[0][0]
+        self.assertEqual(event['event'], 'template.update')
+        self.assertEqual(event['data']['affected'], ['00001', '00002', '00003', '00004'])
+
+    def test_run_fanout_compact(self):
+        kafka_handler = MagicMock()
+        diff = {'added': [{'label': 'humidity'}], 'removed': [], 'changed': []}
+        params = {'template_id': 1, 'template': {'id': 1, 'label': 'sensor', 'attrs': []}, 'diff': diff}
+
+        with patch('DeviceManager.TemplateFanout.CONFIG') as config_mock, \
+                patch('DeviceManager.TemplateFanout.KafkaInstanceHandler') as kafka_mock, \
+                patch('DeviceManager.TemplateFanout.iter_template_device_ids',
+                      return_value=iter([['00001', '00002'], ['00003']])), \
+                patch('DeviceManager.TemplateFanout.iter_devices') as iter_mock:
+            config_mock.template_event_chunk = 2
+            kafka_mock.return_value.getInstance.return_value = kafka_handler
+            result = run_fanout(params, generate_token(), MagicMock())
+            # devices are not even loaded
+            iter_mock.assert_not_called()
+
+        self.assertEqual(result, {'template_id': 1, 'mode': 'compact', 'total': 3, 'published': 3})
+        kafka_handler.update_many.assert_not_called()
+        events = [item[0][0]['data'] for item in kafka_handler.kafkaNotifier.send_raw.call_args_list]
+        self.assertEqual([event['affected'] for event in events], [['00001', '00002'], ['00003']])
+        self.assertEqual([event['part'] for event in events], [1, 2])
+        self.assertEqual(events[0]['template'], {'id': 1, 'label': 'sensor'})
+        self.assertEqual(events[1]['diff'], diff)
+
+    def test_fanout_job(self):
+        orm_job = fanout_job(1, {'id': 1}, generate_token())
+        self.assertEqual(orm_job.kind, 'template.fanout')
+        self.assertEqual(orm_job.status, 'pending')
+        # the affected devices are read by the job itself
+        self.assertEqual(json.loads(orm_job.params)['params'],
+                         {'template_id': 1, 'template': {'id': 1}, 'diff': None})
+
+    def test_get_fanout(self):
+        token = generate_token()
+        with patch('DeviceManager.TemplateHandler.JobHandler') as job_handler_mock:
+            job_handler_mock.get_job.return_value = {'id': '1', 'kind': 'template.fanout'}
+            self.assertEqual(TemplateHandler.get_fanout('1', token)['id'], '1')
+            job_handler_mock.get_job.assert_called_once_with('1', token, kind='template.fanout')
@@ -3,12 +3,17 @@ import json
 import unittest
 from unittest.mock import Mock, MagicMock, patch, call
 from flask import Flask
+from sqlalchemy.dialects import postgresql
 
-from DeviceManager.DatabaseModels import DeviceTemplate
+from DeviceManager.DatabaseModels import DeviceTemplate, DeviceAttr
 from DeviceManager.TemplateHandler import TemplateHandler, flask_get_templates, flask_delete_all_templates, \
-     flask_get_template, flask_remove_template, paginate, attr_format, refresh_template_update_column
+     flask_get_template, flask_remove_template, paginate, refresh_template_update_column
+from DeviceManager.TemplateHandler import diff_attrs
+from DeviceManager.SerializationModels import ValidationError
+from DeviceManager.conf import CONFIG
 from DeviceManager.utils import HTTPRequestError
 from DeviceManager.BackendHandler import KafkaInstanceHandler
+from DeviceManager.TemplateFanout import fanout_job
 from datetime import datetime
 
 
@@ -77,6 +82,101 @@ class TestTemplateHandler(unittest.TestCase):
         self.assertEqual(result['result'], 'ok')
         self.assertIsNotNone(result['template'])
 
+    @patch('DeviceManager.TemplateHandler.db')
+    def test_create_templates(self, db_mock):
+        db_mock.session = AlchemyMagicMock()
+        token = generate_token()
+
+        data = json.dumps({'templates': [
+            {
+                'label': 'SensorModel',
+                'attrs': [
+                    {'label': 'temperature', 'type': 'dynamic', 'value_type': 'float',
+                     'metadata': [{'label': 'unit', 'type': 'meta', 'value_type': 'string',
+                                   'static_value': 'C'}]},
+                    {'label': 'model-id', 'type': 'static', 'value_type': 'string',
+                     'static_value': 'model-001'}
+                ]
+            },
+            {'label': 'Empty', 'attrs': []}
+        ]})
+        params = {'content_type': 'application/json', 'data': data}
+
+        with patch('DeviceManager.TemplateHandler.reserve_sequence_ids') as reserve_mock:
+            reserve_mock.side_effect = lambda session, sequence, count: list(range(1, count + 1))
+            result = TemplateHandler.create_templates(params, token)
+            self.assertEqual(result['result'], 'ok')
+            # ids are reserved once per sequence
+            self.assertEqual([args[2] for args, _ in reserve_mock.call_args_list], [2, 3])
+
+        # a single multi-row statement for templates, attributes and metadata
+        inserts = [args[0] for args, _ in db_mock.session.execute.call_args_list
+                   if hasattr(args[0], 'table')]
+        self.assertEqual([insert.table.name for insert in inserts], ['templates', 'attrs', 'attrs'])
+        params = inserts[2].compile(dialect=postgresql.dialect()).params
+        self.assertEqual(params['parent_id_m0'], 1)
+        self.assertIsNone(params['template_id_m0'])
+
+    @patch('DeviceManager.TemplateHandler.load_attr_trees')
+    @patch('DeviceManager.TemplateHandler.db')
+    def test_create_template_statements(self, db_mock, load_mock):
+        token = generate_token()
+
+        def count_statements(attr_count):
+            db_mock.session = AlchemyMagicMock()
+            query = db_mock.session.query.return_value.options.return_value.filter.return_value
+            query.all.return_value = [DeviceTemplate(id=1, label='SensorModel')]
+            data = json.dumps({'label': 'SensorModel', 'attrs': [
+                {'label': 'attr-{}'.format(i), 'type': 'dynamic', 'value_type': 'float',
+                 'metadata': [{'label': 'unit', 'type': 'meta', 'value_type': 'string',
+                               'static_value': 'C'}]}
+                for i in range(attr_count)]})
+            params = {'content_type': 'application/json', 'data': data}
+
+            with patch('DeviceManager.TemplateHandler.reserve_sequence_ids') as reserve_mock:
+                reserve_mock.side_effect = lambda session, sequence, count: list(range(1, count + 1))
+                result = TemplateHandler.create_template(params, token)
+                self.assertEqual(result['template']['id'], 1)
+                self.assertEqual(reserve_mock.call_count, 2)
+
+            inserts = [args[0] for args, _ in db_mock.session.execute.call_args_list
+                       if hasattr(args[0], 'table')]
+            self.assertEqual([insert.table.name for insert in inserts], ['templates', 'attrs', 'attrs'])
+            return db_mock.session.execute.call_count
+
+        # the number of statements does not depend on how many attributes
+        # (and metadata) the template has
+        self.assertEqual(count_statements(2), count_statements(50))
+
+    @patch('DeviceManager.TemplateHandler.db')
+    def test_create_templates_invalid(self, db_mock):
+        db_mock.session = AlchemyMagicMock()
+        token = generate_token()
+
+        data = json.dumps({'templates': [
+            {'label': 'SensorModel', 'attrs': []},
+            {'attrs': []},
+            {'label': 'Repeated', 'attrs': [
+                {'label': 'temperature', 'type': 'dynamic', 'value_type': 'float'},
+                {'label': 'temperature', 'type': 'dynamic', 'value_type': 'integer'}
+            ]}
+        ]})
+        params = {'content_type': 'application/json', 'data': data}
+
+        with pytest.raises(HTTPRequestError) as error:
+            TemplateHandler.create_templates(params, token)
+        self.assertEqual(error.value.error_code, 400)
+        self.assertEqual(sorted(error.value.message['errors']), [1, 2])
+        self.assertIn('label', error.value.message['errors'][1])
+        self.assertIn('attrs', error.value.message['errors'][2])
+        # nothing is written if any template is invalid
+        self.assertFalse([args for args, _ in db_mock.session.execute.call_args_list
+                          if hasattr(args[0], 'table')])
+
+        with pytest.raises(HTTPRequestError):
+            TemplateHandler.create_templates({'content_type': 'application/json',
+                                              'data': json.dumps({'templates': []})}, token)
+
     @patch('DeviceManager.TemplateHandler.db')
     def test_get_template(self, db_mock):
         db_mock.session = AlchemyMagicMock()
@@ -96,6 +196,80 @@ class TestTemplateHandler(unittest.TestCase):
                 params_query, 'template_id_test', token)
             self.assertFalse(result)
 
+    @patch('DeviceManager.TemplateHandler.db')
+    def test_get_template_attrs_format(self, db_mock):
+        db_mock.session = AlchemyMagicMock()
+        token = generate_token()
+
+        template = DeviceTemplate(id=1, label='template1', attrs=[
+            DeviceAttr(id=1, label='temperature', type='dynamic', value_type='float'),
+            DeviceAttr(id=2, label='protocol', type='meta', value_type='string')
+        ])
+
+        with patch('DeviceManager.TemplateHandler.assert_template_exists') as mock_template_exist_wrapper, \
+                patch('DeviceManager.TemplateHandler.load_attr_trees') as load_mock:
+            mock_template_exist_wrapper.return_value = template
+
+            result = TemplateHandler.get_template({'attrs_format': 'split'}, 1, token)
+            load_mock.assert_called_once_with([template], db_mock.session)
+            self.assertNotIn('attrs', result)
+            self.assertEqual([attr['label'] for attr in result['data_attrs']], ['temperature'])
+            self.assertEqual([attr['label'] for attr in result['config_attrs']], ['protocol'])
+
+            result = TemplateHandler.get_template({'attrs_format': 'single'}, 1, token)
+            self.assertEqual(len(result['attrs']), 2)
+            self.assertNotIn('data_attrs', result)
+            self.assertNotIn('config_attrs', result)
+
+            params = {'attrs_format': 'both', 'fields': 'label,data_attrs.label'}
+            result = TemplateHandler.get_template(params, 1, token)
+            self.assertEqual(result, {'label': 'template1', 'data_attrs': [{'label': 'temperature'}]})
+
+            # attributes are not loaded at all if not requested
+            load_mock.reset_mock()
+            TemplateHandler.get_template({'fields': 'id,label'}, 1, token)
+            load_mock.assert_not_called()
+
+    @patch('DeviceManager.TemplateHandler.db')
+    def test_get_templates_device_count(self, db_mock):
+        db_mock.session = AlchemyMagicMock()
+        token = generate_token()
+
+        templates = [DeviceTemplate(id=1, label='template1'), DeviceTemplate(id=2, label='template2')]
+        db_mock.session.query.return_value.options.return_value.order_by.return_value \
+            .paginate.return_value.items = templates
+        db_mock.session.query.return_value.filter.return_value.group_by.return_value \
+            .all.return_value = [(1, 42)]
+
+        params_query = {'page_number': 1, 'per_page': 2, 'sortBy': None, 'attr': [], 'attr_type': [],
+                        'fields': 'id,label', 'device_count': True}
+        result = TemplateHandler.get_templates(params_query, token)
+        self.assertEqual([template['device_count'] for template in result['templates']], [42, 0])
+
+    @patch('DeviceManager.TemplateHandler.db')
+    def test_get_template_usage(self, db_mock):
+        db_mock.session = AlchemyMagicMock()
+        token = generate_token()
+
+        with patch('DeviceManager.TemplateHandler.assert_template_exists'), \
+                patch('DeviceManager.DeviceHandler.db', db_mock), \
+                patch('DeviceManager.TemplateHandler.device_counts', return_value={1: 3}):
+            usage, device_ids = TemplateHandler.get_template_usage('1', token)
+            self.assertEqual(usage, {'template_id': 1, 'device_count': 3})
+            self.assertIsNone(device_ids)
+
+            # device ids are read in batches, resuming after the last id read
+            query = db_mock.session.query.return_value.filter.return_value
+            query.filter.return_value.order_by.return_value.limit.return_value.all.side_effect = [
+                [('00003',)], []
+            ]
+            query.order_by.return_value.limit.return_value.all.return_value = [('00001',), ('00002',)]
+            usage, device_ids = TemplateHandler.get_template_usage('1', token, with_ids=True, batch=2)
+            self.assertEqual(list(device_ids), [['00001', '00002'], ['00003']])
+
+            with pytest.raises(HTTPRequestError):
+                TemplateHandler.get_template_usage('template', token)
+
     @patch('DeviceManager.TemplateHandler.db')
     def test_delete_all_templates(self, db_mock):
         db_mock.session = AlchemyMagicMock()
@@ -106,6 +280,84 @@ class TestTemplateHandler(unittest.TestCase):
         self.assertTrue(result)
         self.assertEqual(result['result'], 'ok')
 
+    @patch('DeviceManager.TemplateHandler.db')
+    def test_delete_all_templates_set_based(self, db_mock):
+        db_mock.session = AlchemyMagicMock()
+        token = generate_token()
+
+        statements = []
+        removing = [[(1,), (2,)], [(3,)]]
+        def execute(stmt, *args, **kwargs):
+            sql = str(stmt.compile(dialect=postgresql.dialect())) if hasattr(stmt, 'compile') else str(stmt)
+            statements.append(sql)
+            if sql.startswith('DELETE FROM templates'):
+                return removing.pop(0)
+            return MagicMock()
+        db_mock.session.execute.side_effect = execute
+        query = db_mock.session.query.return_value
+        query.distinct.return_value.all.return_value = []
+        query.order_by.return_value.all.return_value = [(1,), (2,), (3,)]
+
+        result = TemplateHandler.delete_all_templates(token, batch=2)
+        self.assertEqual(result['removed'], [{'id': 1}, {'id': 2}, {'id': 3}])
+        deletes = [sql.split(' WHERE')[0].split(')\n ')[-1] for sql in statements if 'DELETE FROM' in sql]
+        self.assertEqual(deletes, ['DELETE FROM overrides', 'DELETE FROM pre_shared_keys',
+                                   'DELETE FROM attrs', 'DELETE FROM templates'] * 2)
+        # metadata, however deep, go along with their attributes
+        self.assertTrue(any(sql.startswith('WITH RECURSIVE attr_tree') for sql in statements))
+
+        # templates in use are detected before anything is removed
+        statements.clear()
+        query.distinct.return_value.all.return_value = [(2,)]
+        with pytest.raises(HTTPRequestError) as error:
+            TemplateHandler.delete_all_templates(token)
+        self.assertEqual(error.value.error_code, 400)
+        self.assertFalse([sql for sql in statements if 'DELETE FROM' in sql])
+
+    @patch('DeviceManager.TemplateHandler.db')
+    def test_clone_template(self, db_mock):
+        db_mock.session = AlchemyMagicMock()
+        token = generate_token()
+
+        statements = []
+        def execute(stmt, *args, **kwargs):
+            statements.append(stmt)
+            result = MagicMock()
+            result.scalar.return_value = 5
+            return result
+        db_mock.session.execute.side_effect = execute
+        db_mock.session.query.return_value.filter.return_value.all.return_value = [('temperature',),
+                                                                                   ('firmware',)]
+
+        data = json.dumps({'label': 'SensorModel v2', 'exclude': ['temperature'],
+                           'static_values': {'firmware': 2}})
+        params = {'content_type': 'application/json', 'data': data}
+        with patch('DeviceManager.TemplateHandler.assert_template_exists') as exists_mock, \
+                patch('DeviceManager.TemplateHandler.load_attr_trees'):
+            exists_mock.side_effect = [DeviceTemplate(id=1, label='SensorModel'),
+                                       DeviceTemplate(id=5, label='SensorModel v2')]
+            result = TemplateHandler.clone_template(params, '1', token)
+            self.assertEqual(result['result'], 'ok')
+            self.assertEqual(result['template']['id'], 5)
+
+            inserts = [stmt for stmt in statements if hasattr(stmt, 'table')]
+            self.assertEqual([insert.table.name for insert in inserts], ['templates', 'attrs'])
+            # attributes and metadata are copied by the database itself
+            compiled = inserts[1].compile(dialect=postgresql.dialect())
+            sql = str(compiled)
+            self.assertTrue(sql.startswith('WITH RECURSIVE attr_tree'))
+            self.assertIn('INSERT INTO attrs (id, label, created, type, value_type, static_value, '
+                          'template_id, parent_id) SELECT', sql)
+            self.assertIn('temperature', compiled.params.values())
+            self.assertIn('2', compiled.params.values())
+
+            exists_mock.side_effect = None
+            exists_mock.return_value = DeviceTemplate(id=1, label='SensorModel')
+            params['data'] = json.dumps({'exclude': ['humidity']})
+            with pytest.raises(HTTPRequestError) as error:
+                TemplateHandler.clone_template(params, '1', token)
+            self.assertEqual(error.value.error_code, 400)
+
     @patch('DeviceManager.TemplateHandler.db')
     def test_remove_template(self, db_mock):
         db_mock.session = AlchemyMagicMock()
@@ -158,17 +410,81 @@ class TestTemplateHandler(unittest.TestCase):
                 self.assertTrue(result)
                 self.assertTrue(result['updated'])
                 self.assertEqual(result['result'], 'ok')
+                self.assertEqual(result['fanout']['kind'], 'template.fanout')
+                self.assertEqual(result['fanout']['status'], 'pending')
+                # devices are published off the request, by a job committed along with the update
+                orm_job = db_mock.session.add.call_args[0][0]
+                self.assertEqual(orm_job.id, result['fanout']['id'])
+                params = json.loads(orm_job.params)['params']
+                self.assertEqual(params['template_id'], 1)
+                self.assertNotIn('device_ids', params)
+                self.assertIsNone(params['diff'])
+
+    def test_diff_attrs(self):
+        temperature = DeviceAttr(label='temperature', type='dynamic', value_type='float')
+        model = DeviceAttr(label='model', type='static', value_type='string')
+        requested = [
+            {'label': 'model', 'type': 'dynamic', 'value_type': 'string'},
+            {'label': 'temperature', 'type': 'dynamic', 'value_type': 'integer'},
+            {'label': 'humidity', 'type': 'dynamic', 'value_type': 'float'}
+        ]
+
+        matched, removed, added = diff_attrs([temperature, model], requested)
+        self.assertEqual(matched, [(temperature, requested[1])])
+        self.assertEqual(removed, [model])
+        self.assertEqual(added, [requested[0], requested[2]])
+
+    @patch('DeviceManager.TemplateHandler.db')
+    def test_update_template_attrs(self, db_mock):
+        db_mock.session = AlchemyMagicMock()
+        token = generate_token()
 
-    def test_attr_format(self):
-        params = {'data_attrs': [], 'config_attrs': [],
-                  'id': 1, 'attrs': [], 'label': 'template1'}
+        unit = DeviceAttr(label='unit', type='meta', value_type='string', static_value='C')
+        precision = DeviceAttr(label='precision', type='meta', value_type='integer', static_value='2')
+        temperature = DeviceAttr(id=1, label='temperature', type='dynamic', value_type='float',
+                                 children=[unit, precision])
+        model = DeviceAttr(id=2, label='model-id', type='static', value_type='string')
+        template = DeviceTemplate(id=1, label='SensorModel', attrs=[temperature, model])
 
-        result = attr_format('split', params)
-        self.assertNotIn('attrs', result)
+        data = json.dumps({
+            "label": "SensorModel",
+            "attrs": [
+                {"label": "temperature", "type": "dynamic", "value_type": "integer",
+                 "metadata": [{"label": "unit", "type": "meta", "value_type": "string", "static_value": "K"},
+                              {"label": "source", "type": "meta", "value_type": "string"}]},
+                {"label": "humidity", "type": "dynamic", "value_type": "float"}
+            ]
+        })
+        params_query = {'content_type': 'application/json', 'data': data}
 
-        result = attr_format('single', params)
-        self.assertNotIn('config_attrs', result)
-        self.assertNotIn('data_attrs', result)
+        with patch('DeviceManager.TemplateHandler.assert_template_exists', return_value=template), \
+                patch.object(KafkaInstanceHandler, "getInstance", return_value=MagicMock()), \
+                patch.object(CONFIG, 'template_update_mode', 'compact'), \
+                patch('DeviceManager.TemplateHandler.fanout_job', wraps=fanout_job) as fanout_mock:
+            TemplateHandler.update_template(params_query, 1, token)
+
+        diff = fanout_mock.call_args[1]['diff']
+        self.assertEqual([attr['label'] for attr in diff['added']], ['humidity'])
+        self.assertEqual([attr['label'] for attr in diff['removed']], ['model-id'])
+        self.assertEqual([attr['label'] for attr in diff['changed']], ['temperature'])
+        metadata_changes = diff['changed'][0]['metadata_changes']
+        self.assertEqual([meta['label'] for meta in metadata_changes['added']], ['source'])
+        self.assertEqual([meta['label'] for meta in metadata_changes['removed']], ['precision'])
+        self.assertEqual([meta['static_value'] for meta in metadata_changes['changed']], ['K'])
+
+        self.assertEqual(temperature.value_type, 'integer')
+        self.assertEqual(unit.static_value, 'K')
+        deleted = [item[0][0] for item in db_mock.session.delete.call_args_list]
+        self.assertEqual(deleted, [precision, model])
+        added = [item[0][0] for item in db_mock.session.add.call_args_list]
+        self.assertEqual([attr.label for attr in added[:-1]], ['source', 'humidity'])
+        # along with the job publishing the changes
+        self.assertEqual(added[-1].kind, 'template.fanout')
+
+        params_query['data'] = json.dumps({"label": "SensorModel", "attrs": [{"label": "temperature"}]})
+        with patch('DeviceManager.TemplateHandler.assert_template_exists', return_value=template):
+            with self.assertRaises(ValidationError):
+                TemplateHandler.update_template(params_query, 1, token)
 
     @patch('DeviceManager.TemplateHandler.db')
     def test_paginate(self, db_mock):
@@ -14,6 +14,25 @@ class TestTenancyManager(unittest.TestCase):
         db_mock = AlchemyMagicMock()
         self.assertIsNone(install_triggers(db_mock, 'admin'))
 
+    def test_install_triggers_by_server_version(self):
+        session = AlchemyMagicMock()
+        session.execute.return_value.scalar.return_value = '100012'
+        install_triggers(None, 'admin', session)
+        query = session.execute.call_args[0][0]
+        self.assertIn('DROP TRIGGER IF EXISTS validate_device_trigger', query)
+        self.assertIn('REFERENCING NEW TABLE AS new_links', query)
+        self.assertNotIn('FOR EACH ROW', query)
+
+        session.execute.return_value.scalar.return_value = '90424'
+        install_triggers(None, 'admin', session)
+        query = session.execute.call_args[0][0]
+        self.assertIn('FOR EACH ROW', query)
+        self.assertNotIn('REFERENCING NEW TABLE', query)
+
+        # explicitly requested
+        install_triggers(None, 'admin', session, statement_level=True)
+        self.assertIn('FOR EACH STATEMENT', session.execute.call_args[0][0])
+
     def test_create_tenant(self):
         db_mock = AlchemyMagicMock()
         self.assertIsNone(create_tenant('admin', db_mock))
@@ -4,7 +4,7 @@ import unittest
 
 from flask import Flask
 from DeviceManager.utils import format_response, get_pagination, get_allowed_service, decrypt, retrieve_auth_token
-from DeviceManager.utils import HTTPRequestError
+from DeviceManager.utils import HTTPRequestError, claims_token
 
 from .token_test_generator import generate_token
 
@@ -68,6 +68,10 @@ class TestUtils(unittest.TestCase):
         with self.assertRaises(ValueError):
             get_allowed_service('Is.Not_A_Valid_Token')
 
+    def test_claims_token(self):
+        for service in ['admin', 'tenant_with?odd/chars']:
+            self.assertEqual(get_allowed_service(claims_token({'service': service})), service)
+
 
     def test_decrypt(self):
         result = decrypt(b"\xa97\xa4o\xba\xddx\xe0\xe9\x8f\xe2\xc4V\x85\xf7'")